@@ -1,29 +1,38 @@
 import streamlit as st
 import extra_streamlit_components as stx
-from PIL import Image
-import google.generativeai as genai
-import pandas as pd
-import gspread
-from google.oauth2.service_account import Credentials
+from PIL import Image, ImageOps
 import datetime
 import io
-import requests
 import base64
-import matplotlib.pyplot as plt
-import matplotlib.font_manager as fm
-import matplotlib.patches as patches
 import os
 import time
 import json
 import re
 import random 
 import ast
-import numpy as np
-import textwrap
-
-# 🔥 [복구] 마이크 기능 라이브러리 활성화
-from streamlit_drawable_canvas import st_canvas
-from streamlit_mic_recorder import speech_to_text
+import threading
+import queue
+import concurrent.futures
+import sqlite3
+import uuid
+import zlib
+import hashlib
+import collections
+import shutil
+import functools
+import asyncio
+import contextlib
+import contextvars
+
+RUN_STARTED_AT = time.perf_counter() # 전체 실행(리런) 시간 측정 기준 (fragment 만 다시 실행될 때는 이 줄이 실행되지 않음)
+
+# 🔥 [성능] 무거운 라이브러리는 필요한 기능이 처음 실행될 때 import 합니다. (로그인 화면에는 불필요)
+#   google.generativeai / google.api_core  → Gemini 호출 (KeyModelScheduler)
+#   gspread / google.oauth2 / pandas      → 시트 연결, 기록·학생 목록
+#   requests                              → imgbb 업로드
+#   solution_image (matplotlib)           → 오답노트 이미지 렌더링 (로그인 후 백그라운드에서 미리 로드)
+#   streamlit_drawable_canvas / streamlit_mic_recorder → 학습 화면 위젯
+# 시작 시간 측정: python profile_startup.py
 
 # ----------------------------------------------------------
 # [1] 기본 설정 & 디자인 주입 (HTML/Tailwind)
@@ -89,13 +98,21 @@ try:
         key_name = f"GOOGLE_API_KEY_{i}"
         if key_name in st.secrets:
             API_KEYS.append(st.secrets[key_name])
-    API_KEYS = list(set([k for k in API_KEYS if k]))
+    API_KEYS = sorted(set([k for k in API_KEYS if k])) # 프로세스 간 키 순서 고정 (스케줄러 통계 기준)
     
     if not API_KEYS:
         st.error("설정 오류: API 키가 하나도 없습니다.")
         st.stop()
         
     IMGBB_API_KEY = st.secrets["IMGBB_API_KEY"]
+    HEDGED_REQUESTS = bool(st.secrets.get("HEDGED_REQUESTS", False)) # 헤지 요청 모드 (선택)
+    SOLUTION_IMAGE_ENGINE = st.secrets.get("SOLUTION_IMAGE_ENGINE", "pil") # "pil" | "matplotlib"
+    IMAGE_HANDLE_BACKEND = st.secrets.get("IMAGE_HANDLE_BACKEND", "gemini") # "gemini" | "local" (오프라인 테스트용)
+    SPECULATIVE_PRO = bool(st.secrets.get("SPECULATIVE_PRO", False)) # Pro 심화 분석 선행 생성 (선택)
+    SHARED_STATE = bool(st.secrets.get("SHARED_STATE", False)) # 다중 프로세스 배포 모드: 세션 상태 공유 저장소 (선택)
+    SHOW_DIAGNOSTICS = bool(st.secrets.get("SHOW_DIAGNOSTICS", False)) # 사이드바 진단 패널 (운영자용, 선택)
+    LLM_KEY_RPM = int(st.secrets.get("LLM_KEY_RPM", 10))         # 키당 분당 요청 수 한도 (프로세스 단위)
+    LLM_KEY_TPM = int(st.secrets.get("LLM_KEY_TPM", 250000))     # 키당 분당 토큰 수 한도 (프로세스 단위)
 except:
     st.error("설정 오류: Secrets 접근 실패")
     st.stop()
@@ -141,323 +158,2016 @@ def get_sheet_client():
     try:
         secrets = st.secrets["gcp_service_account"]
         scopes = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+        import gspread
+        from google.oauth2.service_account import Credentials
         creds = Credentials.from_service_account_info(secrets, scopes=scopes)
         client = gspread.authorize(creds)
         return client
     except: return None
 
+# 🔥 [성능] results 시트 접근 계층
+# (날짜, 이름) → 행 번호 인덱스를 프로세스당 한 번만 만들고, 행 추가 시 갱신합니다.
+# 단건 수정은 "인덱스 조회 → 해당 행 1줄 읽기(검증) → 셀 수정"으로 끝나므로 시트 전체를 내려받지 않습니다.
+RESULTS_COL_CONTENT = 5
+RESULTS_COL_LINK = 6
+RESULTS_COL_REVIEW = 8
+RESULTS_LIST_COLUMNS = [(1, 4), (6, 8)] # 날짜/이름/과목/단원 + 링크/(G)/복습횟수 (내용 열 제외)
+
+def rowcol_to_a1(row, col):
+    from gspread.utils import rowcol_to_a1 as _rowcol_to_a1
+    return _rowcol_to_a1(row, col)
+
+class ResultsStore:
+    def __init__(self, client, ttl=300, shared=None):
+        self._client = client
+        self._ttl = ttl
+        self._shared = shared
+        self._lock = threading.RLock()
+        self._sheet = None
+        self._headers = []
+        self._index = {}
+        self._by_student = {}
+        self._versions = {}
+        self._last_row = 1
+        self._built_at = 0.0
+
+    def _worksheet(self):
+        if self._sheet is None:
+            self._sheet = self._client.open_by_key(SHEET_ID).worksheet("results")
+        return self._sheet
+
+    def _rebuild(self):
+        # 헤더 1줄 + 날짜/이름 2개 열만 읽어서 인덱스 구성 (내용 열은 받지 않음)
+        header_rows, key_rows = self._worksheet().batch_get(["1:1", "A2:B"])
+        self._headers = header_rows[0] if header_rows else []
+        index, by_student = {}, {}
+        for i, row in enumerate(key_rows):
+            if len(row) < 2: continue
+            index.setdefault((str(row[0]), str(row[1])), i + 2) # 중복 시 첫 행 우선 (기존 동작 유지)
+            by_student.setdefault(str(row[1]), []).append(i + 2)
+        self._index = index
+        self._by_student = by_student
+        self._last_row = len(key_rows) + 1
+        self._built_at = time.time()
+
+    def _add_row(self, key, row_idx):
+        if key in self._index: return
+        self._index[key] = row_idx
+        self._by_student.setdefault(key[1], []).append(row_idx)
+        self._last_row = max(self._last_row, row_idx)
+        self.touch(key[1])
+
+    def touch(self, student_name):
+        # 학생별 버전: 해당 학생의 행이 바뀌면 증가 → 학생별 읽기 캐시 무효화 키로 사용
+        # 공유 저장소가 있으면 버전을 거기 두어서 다른 프로세스가 바꾼 행도 이 프로세스의 캐시를 무효화합니다.
+        if self._shared: return self._shared.bump_version(student_name)
+        self._versions[str(student_name)] = self._versions.get(str(student_name), 0) + 1
+
+    def student_version(self, student_name):
+        if self._shared: return self._shared.version(student_name)
+        return self._versions.get(str(student_name), 0)
+
+    def _is_stale(self):
+        return not self._headers or time.time() - self._built_at > self._ttl
+
+    def locate_many(self, keys):
+        keys = [(str(t), str(n)) for t, n in keys]
+        with self._lock:
+            if self._is_stale(): self._rebuild()
+            if any(key not in self._index for key in keys):
+                # 다른 프로세스가 추가한 행일 수 있으므로 한 번만 다시 만듭니다.
+                self._rebuild()
+            return {key: self._index[key] for key in keys if key in self._index}
+
+    def locate(self, target_time, student_name):
+        return self.locate_many([(target_time, student_name)]).get((str(target_time), str(student_name)))
+
+    def _row_to_record(self, values):
+        values = list(values) + [""] * (len(self._headers) - len(values))
+        return dict(zip(self._headers, values))
+
+    def read_rows(self, keys):
+        # 인덱스가 가리키는 행들만 batch_get 한 번으로 읽고, 키가 맞지 않는 행이 있으면(행 삭제/정렬 등) 재구축 후 한 번 더 시도
+        found = {}
+        pending = [(str(t), str(n)) for t, n in keys]
+        for attempt in range(2):
+            located = self.locate_many(pending)
+            if not located: break
+            with self._lock:
+                value_ranges = self._worksheet().batch_get([f"{r}:{r}" for r in located.values()])
+                mismatched = []
+                for (key, row_idx), rows in zip(located.items(), value_ranges):
+                    record = self._row_to_record(rows[0] if rows else [])
+                    if (str(record.get('날짜')), str(record.get('이름'))) == key:
+                        found[key] = (row_idx, record)
+                    else:
+                        mismatched.append(key)
+                if not mismatched: break
+                self._rebuild()
+                pending = mismatched
+        return found
+
+    def read_student_rows(self, student_name, columns=None):
+        # 학생별 행 번호 목록으로 해당 학생의 행만 읽습니다. 연속된 행은 하나의 범위로 묶어 batch_get 한 번.
+        # columns: [(시작 열, 끝 열), ...] (1부터). None 이면 행 전체. 검증을 위해 이름(B) 열은 포함해야 합니다.
+        student_name = str(student_name)
+        records = []
+        for attempt in range(2):
+            with self._lock:
+                if self._is_stale(): self._rebuild()
+                row_ids = sorted(self._by_student.get(student_name, []))
+                if not row_ids: return []
+                spans = []
+                for r in row_ids:
+                    if spans and spans[-1][1] == r - 1: spans[-1][1] = r
+                    else: spans.append([r, r])
+                col_spans = columns or [(1, len(self._headers))]
+                value_ranges = iter(self._worksheet().batch_get([
+                    f"{rowcol_to_a1(a, c0)}:{rowcol_to_a1(b, c1)}"
+                    for a, b in spans for c0, c1 in col_spans
+                ]))
+                records = []
+                for a, b in spans:
+                    merged = [{} for _ in range(b - a + 1)]
+                    for c0, c1 in col_spans:
+                        rows = next(value_ranges)
+                        headers = self._headers[c0 - 1:c1]
+                        for i, record in enumerate(merged):
+                            values = list(rows[i]) if i < len(rows) else [] # 끝쪽 빈 행은 응답에서 생략됨
+                            record.update(zip(headers, values + [""] * (len(headers) - len(values))))
+                    records.extend(merged)
+                if all(str(rec.get('이름')) == student_name for rec in records):
+                    return records
+                self._rebuild()
+        return [rec for rec in records if str(rec.get('이름')) == student_name]
+
+    def read_content(self, target_time, student_name):
+        # 상세 보기용: 내용 셀 하나와 검증용 날짜/이름만 읽기
+        key = (str(target_time), str(student_name))
+        for attempt in range(2):
+            row_idx = self.locate(*key)
+            if row_idx is None: return None
+            with self._lock:
+                key_rows, content_rows = self._worksheet().batch_get([f"A{row_idx}:B{row_idx}", rowcol_to_a1(row_idx, RESULTS_COL_CONTENT)])
+                if key_rows and tuple(str(v) for v in key_rows[0][:2]) == key:
+                    return content_rows[0][0] if content_rows and content_rows[0] else ""
+                self._rebuild()
+        return None
+
+    def last_row(self):
+        with self._lock:
+            if self._is_stale(): self._rebuild()
+            return self._last_row
+
+    def read_content_range(self, start_row, end_row):
+        # 마이그레이션용: 날짜/이름 + 내용 열만 구간 단위로 읽기 → [(행, 날짜, 이름, 내용), ...]
+        col = rowcol_to_a1(1, RESULTS_COL_CONTENT).rstrip("1")
+        with self._lock:
+            key_rows, content_rows = self._worksheet().batch_get([f"A{start_row}:B{end_row}", f"{col}{start_row}:{col}{end_row}"])
+        result = []
+        for i in range(end_row - start_row + 1):
+            keys = list(key_rows[i]) if i < len(key_rows) else []
+            content = content_rows[i][0] if i < len(content_rows) and content_rows[i] else ""
+            if len(keys) < 2: continue
+            result.append((start_row + i, str(keys[0]), str(keys[1]), content))
+        return result
+
+    def update_cells(self, cells):
+        # cells: [(행, 열, 값), ...] → batch_update 한 번 (update_cell 과 같은 USER_ENTERED 입력)
+        if not cells: return
+        data = [{"range": rowcol_to_a1(r, c), "values": [[v]]} for r, c, v in cells]
+        with self._lock:
+            self._worksheet().batch_update(data, raw=False)
+
+    def append_rows(self, rows):
+        with self._lock:
+            response = self._worksheet().append_rows(rows)
+            if self._headers:
+                updated_range = (response or {}).get('updates', {}).get('updatedRange', "")
+                match = re.search(r'![A-Z]+(\d+)', updated_range)
+                if match:
+                    first_row = int(match.group(1))
+                    for offset, values in enumerate(rows):
+                        self._add_row((str(values[0]), str(values[1])), first_row + offset)
+                else:
+                    self._built_at = 0.0 # 행 번호를 모르면 다음 조회 때 재구축
+                    for values in rows: self.touch(values[1])
+            return response
+
 @st.cache_resource
-def get_handwriting_font_prop():
-    font_file = "NanumPen.ttf"
-    if not os.path.exists(font_file):
-        url = "https://github.com/google/fonts/raw/main/ofl/nanumpenscript/NanumPenScript-Regular.ttf"
+def get_results_store():
+    client = get_sheet_client()
+    if not client: return None
+    return ResultsStore(client, shared=get_shared_state())
+
+# 🔥 [저장 포맷] 내용 셀 직렬화 (v2)
+# 새 기록은 스키마 버전(_v)이 들어간 compact JSON 으로 저장하고, 셀 한도(50,000자)에 가까우면 zlib 압축 후 base64.
+# 예전 str(dict) 기록은 그대로 읽을 수 있고, 백그라운드 마이그레이션이 v2 로 다시 씁니다.
+RECORD_FORMAT_VERSION = 2
+RECORD_ZLIB_PREFIX = "z2:"
+RECORD_ZLIB_THRESHOLD = 40000
+
+class LRUCache:
+    def __init__(self, maxsize=512):
+        self._maxsize = maxsize
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data: return default
+            self._data.move_to_end(key)
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self._maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def __len__(self):
+        return len(self._data)
+
+@st.cache_resource
+def get_record_parse_cache():
+    return LRUCache(maxsize=1024)
+
+def is_legacy_result_content(raw):
+    return bool(raw) and not raw.startswith('{"') and not raw.startswith(RECORD_ZLIB_PREFIX)
+
+def encode_result_content(data):
+    payload = dict(data)
+    payload['_v'] = RECORD_FORMAT_VERSION
+    text = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    if len(text) > RECORD_ZLIB_THRESHOLD:
+        text = RECORD_ZLIB_PREFIX + base64.b64encode(zlib.compress(text.encode("utf-8"), 6)).decode("ascii")
+    return text
+
+def _parse_result_content(raw):
+    if raw.startswith(RECORD_ZLIB_PREFIX):
+        raw = zlib.decompress(base64.b64decode(raw[len(RECORD_ZLIB_PREFIX):])).decode("utf-8")
+    if raw.startswith('{"'):
+        data = json.loads(raw)
+        data.pop('_v', None)
+        return data
+    # 예전 str(dict) 포맷
+    try:
+        return ast.literal_eval(raw)
+    except:
+        return ast.literal_eval(raw.replace("\\", "\\\\"))
+
+def decode_result_content(raw):
+    # 내용 해시로 파싱 결과를 캐시 → 바뀌지 않은 기록은 다시 파싱하지 않음 (반환값은 공유되므로 수정 전 복사할 것)
+    digest = hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+    cache = get_record_parse_cache()
+    data = cache.get(digest)
+    if data is None:
+        data = _parse_result_content(raw)
+        cache.put(digest, data)
+    return data
+
+# 🔥 [안정성] 시트 쓰기 Outbox (Write-Behind)
+# UI 는 로컬 SQLite(WAL)에 기록만 하고 바로 돌아옵니다. 백그라운드 워커가 모아서
+# append_rows / batch_update 로 시트에 반영하고, 실패하면 지수 백오프로 재시도합니다.
+# 같은 행에 대한 여러 수정은 한 번의 쓰기로 합쳐집니다(coalesce).
+OUTBOX_PATH = "mathai_outbox.db"
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_BATCH_WINDOW_SEC = 0.5
+OUTBOX_POLL_SEC = 5
+OUTBOX_LEASE_SEC = 120
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_MAX_BACKOFF_SEC = 300
+
+class SheetOutbox:
+    def __init__(self, store, path=OUTBOX_PATH, batch_size=OUTBOX_BATCH_SIZE):
+        self._store = store
+        self._path = path
+        self._batch_size = batch_size
+        self._owner = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._wake = threading.Event()
+        conn = self._connect()
         try:
-            r = requests.get(url)
-            with open(font_file, "wb") as f:
-                f.write(r.content)
-        except: pass
-    try: return fm.FontProperties(fname=font_file)
-    except: return None
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    kind TEXT NOT NULL,
+                    row_key TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL DEFAULT 0,
+                    claimed_by TEXT,
+                    claimed_at REAL,
+                    dead INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (dead, next_attempt_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        finally: conn.close()
+        threading.Thread(target=self._run, name="sheet-outbox", daemon=True).start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=FULL")
+        return conn
+
+    def enqueue(self, kind, row_key, payload):
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT INTO outbox (kind, row_key, payload, created_at) VALUES (?, ?, ?, ?)",
+                (kind, json.dumps([str(k) for k in row_key], ensure_ascii=False), json.dumps(payload, ensure_ascii=False), time.time())
+            )
+        finally: conn.close()
+        self._wake.set()
+
+    def append(self, values, content=None):
+        self.enqueue("append", (values[0], values[1]), {"values": values, "content": content})
+
+    def update(self, row_key, content=None, cells=None, review=0, reencode=False):
+        self.enqueue("update", row_key, {"content": content or {}, "cells": cells or {}, "review": review, "reencode": reencode})
+
+    def get_meta(self, key, default=None):
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        finally: conn.close()
+        return json.loads(row[0]) if row else default
+
+    def set_meta(self, key, value):
+        conn = self._connect()
+        try:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+        finally: conn.close()
+
+    def stats(self):
+        conn = self._connect()
+        try:
+            pending, dead = conn.execute("SELECT COALESCE(SUM(dead = 0), 0), COALESCE(SUM(dead = 1), 0) FROM outbox").fetchone()
+        finally: conn.close()
+        return {"pending": pending, "dead": dead}
+
+    def dead_letters(self, student_name=None):
+        # 최대 시도 횟수를 넘겨 멈춘 작업 (student_name 이 있으면 그 학생의 행만)
+        conn = self._connect()
+        try:
+            rows = conn.execute("SELECT id, kind, row_key, payload, attempts, created_at, last_error FROM outbox WHERE dead = 1 ORDER BY id").fetchall()
+        finally: conn.close()
+        letters = [
+            {"id": op_id, "kind": kind, "row_key": json.loads(row_key), "payload": json.loads(payload),
+             "attempts": attempts, "created_at": created_at, "last_error": last_error}
+            for op_id, kind, row_key, payload, attempts, created_at, last_error in rows
+        ]
+        if student_name is not None: letters = [l for l in letters if l["row_key"][1] == student_name]
+        return letters
+
+    def retry_dead(self, ids):
+        # 멈춘 작업을 처음부터 다시 시도 (id 순서를 그대로 쓰므로 같은 행의 추가·수정 순서는 유지)
+        if not ids: return 0
+        conn = self._connect()
+        try:
+            count = conn.execute(
+                f"UPDATE outbox SET dead = 0, attempts = 0, next_attempt_at = 0, claimed_by = NULL, claimed_at = NULL "
+                f"WHERE dead = 1 AND id IN ({','.join('?' * len(ids))})", list(ids)
+            ).rowcount
+        finally: conn.close()
+        self._wake.set()
+        return count
+
+    def _claim(self):
+        # 같은 행의 선행 작업이 백오프 중이거나 다른 워커가 처리 중이면 그 행은 건너뜁니다 (순서 보장)
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            rows = conn.execute("""
+                SELECT id, kind, row_key, payload, attempts FROM outbox
+                WHERE dead = 0 AND next_attempt_at <= ?
+                  AND (claimed_by IS NULL OR claimed_at < ?)
+                  AND row_key NOT IN (
+                      SELECT row_key FROM outbox
+                      WHERE dead = 0 AND (next_attempt_at > ? OR (claimed_by IS NOT NULL AND claimed_at >= ?))
+                  )
+                ORDER BY id LIMIT ?
+            """, (now, now - OUTBOX_LEASE_SEC, now, now - OUTBOX_LEASE_SEC, self._batch_size)).fetchall()
+            conn.executemany("UPDATE outbox SET claimed_by = ?, claimed_at = ? WHERE id = ?", [(self._owner, now, r[0]) for r in rows])
+            conn.execute("COMMIT")
+            return rows
+        except:
+            conn.execute("ROLLBACK")
+            raise
+        finally: conn.close()
+
+    def _finish(self, done_ids, failed):
+        # failed: {op_id: (attempts, error)}
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany("DELETE FROM outbox WHERE id = ?", [(i,) for i in done_ids])
+            for op_id, (attempts, error) in failed.items():
+                attempts += 1
+                backoff = min(OUTBOX_MAX_BACKOFF_SEC, 2 ** attempts) * (1 + random.random() * 0.2)
+                conn.execute(
+                    "UPDATE outbox SET attempts = ?, next_attempt_at = ?, claimed_by = NULL, claimed_at = NULL, dead = ?, last_error = ? WHERE id = ?",
+                    (attempts, now + backoff, int(attempts >= OUTBOX_MAX_ATTEMPTS), str(error)[:500], op_id)
+                )
+            conn.execute("COMMIT")
+        finally: conn.close()
+
+    def _coalesce(self, rows):
+        # 행 키별로 작업을 id 순서대로 합칩니다. 같은 배치 안에 새 행 추가가 있으면 후속 수정은 추가 전에 반영합니다.
+        groups = {}
+        for op_id, kind, row_key, payload, attempts in rows:
+            key = tuple(json.loads(row_key))
+            payload = json.loads(payload)
+            group = groups.setdefault(key, {"ids": [], "attempts": 0, "values": None, "content": None, "patch": {}, "cells": {}, "review": 0, "reencode": False})
+            group["ids"].append(op_id)
+            group["attempts"] = max(group["attempts"], attempts)
+            if kind == "append":
+                group["values"] = payload["values"]
+                group["content"] = payload.get("content")
+            else:
+                if group["values"] is not None and isinstance(group["content"], dict):
+                    group["content"].update(payload["content"])
+                else:
+                    group["patch"].update(payload["content"])
+                group["cells"].update(payload["cells"])
+                group["review"] += payload["review"]
+                group["reencode"] = group["reencode"] or payload.get("reencode", False)
+        return groups
+
+    def _flush(self, rows):
+        groups = self._coalesce(rows)
+        done, failed = [], {}
+
+        def fail(group, error):
+            for op_id in group["ids"]: failed[op_id] = (group["attempts"], error)
+
+        # 1) 새 행 추가: append_rows 한 번
+        appends = [g for g in groups.values() if g["values"] is not None]
+        if appends:
+            new_rows = []
+            for g in appends:
+                values = list(g["values"])
+                if g["content"] is not None: values[RESULTS_COL_CONTENT - 1] = encode_result_content(g["content"])
+                for col, value in g["cells"].items(): values[int(col) - 1] = value
+                values[RESULTS_COL_REVIEW - 1] = int(values[RESULTS_COL_REVIEW - 1] or 0) + g["review"]
+                new_rows.append(values)
+            try:
+                self._store.append_rows(new_rows)
+                for g in appends: done.extend(g["ids"])
+            except Exception as e:
+                for g in appends: fail(g, e)
+
+        # 2) 기존 행 수정: 대상 행만 batch_get 으로 읽고 batch_update 한 번
+        updates = {key: g for key, g in groups.items() if g["values"] is None}
+        if updates:
+            try:
+                found = self._store.read_rows(list(updates.keys()))
+                cells, applied = [], []
+                for key, g in updates.items():
+                    if key not in found:
+                        fail(g, "row not found")
+                        continue
+                    row_idx, record = found[key]
+                    try:
+                        if g["patch"] or g["reencode"]:
+                            data = dict(decode_result_content(record.get('내용')))
+                            data.update(g["patch"])
+                            cells.append((row_idx, RESULTS_COL_CONTENT, encode_result_content(data)))
+                        for col, value in g["cells"].items():
+                            cells.append((row_idx, int(col), value))
+                        if g["review"]:
+                            current_count = record.get('복습횟수')
+                            if current_count == '' or current_count is None: current_count = 0
+                            cells.append((row_idx, RESULTS_COL_REVIEW, int(current_count) + g["review"]))
+                        applied.append((key, g))
+                    except Exception as e:
+                        fail(g, e)
+                self._store.update_cells(cells)
+                for key, g in applied:
+                    done.extend(g["ids"])
+                    self._store.touch(key[1])
+            except Exception as e:
+                for g in updates.values():
+                    if g["ids"][0] not in failed: fail(g, e)
+
+        self._finish(done, failed)
+
+    def _run(self):
+        while True:
+            self._wake.wait(timeout=OUTBOX_POLL_SEC)
+            self._wake.clear()
+            time.sleep(OUTBOX_BATCH_WINDOW_SEC) # 연속 클릭을 한 배치로 모으기
+            try:
+                while True:
+                    rows = self._claim()
+                    if not rows: break
+                    self._flush(rows)
+            except Exception:
+                time.sleep(OUTBOX_POLL_SEC)
+
+@st.cache_resource
+def get_sheet_outbox():
+    store = get_results_store()
+    if not store: return None
+    return SheetOutbox(store)
+
+# 🔥 [저장 포맷] 예전 str(dict) 기록 → v2 백그라운드 마이그레이션
+# 구간 단위로 날짜/이름/내용 열만 읽고, 예전 포맷인 행은 Outbox 에 재인코딩 작업으로 넣습니다.
+# (Outbox 를 거치므로 같은 행에 대한 학생의 수정과 순서가 섞이지 않습니다.) 진행 위치는 Outbox DB 에 저장.
+RECORD_MIGRATION_CHUNK = 200
+RECORD_MIGRATION_PAUSE_SEC = 2
+
+def _migrate_legacy_records(store, outbox):
+    while True:
+        try:
+            start_row = outbox.get_meta("record_migration_row", 2)
+            end_row = min(start_row + RECORD_MIGRATION_CHUNK - 1, store.last_row())
+            if end_row < start_row: return
+            for row_idx, row_date, student_name, raw in store.read_content_range(start_row, end_row):
+                if not is_legacy_result_content(raw): continue
+                try: decode_result_content(raw)
+                except: continue # 파싱 불가 기록은 원본 유지
+                outbox.update((row_date, student_name), reencode=True)
+            outbox.set_meta("record_migration_row", end_row + 1)
+        except Exception:
+            time.sleep(OUTBOX_MAX_BACKOFF_SEC)
+        time.sleep(RECORD_MIGRATION_PAUSE_SEC)
+
+@st.cache_resource
+def start_record_migration():
+    store, outbox = get_results_store(), get_sheet_outbox()
+    if not store or not outbox: return None
+    worker = threading.Thread(target=_migrate_legacy_records, args=(store, outbox), name="record-migration", daemon=True)
+    worker.start()
+    return worker
 
 def resize_image(image, max_width=800):
     w, h = image.size
     if w > max_width:
         ratio = max_width / float(w)
         new_h = int((float(h) * float(ratio)))
-        image = image.resize((max_width, new_h), Image.Resampling.LANCZOS)
+        image = image.resize((max_width, new_h), Image.Resampling.LANCZOS, reducing_gap=3.0) # 큰 사진은 정수배 축소 후 LANCZOS
     return image
 
+# 🔥 [성능] 문제 이미지 수집 단계
+# 업로드/카메라 사진을 한 번만 디코드 → 정규화 → 압축하고, 그 결과(ProblemImage)를 미리보기, 캔버스,
+# 캐시 키, Gemini 호출(모든 재시도/헤지 포함), 오답노트 렌더링이 함께 씁니다. 같은 파일은 다시 처리하지 않습니다.
+INGEST_MAX_WIDTH = 800
+INGEST_BYTE_BUDGET = 300 * 1024     # Gemini 로 보내는 압축 이미지 최대 크기
+INGEST_FORMAT = "JPEG"              # "WEBP" 도 가능 (더 작지만 인코딩이 수십 배 느림, 인코더가 없으면 JPEG)
+INGEST_QUALITIES = (85, 75, 65, 55)
+INGEST_GRAY_SATURATION = 24         # 평균 채도(0~255)가 이보다 낮으면 흑백 인쇄물로 보고 L 로 변환
+
+class ProblemImage:
+    def __init__(self, image, data, mime_type, dhash):
+        self._image = image         # 정규화된 PIL 이미지 (폭 ≤ INGEST_MAX_WIDTH). None 이면 필요할 때 data 에서 디코드
+        self._size = image.size if image is not None else None
+        self.data = data            # 압축 바이트 (한 번만 인코딩, 기준 저장 형태)
+        self.mime_type = mime_type
+        self.dhash = dhash
+        self.digest = hashlib.blake2b(data, digest_size=16).hexdigest() # 업로드 핸들 키
+
+    @property
+    def image(self):
+        image = self._image
+        if image is None:
+            image = Image.open(io.BytesIO(self.data))
+            image.load()
+            self._image, self._size = image, image.size
+        return image
+
+    @property
+    def size(self):
+        return self._size or self.image.size
+
+    def release(self):
+        # 디코드된 픽셀만 버림 (압축 바이트는 유지, 다음 접근 때 다시 디코드)
+        self._image = None
+
+    def decoded_nbytes(self):
+        image = self._image
+        return image.width * image.height * len(image.getbands()) if image is not None else 0
+
+    def blob(self):
+        return {"mime_type": self.mime_type, "data": self.data}
+
+EXIF_ORIENTATION_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT, 3: Image.Transpose.ROTATE_180, 4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE, 6: Image.Transpose.ROTATE_270, 7: Image.Transpose.TRANSVERSE, 8: Image.Transpose.ROTATE_90,
+}
+
+def is_mostly_gray(image):
+    # 인쇄된 수학 문제처럼 색이 거의 없는 사진인지 (64×64 축소본의 평균 채도로 판단)
+    if image.mode == "L": return True
+    saturation = image.resize((64, 64), Image.Resampling.BOX).convert("HSV").getchannel("S")
+    return sum(saturation.getdata()) / (64 * 64) < INGEST_GRAY_SATURATION
+
+def encode_within_budget(image, budget=INGEST_BYTE_BUDGET, fmt=INGEST_FORMAT):
+    # 품질을 낮춰 가며 예산 안에 들어오는 첫 인코딩 → 그래도 크면 0.85배씩 축소
+    while True:
+        for quality in INGEST_QUALITIES:
+            buf = io.BytesIO()
+            try: image.save(buf, format=fmt, quality=quality)
+            except (KeyError, OSError):
+                if fmt == "JPEG": raise
+                return encode_within_budget(image, budget, "JPEG")
+            if buf.tell() <= budget or min(image.size) < 200:
+                return image, buf.getvalue(), f"image/{fmt.lower()}"
+        image = image.resize((int(image.width * 0.85), int(image.height * 0.85)), Image.Resampling.LANCZOS)
+
+@st.cache_resource
+def get_problem_image_cache():
+    return LRUCache(maxsize=16)
+
+def ingest_problem_image(uploaded_file):
+    raw = uploaded_file.getvalue()
+    digest = hashlib.blake2b(raw, digest_size=16).hexdigest()
+    cache = get_problem_image_cache()
+    problem = cache.get(digest)
+    if problem is not None: return problem
+
+    image = Image.open(io.BytesIO(raw))
+    orientation = image.getexif().get(0x0112, 1)
+    rotated = orientation in (5, 6, 7, 8) # 90°/270° 회전이면 저장된 세로 길이가 화면의 폭이 됨
+    if image.format == "JPEG":
+        # draft: JPEG 를 디코드 단계에서 1/2·1/4·1/8 로 줄여 읽음 (12MP 사진도 목표 폭 근처만 디코드)
+        image.draft("RGB", (1, INGEST_MAX_WIDTH) if rotated else (INGEST_MAX_WIDTH, 1))
+    if image.mode not in ("RGB", "L"): image = image.convert("RGB")
+    # 정규화: 색이 거의 없으면 먼저 흑백으로 바꿔 이후 단계의 처리량을 1/3 로 → 축소 → EXIF 방향 적용(작은 이미지에서)
+    # → 양 끝 1% 를 잘라 대비를 늘림 (그래프 등 컬러 사진은 컬러 유지)
+    if is_mostly_gray(image): image = image.convert("L")
+    if rotated and image.height > INGEST_MAX_WIDTH:
+        new_w = int(image.width * INGEST_MAX_WIDTH / image.height)
+        image = image.resize((new_w, INGEST_MAX_WIDTH), Image.Resampling.LANCZOS, reducing_gap=3.0)
+    elif not rotated:
+        image = resize_image(image, INGEST_MAX_WIDTH)
+    if orientation in EXIF_ORIENTATION_TRANSPOSE: image = image.transpose(EXIF_ORIENTATION_TRANSPOSE[orientation])
+    image = ImageOps.autocontrast(image, cutoff=1)
+    problem = problem_image_from_pil(image)
+    cache.put(digest, problem)
+    return problem
+
+def problem_image_from_pil(image, budget=INGEST_BYTE_BUDGET):
+    image, data, mime_type = encode_within_budget(image, budget)
+    return ProblemImage(image, data, mime_type, image_dhash(image))
+
+# 🔥 [성능] 판서 모드 변경 감지
+# st_canvas 의 image_data 는 배경 없이 필기 레이어(RGBA)만 담고 있어서, 필기가 바뀌었을 때만 문제 이미지 위에 합성합니다.
+# 변경 여부는 벡터 json_data 의 해시로 판단합니다. 지난 턴 이후 새로 그린 획만 작은 영역에 있으면 문제 이미지 핸들 +
+# 그 부분을 확대한 crop 을, 넓으면 축소한 합성본을 보냅니다. 필기가 그대로면 지난번 이미지(핸들)를 그대로 씁니다.
+# crop·합성본은 필기가 바뀔 때마다 새로 만들어 한두 번만 쓰므로 처음에는 File API 핸들 없이 인라인 바이트로 보냅니다. (세션에는 SessionBlob)
+# 필기가 그대로인 채 대화가 이어지면 같은 바이트를 ProblemImage 로 감싸 업로드 핸들을 재사용합니다. (키별로 한 번만 업로드, 다시 인코딩하지 않음)
+CANVAS_CROP_MAX_AREA = 0.35         # 새 필기 영역이 이미지의 이 비율 이하이면 crop
+CANVAS_CROP_PADDING = 32            # crop 여백 (이미지 픽셀)
+CANVAS_CROP_MIN_SIDE = 160
+CANVAS_COMPOSITE_MAX_WIDTH = 640
+CANVAS_BYTE_BUDGET = 150 * 1024
+
+def canvas_strokes(json_data, image_data, previous=None):
+    # 리런마다 호출: 필기가 바뀐 경우에만 새 상태를 만들고, 아니면 이전 상태를 그대로 돌려줌
+    # 필기 레이어(RGBA 배열)는 세션에 그대로 두지 않고 PNG 로 압축해 둠 (대부분 투명이라 수 KB)
+    objects = (json_data or {}).get("objects") or []
+    signature = hashlib.blake2b(json.dumps(objects, sort_keys=True).encode("utf-8"), digest_size=16).hexdigest()
+    if previous and previous["signature"] == signature: return previous
+    ink, ink_width = None, None
+    if image_data is not None and objects:
+        if image_data.dtype != "uint8": image_data = image_data.astype("uint8")
+        buf = io.BytesIO()
+        Image.fromarray(image_data, "RGBA").save(buf, format="PNG", compress_level=1)
+        ink, ink_width = SessionBlob(buf.getvalue()), image_data.shape[1]
+    return {"signature": signature, "objects": objects, "ink": ink, "ink_width": ink_width}
+
+def _ink_bbox(objects, scale):
+    boxes = []
+    for obj in objects:
+        pad = float(obj.get("strokeWidth") or 0)
+        left, top = float(obj.get("left", 0)) - pad, float(obj.get("top", 0)) - pad
+        boxes.append((left, top, left + float(obj.get("width", 0)) + 2 * pad, top + float(obj.get("height", 0)) + 2 * pad))
+    if not boxes: return None
+    return tuple(int(v * scale) for v in (min(b[0] for b in boxes), min(b[1] for b in boxes), max(b[2] for b in boxes), max(b[3] for b in boxes)))
+
+def compose_annotation(problem, ink_png):
+    base = problem.image.convert("RGB")
+    ink = Image.open(io.BytesIO(ink_png)).convert("RGBA").resize(base.size, Image.Resampling.BILINEAR)
+    base.paste(ink, (0, 0), ink)
+    return base
+
+def _canvas_part(image):
+    _, data, mime_type = encode_within_budget(image, CANVAS_BYTE_BUDGET)
+    return {"mime_type": mime_type, "blob": SessionBlob(data)}
+
+def _canvas_images(problem, sent, reused=False):
+    # 보낼 이미지 목록: (crop 이면) 문제 이미지 + 판서 (처음에는 인라인 blob, 다시 보낼 때는 핸들로 바뀌는 ProblemImage)
+    data = sent["canvas"]["blob"].get()
+    canvas = ProblemImage(None, data, sent["canvas"]["mime_type"], None) if reused else {"mime_type": sent["canvas"]["mime_type"], "data": data}
+    return [problem, canvas] if sent["with_problem"] else [canvas]
+
+def canvas_images_for_chat(problem, strokes, sent):
+    # → (보낼 이미지 목록, 프롬프트에 덧붙일 설명, 이번에 보낸 상태)
+    if not strokes or not strokes["objects"] or strokes["ink"] is None:
+        return [problem], "", None
+    if sent and sent["signature"] == strokes["signature"]:
+        return _canvas_images(problem, sent, reused=True), sent["note"], sent
+    objects = strokes["objects"]
+    new_objects = objects
+    if sent and len(objects) >= sent["count"] and objects[:sent["count"]] == sent["objects"]:
+        new_objects = objects[sent["count"]:] # 이전에 보낸 획은 그대로 두고 새로 그린 획만
+    composite = compose_annotation(problem, strokes["ink"].get())
+    bbox = _ink_bbox(new_objects, composite.width / strokes["ink_width"])
+    if bbox and (bbox[2] - bbox[0]) * (bbox[3] - bbox[1]) <= CANVAS_CROP_MAX_AREA * composite.width * composite.height:
+        left, top, right, bottom = bbox
+        cx, cy = (left + right) // 2, (top + bottom) // 2
+        half_w = max(right - left + 2 * CANVAS_CROP_PADDING, CANVAS_CROP_MIN_SIDE) // 2
+        half_h = max(bottom - top + 2 * CANVAS_CROP_PADDING, CANVAS_CROP_MIN_SIDE) // 2
+        crop = composite.crop((max(0, cx - half_w), max(0, cy - half_h), min(composite.width, cx + half_w), min(composite.height, cy + half_h)))
+        canvas, with_problem = _canvas_part(crop), True
+        note = "[판서] 두 번째 이미지는 학생이 방금 문제 위에 빨간 펜으로 표시한 부분을 확대한 것입니다."
+    else:
+        canvas, with_problem = _canvas_part(resize_image(composite, CANVAS_COMPOSITE_MAX_WIDTH)), False
+        note = "[판서] 이미지의 빨간 펜 표시는 학생이 문제 위에 직접 그린 것입니다."
+    sent = {"signature": strokes["signature"], "objects": objects, "count": len(objects), "canvas": canvas, "with_problem": with_problem, "note": note}
+    return _canvas_images(problem, sent), note, sent
+
+# 🔥 [메모리] 세션별 무거운 객체 관리 (SessionHeap, 프로세스 공용)
+# 세션에는 이미지를 압축 바이트로만 두고(문제 이미지 JPEG, 오답노트 이미지 JPEG, 판서 PNG) 화면에 그릴 때 디코드합니다.
+# 매 실행 끝에 세션이 가진 객체를 등록해 두면, 백그라운드 스위퍼가 한동안 활동이 없는 세션의 압축 바이트를
+# 디스크로 내보내고(spill) 디코드된 픽셀을 해제합니다. 다음 접근 때 다시 읽으므로 학생 쪽에서는 차이가 없습니다.
+# 세션별 메모리 사용량 보고서(report)는 스위퍼가 주기적으로 SESSION_REPORT_FILE 에 기록합니다.
+SESSION_IDLE_EVICT_SEC = 300
+SESSION_HEAP_SWEEP_SEC = 30
+SESSION_SPILL_DIR = "session_spill"
+SESSION_REPORT_FILE = os.path.join(SESSION_SPILL_DIR, "report.json")
+
+class SessionBlob:
+    def __init__(self, data):
+        self._data = data
+        self._path = None
+        self.nbytes = len(data)
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._data is None:
+                with open(self._path, "rb") as f: self._data = f.read()
+                os.remove(self._path)
+                self._path = None
+            return self._data
+
+    def spill(self, path):
+        with self._lock:
+            if self._data is None: return
+            with open(path, "wb") as f: f.write(self._data)
+            self._data, self._path = None, path
+
+    def discard(self):
+        with self._lock:
+            if self._path and os.path.exists(self._path): os.remove(self._path)
+            self._path = None
+
+    @property
+    def in_memory(self):
+        return self._data is not None
+
+def _process_rss_bytes():
+    try:
+        with open("/proc/self/statm") as f: return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except Exception: return None
+
+class SessionHeap:
+    def __init__(self, spill_root=SESSION_SPILL_DIR, idle_sec=SESSION_IDLE_EVICT_SEC):
+        self._spill_dir = os.path.join(spill_root, str(os.getpid())) # 다중 프로세스 배포 시 프로세스별 폴더
+        self._idle_sec = idle_sec
+        self._lock = threading.Lock()
+        self._sessions = {} # 세션 id → {"user", "last_seen", "problems", "blobs", "text_bytes", "spilled"}
+        self.spills = 0
+        os.makedirs(self._spill_dir, exist_ok=True)
+        for name in os.listdir(spill_root): # 종료된 프로세스가 남긴 폴더 정리
+            if name.isdigit() and int(name) != os.getpid() and not self._pid_alive(int(name)):
+                shutil.rmtree(os.path.join(spill_root, name), ignore_errors=True)
+        threading.Thread(target=self._run, name="session-heap", daemon=True).start()
+
+    @staticmethod
+    def _pid_alive(pid):
+        try: os.kill(pid, 0)
+        except ProcessLookupError: return False
+        except OSError: pass
+        return True
+
+    def track(self, session_id, user_name, problems, blobs, text_bytes):
+        # 실행 끝마다 호출: 세션이 지금 들고 있는 무거운 객체 목록을 갱신하고 활동 시각을 기록
+        with self._lock:
+            record = self._sessions.get(session_id)
+            for blob in (record["blobs"] if record else []):
+                if all(blob is not b for b in blobs): blob.discard() # 세션에서 빠진 객체의 디스크 사본 정리
+            self._sessions[session_id] = {
+                "user": user_name, "last_seen": time.time(), "problems": [p for p in problems if p is not None],
+                "blobs": [b for b in blobs if b is not None], "text_bytes": text_bytes, "spilled": False,
+            }
+
+    def sweep(self):
+        now = time.time()
+        with self._lock: sessions = list(self._sessions.items())
+        for session_id, record in sessions:
+            if not is_session_alive(session_id):
+                for blob in record["blobs"]: blob.discard()
+                with self._lock:
+                    if self._sessions.get(session_id) is record: del self._sessions[session_id]
+            elif not record["spilled"] and now - record["last_seen"] > self._idle_sec:
+                for i, blob in enumerate(record["blobs"]):
+                    blob.spill(os.path.join(self._spill_dir, f"{session_id}-{i}-{uuid.uuid4().hex[:8]}.bin"))
+                for problem in record["problems"]: problem.release()
+                record["spilled"] = True
+                with self._lock: self.spills += 1
+
+    def report(self):
+        now = time.time()
+        with self._lock: sessions = list(self._sessions.items())
+        rows = []
+        for session_id, record in sessions:
+            seen_problems = {id(p): p for p in record["problems"]}.values() # 같은 이미지를 여러 곳에서 참조해도 한 번만
+            rows.append({
+                "session": session_id[:8], "user": record["user"], "idle_sec": round(now - record["last_seen"]),
+                "compressed_bytes": sum(len(p.data) for p in seen_problems) + sum(b.nbytes for b in record["blobs"] if b.in_memory),
+                "decoded_bytes": sum(p.decoded_nbytes() for p in seen_problems),
+                "spilled_bytes": sum(b.nbytes for b in record["blobs"] if not b.in_memory),
+                "text_bytes": record["text_bytes"],
+            })
+        rows.sort(key=lambda r: -(r["compressed_bytes"] + r["decoded_bytes"] + r["text_bytes"]))
+        totals = {k: sum(r[k] for r in rows) for k in ("compressed_bytes", "decoded_bytes", "spilled_bytes", "text_bytes")}
+        return {"pid": os.getpid(), "rss_bytes": _process_rss_bytes(), "sessions": len(rows), "spills": self.spills, "totals": totals, "by_session": rows}
+
+    def _run(self):
+        while True:
+            time.sleep(SESSION_HEAP_SWEEP_SEC)
+            try:
+                self.sweep()
+                tmp = f"{SESSION_REPORT_FILE}.{os.getpid()}.tmp"
+                with open(tmp, "w", encoding="utf-8") as f: json.dump(self.report(), f, ensure_ascii=False, indent=1)
+                os.replace(tmp, SESSION_REPORT_FILE)
+            except Exception: pass
+
+@st.cache_resource
+def get_session_heap():
+    return SessionHeap()
+
+def track_session_memory():
+    # 실행 끝에서 호출: 이 세션의 이미지(압축 바이트)와 텍스트 크기를 SessionHeap 에 등록
+    if not st.session_state.get('is_logged_in'): return
+    strokes, sent = st.session_state.get('canvas_strokes'), st.session_state.get('canvas_sent')
+    problems = [st.session_state.get('gemini_image')]
+    blobs = [st.session_state.get('solution_image'), (strokes or {}).get("ink"), ((sent or {}).get("canvas") or {}).get("blob")]
+    text_bytes = len(json.dumps([st.session_state.get('analysis_result'), st.session_state.get('chat_messages')], ensure_ascii=False, default=str).encode("utf-8"))
+    get_session_heap().track(current_session_id(), st.session_state.get('user_name'), problems, blobs, text_bytes)
+
 def upload_to_imgbb(image_bytes):
     url = "https://api.imgbb.com/1/upload"
     encoded_image = base64.b64encode(image_bytes).decode("utf-8")
     payload = {"key": IMGBB_API_KEY, "image": encoded_image}
     try:
+        import requests
         response = requests.post(url, data=payload, timeout=15)
         if response.status_code == 200:
             return response.json()['data']['url']
         return None
     except: return None
 
+# 🔥 [성능] 해설 후처리 파이프라인
+# 단계들을 작은 의존성 그래프로 스레드 풀에서 실행합니다. 선행 단계가 모두 끝나면 다음 단계가 시작되고,
+# 선행 단계가 실패하면 그 예외가 후속 단계로 전파됩니다. 반환값: {단계 이름: Future}
+@st.cache_resource
+def get_background_executor():
+    return concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="post-analysis")
+
+def run_stage_graph(executor, stages, inputs=None):
+    # stages: {이름: (함수, [선행 단계 이름, ...])} → 함수는 선행 단계 결과를 순서대로 인자로 받음
+    # inputs: {이름: Future} 그래프 밖에서 채워지는 값 (선행 단계 이름으로 쓸 수 있음, 기다리는 동안 작업자를 잡지 않음)
+    futures = dict(inputs or {})
+    futures.update({name: concurrent.futures.Future() for name in stages})
+    remaining = {name: len(deps) for name, (fn, deps) in stages.items()}
+    lock = threading.Lock()
+
+    def launch(name):
+        fn, deps = stages[name]
+        failed = next((futures[d] for d in deps if futures[d].exception() is not None), None)
+        if failed is not None:
+            futures[name].set_exception(failed.exception())
+            return
+        def body():
+            try: futures[name].set_result(fn(*[futures[d].result() for d in deps]))
+            except BaseException as e: futures[name].set_exception(e)
+        executor.submit(body)
+
+    def on_dependency_done(name):
+        with lock:
+            remaining[name] -= 1
+            ready = remaining[name] == 0
+        if ready: launch(name)
+
+    roots = [name for name, count in remaining.items() if count == 0] # 이미 끝난 입력에 걸린 단계는 콜백이 바로 시작
+    for name, (fn, deps) in stages.items():
+        for dep in deps:
+            futures[dep].add_done_callback(lambda _, name=name: on_dependency_done(name))
+    for name in roots: launch(name)
+    return futures
+
+def encode_jpeg(image, quality=90):
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, format='JPEG', quality=quality)
+    return img_byte_arr.getvalue()
+
+@st.cache_resource
+def start_solution_image_prefetch():
+    # 로그인 후 한 번: 렌더러 모듈(matplotlib)과 손글씨 폰트를 백그라운드에서 미리 준비
+    def prefetch():
+        try:
+            import solution_image
+            solution_image.prefetch()
+        except Exception: pass
+    worker = threading.Thread(target=prefetch, name="solution-image-prefetch", daemon=True)
+    worker.start()
+    return worker
+
+def start_post_analysis_pipeline(problem, hints, student_name, saved_ts):
+    # 렌더링 → JPEG 인코딩 → imgbb 업로드 → 저장된 기록의 링크 갱신 (Outbox)
+    # saved_ts 는 Future 일 수 있음: 해설 스트리밍 중(저장 전)에 시작하면 링크 단계는 업로드와 저장이 모두 끝난 뒤에 시작
+    # (저장 시각을 기다리며 백그라운드 작업자를 붙잡지 않도록 그래프의 입력으로 연결)
+    # 화면에는 encode 단계의 JPEG 바이트를 그대로 씀 (세션에 렌더링된 PIL 이미지를 두지 않음)
+    outbox = get_sheet_outbox()
+
+    def render():
+        from solution_image import create_solution_image
+        return create_solution_image(problem.image, hints, engine=SOLUTION_IMAGE_ENGINE)
+
+    def update_link(link, ts):
+        if outbox and ts and link != "이미지_없음":
+            outbox.update((ts, student_name), cells={str(RESULTS_COL_LINK): link})
+        return link
+
+    saved = saved_ts
+    if not isinstance(saved, concurrent.futures.Future):
+        saved = concurrent.futures.Future()
+        saved.set_result(saved_ts)
+
+    return run_stage_graph(get_background_executor(), {
+        "render": (render, []),
+        "encode": (encode_jpeg, ["render"]),
+        "upload": (lambda image_bytes: upload_to_imgbb(image_bytes) or "이미지_없음", ["encode"]),
+        "link": (update_link, ["upload", "saved"]),
+    }, inputs={"saved": saved})
+
 def save_result_to_sheet(student_name, subject, unit, summary, link, chat_log):
-    client = get_sheet_client()
-    if not client: return None
+    outbox = get_sheet_outbox()
+    if not outbox: return None
     try:
-        sheet = client.open_by_key(SHEET_ID).worksheet("results")
         kst = datetime.timezone(datetime.timedelta(hours=9))
         now = datetime.datetime.now(kst).strftime("%Y-%m-%d %H:%M:%S")
         
         try:
             data = summary.copy() 
             data['chat_history'] = chat_log
-            final_content = str(data) 
+            outbox.append([now, student_name, subject, unit, "", link, "", 0], content=data)
         except:
-            final_content = str(summary)
+            outbox.append([now, student_name, subject, unit, str(summary), link, "", 0])
 
-        sheet.append_row([now, student_name, subject, unit, final_content, link, "", 0])
         st.toast("✅ 학습 기록 저장 완료!", icon="💾")
         return now 
     except: return None
 
-def overwrite_result_in_sheet(student_name, target_time, new_summary):
-    client = get_sheet_client()
-    if not client: return False
+def _update_result_row(student_name, target_time, content=None, cells=None, review=0):
+    # 로컬 Outbox 에 커밋되면 성공으로 보고, 실제 시트 반영은 백그라운드 워커가 합니다.
+    outbox = get_sheet_outbox()
+    if not outbox: return False
     try:
-        sheet = client.open_by_key(SHEET_ID).worksheet("results")
-        records = sheet.get_all_records()
-        row_idx = -1
-        
-        for i, record in enumerate(records):
-            if str(record.get('날짜')) == str(target_time) and str(record.get('이름')) == str(student_name):
-                row_idx = i + 2
-                current_content_str = record.get('내용')
-                break
-        
-        if row_idx != -1:
-            try:
-                data = ast.literal_eval(current_content_str)
-                data.update(new_summary) # 병합 (Append)
-                updated_content = str(data)
-                sheet.update_cell(row_idx, 5, updated_content)
-                return True
-            except: return False
-        return False
+        outbox.update((target_time, student_name), content=content, cells=cells, review=review)
+        return True
     except: return False
 
+def overwrite_result_in_sheet(student_name, target_time, new_summary):
+    return _update_result_row(student_name, target_time, content=dict(new_summary)) # 병합 (Append)
+
 def update_chat_log_in_sheet(student_name, target_time, new_chat_log):
-    client = get_sheet_client()
-    if not client: return False
-    try:
-        sheet = client.open_by_key(SHEET_ID).worksheet("results")
-        records = sheet.get_all_records()
-        row_idx = -1
-        
-        for i, record in enumerate(records):
-            if str(record.get('날짜')) == str(target_time) and str(record.get('이름')) == str(student_name):
-                row_idx = i + 2
-                current_content_str = record.get('내용')
-                break
-        
-        if row_idx != -1:
-            try:
-                data = ast.literal_eval(current_content_str)
-                data['chat_history'] = new_chat_log
-                updated_content = str(data)
-                sheet.update_cell(row_idx, 5, updated_content)
-                return True
-            except: return False
-        return False
-    except: return False
+    return _update_result_row(student_name, target_time, content={'chat_history': new_chat_log})
 
 def update_twin_data_in_sheet(student_name, target_time, twin_data):
-    client = get_sheet_client()
-    if not client: return False
-    try:
-        sheet = client.open_by_key(SHEET_ID).worksheet("results")
-        records = sheet.get_all_records()
-        row_idx = -1
-        
-        for i, record in enumerate(records):
-            if str(record.get('날짜')) == str(target_time) and str(record.get('이름')) == str(student_name):
-                row_idx = i + 2
-                current_content_str = record.get('내용')
-                break
-        
-        if row_idx != -1:
-            try:
-                data = ast.literal_eval(current_content_str)
-                data['twin_problem'] = twin_data.get('twin_problem')
-                data['twin_answer'] = twin_data.get('twin_answer')
-                updated_content = str(data)
-                sheet.update_cell(row_idx, 5, updated_content)
-                return True
-            except: return False
-        return False
-    except: return False
+    return _update_result_row(student_name, target_time, content={
+        'twin_problem': twin_data.get('twin_problem'),
+        'twin_answer': twin_data.get('twin_answer')
+    })
 
 def increment_review_count(row_date, student_name):
-    client = get_sheet_client()
-    if not client: return False
-    try:
-        sheet = client.open_by_key(SHEET_ID).worksheet("results")
-        records = sheet.get_all_records()
-        row_idx = -1
-        current_count = 0
-        for i, record in enumerate(records):
-            if str(record.get('날짜')) == str(row_date) and str(record.get('이름')) == str(student_name):
-                row_idx = i + 2
-                current_count = record.get('복습횟수')
-                if current_count == '' or current_count is None: current_count = 0
-                break
-        if row_idx != -1:
-            sheet.update_cell(row_idx, 8, int(current_count) + 1)
-            return True
-        return False
-    except: return False
+    return _update_result_row(student_name, row_date, review=1)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _load_user_results_cached(user_name, version):
+    import pandas as pd
+    store = get_results_store()
+    if not store: return pd.DataFrame()
+    try: return pd.DataFrame(store.read_student_rows(user_name, columns=RESULTS_LIST_COLUMNS))
+    except: return pd.DataFrame()
 
 def load_user_results(user_name):
-    client = get_sheet_client()
-    if not client: return pd.DataFrame()
-    try:
-        sheet = client.open_by_key(SHEET_ID).worksheet("results")
-        return pd.DataFrame(sheet.get_all_records())
-    except: return pd.DataFrame()
+    # 🔥 [성능] 학생 본인의 행만, 목록 헤더에 필요한 열만 읽고 학생별 버전이 바뀔 때까지 캐시 재사용
+    store = get_results_store()
+    if not store:
+        import pandas as pd
+        return pd.DataFrame()
+    return _load_user_results_cached(user_name, store.student_version(user_name))
+
+@st.cache_data(ttl=600, show_spinner=False)
+def _load_result_content_cached(row_date, user_name, version):
+    store = get_results_store()
+    if not store: return None, None
+    try: raw_content = store.read_content(row_date, user_name)
+    except: return None, None
+    try: return raw_content, decode_result_content(raw_content)
+    except: return raw_content, None
+
+def load_result_content(row_date, user_name):
+    # 🔥 [성능] 펼친 항목의 내용 셀만 가져와 파싱하고, 결과를 캐시합니다.
+    store = get_results_store()
+    if not store: return None, None
+    return _load_result_content_cached(str(row_date), user_name, store.student_version(user_name))
+
+# 🔥 [확장] 다중 프로세스 배포 모드 (선택: secrets SHARED_STATE)
+# 여러 Streamlit 워커 프로세스를 로드밸런서 뒤에 둘 때 학생의 작업이 한 프로세스 메모리에만 있지 않도록,
+# 세션 핵심 상태(해설 결과, 채팅, 저장 시각, Self-Note, 문제 이미지 참조)를 SQLite(WAL) 공유 저장소에 둡니다.
+# 브라우저에는 세션 id 쿠키만 두고, 다른 프로세스로 연결되거나 워커가 재시작되면 그 쿠키로 상태를 복원합니다.
+# 상태는 탭마다 따로 저장합니다(쿠키 + 주소의 ?tab= id). 새 탭은 같은 브라우저의 가장 최근 탭 상태로 시작하지만 자기 키로 저장하므로
+# 여러 탭이 서로의 상태를 덮어쓰지 않습니다. 학생별 오답노트 버전(목록 캐시 무효화 키)도 이 저장소에 두어 프로세스 간에 맞춥니다.
+# 학생 명단(students 시트) 스냅샷도 같은 저장소에 두어 프로세스마다 시트를 따로 읽지 않습니다.
+# (응답 캐시와 시트 Outbox 는 원래 SQLite 파일이라 프로세스 간에 이미 공유됩니다.)
+SHARED_STATE_PATH = "mathai_state.db"
+SHARED_SESSION_COOKIE = "mathai_session"
+SHARED_TAB_PARAM = "tab"
+SHARED_SESSION_TTL_SEC = 7 * 24 * 3600 # 로그인 쿠키와 같은 기간
+SHARED_CLEANUP_INTERVAL_SEC = 3600
+SHARED_SESSION_KEYS = [
+    'analysis_result', 'chat_active', 'chat_messages', 'self_note', 'selected_subject',
+    'saved_timestamp', 'last_saved_chat_len', 'enable_canvas',
+]
 
-@st.cache_data(ttl=600)
-def load_students_from_sheet():
+class SharedStateStore:
+    def __init__(self, path=SHARED_STATE_PATH):
+        self._path = path
+        self._cleaned_at = 0.0
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    id TEXT PRIMARY KEY,
+                    user_name TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    image_digest TEXT,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS images (
+                    digest TEXT PRIMARY KEY,
+                    data BLOB NOT NULL,
+                    mime_type TEXT NOT NULL,
+                    dhash TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE TABLE IF NOT EXISTS tables (name TEXT PRIMARY KEY, value TEXT NOT NULL, fetched_at REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS versions (name TEXT PRIMARY KEY, version INTEGER NOT NULL)")
+        finally: conn.close()
+        self._cleanup()
+
+    def _connect(self):
+        conn = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def _cleanup(self):
+        # 만료된 세션과, 어느 세션도 참조하지 않는 문제 이미지 정리 (프로세스마다 최대 시간당 한 번)
+        now = time.time()
+        if now - self._cleaned_at < SHARED_CLEANUP_INTERVAL_SEC: return
+        self._cleaned_at = now
+        conn = self._connect()
+        try:
+            conn.execute("DELETE FROM sessions WHERE updated_at <= ?", (now - SHARED_SESSION_TTL_SEC,))
+            conn.execute("DELETE FROM images WHERE digest NOT IN (SELECT image_digest FROM sessions WHERE image_digest IS NOT NULL)")
+        finally: conn.close()
+
+    def save_session(self, session_id, user_name, state, image=None):
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            if image is not None:
+                conn.execute(
+                    "INSERT OR IGNORE INTO images (digest, data, mime_type, dhash, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (image.digest, image.data, image.mime_type, image.dhash, time.time())
+                )
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (id, user_name, state, image_digest, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (session_id, user_name, json.dumps(state, ensure_ascii=False, default=str), image.digest if image else None, time.time())
+            )
+            conn.execute("COMMIT")
+        finally: conn.close()
+        self._cleanup()
+
+    def load_session(self, session_id, user_name, browser_id=None):
+        # → (상태 dict, ProblemImage 또는 None) / 없거나 다른 학생의 세션이면 None
+        # browser_id: session_id("브라우저/탭") 행이 없으면 같은 브라우저의 가장 최근 탭(또는 탭 구분 전의 행) 상태로
+        browser_id = browser_id or session_id
+        conn = self._connect()
+        try:
+            row = conn.execute("""
+                SELECT s.state, i.data, i.mime_type, i.dhash FROM sessions s
+                LEFT JOIN images i ON i.digest = s.image_digest
+                WHERE (s.id = ? OR s.id = ? OR s.id LIKE ?) AND s.user_name = ? AND s.updated_at > ?
+                ORDER BY s.id = ? DESC, s.updated_at DESC LIMIT 1
+            """, (session_id, browser_id, f"{browser_id}/%", user_name, time.time() - SHARED_SESSION_TTL_SEC, session_id)).fetchone()
+        finally: conn.close()
+        if not row: return None
+        state, data, mime_type, dhash = row
+        image = None
+        if data: image = ProblemImage(None, bytes(data), mime_type, dhash) # 픽셀은 필요할 때 디코드
+        return json.loads(state), image
+
+    def delete_browser_sessions(self, browser_id):
+        # 로그아웃: 그 브라우저의 모든 탭 상태
+        conn = self._connect()
+        try: conn.execute("DELETE FROM sessions WHERE id = ? OR id LIKE ?", (browser_id, f"{browser_id}/%"))
+        finally: conn.close()
+
+    def bump_version(self, name):
+        conn = self._connect()
+        try: conn.execute("INSERT INTO versions (name, version) VALUES (?, 1) ON CONFLICT(name) DO UPDATE SET version = version + 1", (str(name),))
+        finally: conn.close()
+
+    def version(self, name):
+        conn = self._connect()
+        try: row = conn.execute("SELECT version FROM versions WHERE name = ?", (str(name),)).fetchone()
+        finally: conn.close()
+        return row[0] if row else 0
+
+    def get_table(self, name, max_age):
+        # 공유 스냅샷 (값, 읽은 시각) / max_age 보다 오래됐으면 None
+        conn = self._connect()
+        try: row = conn.execute("SELECT value, fetched_at FROM tables WHERE name = ? AND fetched_at > ?", (name, time.time() - max_age)).fetchone()
+        finally: conn.close()
+        return (json.loads(row[0]), row[1]) if row else None
+
+    def put_table(self, name, value):
+        conn = self._connect()
+        try: conn.execute("INSERT OR REPLACE INTO tables (name, value, fetched_at) VALUES (?, ?, ?)", (name, json.dumps(value, ensure_ascii=False), time.time()))
+        finally: conn.close()
+
+@st.cache_resource
+def get_shared_state():
+    return SharedStateStore() if SHARED_STATE else None
+
+# 🔥 [성능] 학생 로그인 인덱스 (프로세스 공용)
+# students 시트를 아이디 → (비밀번호, 이름) 해시 인덱스로 만들어 두고, 로그인/쿠키 확인은 조회 한 번으로 끝냅니다.
+# TTL 마다 시트를 다시 읽되 내용 해시가 같으면 인덱스를 그대로 쓰고, 없는 아이디는 방금 등록된 학생일 수 있으니
+# 마지막으로 읽은 지 조금 지났다면 한 번 더 읽어 봅니다. 공유 저장소가 있으면 다른 프로세스가 읽어 둔 스냅샷을 먼저 씁니다.
+STUDENT_INDEX_TTL_SEC = 600
+STUDENT_INDEX_MISS_REFRESH_SEC = 30
+
+def normalize_student_pw(pw):
+    return str(pw).split('.')[0] # 시트에서 숫자 비밀번호가 "1234.0" 으로 읽히는 경우
+
+class StudentIndex:
+    def __init__(self, client, shared=None):
+        self._client = client
+        self._shared = shared
+        self._lock = threading.Lock()
+        self._index = {}
+        self._digest = None
+        self._loaded_at = 0.0
+
+    def _refresh(self, max_age):
+        # 호출 측에서 self._lock 보유
+        snapshot = self._shared.get_table("students", max_age) if self._shared else None
+        if snapshot:
+            values, self._loaded_at = snapshot
+        else:
+            values = self._client.open_by_key(SHEET_ID).worksheet("students").get_all_values()
+            self._loaded_at = time.time()
+            if self._shared: self._shared.put_table("students", values)
+        digest = hashlib.blake2b(json.dumps(values, ensure_ascii=False).encode("utf-8"), digest_size=16).hexdigest()
+        if digest == self._digest: return
+        index = {}
+        if values:
+            headers = values[0]
+            col = {name: headers.index(name) for name in ("id", "pw", "name") if name in headers}
+            if len(col) == 3:
+                for row in values[1:]:
+                    row = row + [""] * (len(headers) - len(row))
+                    index[str(row[col["id"]])] = (normalize_student_pw(row[col["pw"]]), row[col["name"]])
+        self._index, self._digest = index, digest
+
+    def lookup(self, student_id):
+        # → (비밀번호, 이름) 또는 None. 시트를 한 번도 읽지 못했으면 예외
+        student_id = str(student_id)
+        with self._lock:
+            if time.time() - self._loaded_at > STUDENT_INDEX_TTL_SEC or self._digest is None:
+                self._refresh(STUDENT_INDEX_TTL_SEC)
+            student = self._index.get(student_id)
+            if student is None and time.time() - self._loaded_at > STUDENT_INDEX_MISS_REFRESH_SEC:
+                self._refresh(STUDENT_INDEX_MISS_REFRESH_SEC)
+                student = self._index.get(student_id)
+            return student
+
+@st.cache_resource
+def get_student_index():
     client = get_sheet_client()
     if not client: return None
-    try:
-        sheet = client.open_by_key(SHEET_ID).worksheet("students")
-        all_data = sheet.get_all_values()
-        if not all_data: return None
-        headers = all_data.pop(0) 
-        return pd.DataFrame(all_data, columns=headers)
-    except: return None
+    return StudentIndex(client, get_shared_state())
+
+def find_student(student_id):
+    # → (비밀번호, 이름) / None(없는 아이디) / False(시트 연결 실패)
+    index = get_student_index()
+    if not index: return False
+    try: return index.lookup(student_id)
+    except Exception: return False
+
+# 🔥 [안정성] API 키 × 모델 상태 기반 스케줄러 (프로세스 공용)
+# (키, 모델) 쌍마다 성공률, 지연(전체/첫 토큰) 백분위, 쿼터 쿨다운, 서킷 브레이커 상태를 기록하고
+# 가장 건강한 쌍부터 시도합니다. 전역 genai.configure 대신 키별 클라이언트를 모델에 붙여서
+# 여러 Streamlit 세션이 동시에 호출해도 서로의 키를 덮어쓰지 않습니다.
+SCHED_RATE_LIMIT_COOLDOWN_SEC = 60
+SCHED_DAILY_QUOTA_COOLDOWN_SEC = 3600
+SCHED_BAD_KEY_COOLDOWN_SEC = 3600
+SCHED_MODEL_MISSING_COOLDOWN_SEC = 3600
+SCHED_CIRCUIT_THRESHOLD = 3
+SCHED_CIRCUIT_BASE_SEC = 30
+SCHED_CIRCUIT_MAX_SEC = 600
+SCHED_LATENCY_WINDOW = 50
+
+def _percentile(values, q):
+    if not values: return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class KeyModelScheduler:
+    def __init__(self, keys):
+        self._keys = keys
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._async_clients = {}
+        self._key_blocked_until = {}
+        self._model_blocked_until = {}
+
+    def _stat(self, key_idx, model_name):
+        stat = self._stats.get((key_idx, model_name))
+        if stat is None:
+            stat = self._stats[(key_idx, model_name)] = {
+                "success": 0, "failure": 0, "consecutive_failures": 0, "trips": 0,
+                "latency": collections.deque(maxlen=SCHED_LATENCY_WINDOW),
+                "ttft": collections.deque(maxlen=SCHED_LATENCY_WINDOW),
+                "blocked_until": 0.0, "last_error": None,
+            }
+        return stat
+
+    def _available_at(self, key_idx, model_name):
+        return max(
+            self._stat(key_idx, model_name)["blocked_until"],
+            self._key_blocked_until.get(key_idx, 0.0),
+            self._model_blocked_until.get(model_name, 0.0),
+        )
+
+    def _score(self, key_idx, model_name, preference):
+        stat = self._stat(key_idx, model_name)
+        success_rate = (stat["success"] + 1) / (stat["success"] + stat["failure"] + 2) # 라플라스 보정
+        p50 = _percentile(stat["latency"], 0.5) or 5.0
+        # 같은 점수대에서는 키를 고르게 쓰도록 약간의 무작위성을 섞습니다.
+        return success_rate * preference / (1.0 + p50 / 10.0) + random.random() * 0.02
+
+    def plan(self, mode):
+        models = PRO_MODELS if mode == "pro" else FLASH_MODELS
+        now = time.time()
+        with self._lock:
+            ready, waiting = [], []
+            for rank, model_name in enumerate(models):
+                preference = 1.0 - 0.1 * rank # 모델 라인업 순서 = 선호도
+                for key_idx in range(len(self._keys)):
+                    available_at = self._available_at(key_idx, model_name)
+                    if available_at <= now:
+                        ready.append((self._score(key_idx, model_name, preference), key_idx, model_name))
+                    else:
+                        waiting.append((available_at, key_idx, model_name))
+        ready.sort(reverse=True)
+        waiting.sort()
+        # 모두 쿨다운 중이면 가장 먼저 풀리는 쌍부터라도 시도
+        return [(k, m) for _, k, m in ready] + [(k, m) for _, k, m in waiting]
+
+    def api_key(self, key_idx):
+        return self._keys[key_idx]
+
+    def async_model_for(self, key_idx, model_name):
+        # 비동기 호출 계층의 이벤트 루프 안에서만 호출 (grpc.aio 채널은 만든 루프에 묶임)
+        client = self._async_clients.get(key_idx)
+        if client is None:
+            from google.ai import generativelanguage as glm
+            client = self._async_clients[key_idx] = glm.GenerativeServiceAsyncClient(client_options={"api_key": self.api_key(key_idx)})
+        import google.generativeai as genai
+        model = genai.GenerativeModel(model_name)
+        model._async_client = client # 전역 genai.configure 를 쓰지 않고 키별 클라이언트 사용
+        return model
+
+    def record_success(self, key_idx, model_name, latency, ttft):
+        with self._lock:
+            stat = self._stat(key_idx, model_name)
+            stat["success"] += 1
+            stat["consecutive_failures"] = 0
+            stat["trips"] = 0
+            stat["blocked_until"] = 0.0
+            stat["latency"].append(latency)
+            stat["ttft"].append(ttft)
+
+    def record_failure(self, key_idx, model_name, error):
+        from google.api_core import exceptions as google_exceptions
+        now = time.time()
+        message = str(error).lower()
+        with self._lock:
+            stat = self._stat(key_idx, model_name)
+            stat["failure"] += 1
+            stat["consecutive_failures"] += 1
+            stat["last_error"] = f"{type(error).__name__}: {error}"[:300]
+            if isinstance(error, google_exceptions.ResourceExhausted):
+                # 429: 일일 쿼터 소진이면 길게, 분당 한도면 서버가 알려준 재시도 시간(없으면 기본값)만큼 쉼
+                if "per day" in message or "perday" in message:
+                    cooldown = SCHED_DAILY_QUOTA_COOLDOWN_SEC
+                else:
+                    retry = re.search(r'retry[^0-9]{0,40}?(\d+(?:\.\d+)?)\s*s', message)
+                    cooldown = float(retry.group(1)) if retry else SCHED_RATE_LIMIT_COOLDOWN_SEC
+                stat["blocked_until"] = max(stat["blocked_until"], now + cooldown)
+            elif isinstance(error, (google_exceptions.PermissionDenied, google_exceptions.Unauthenticated)) or "api_key_invalid" in message:
+                self._key_blocked_until[key_idx] = now + SCHED_BAD_KEY_COOLDOWN_SEC
+            elif isinstance(error, google_exceptions.NotFound):
+                self._model_blocked_until[model_name] = now + SCHED_MODEL_MISSING_COOLDOWN_SEC
+            elif stat["consecutive_failures"] >= SCHED_CIRCUIT_THRESHOLD:
+                # 서킷 열기: 열릴 때마다 차단 시간을 두 배로 (반열림 상태에서 다시 실패하면 더 오래 쉼)
+                stat["trips"] += 1
+                stat["blocked_until"] = now + min(SCHED_CIRCUIT_MAX_SEC, SCHED_CIRCUIT_BASE_SEC * 2 ** (stat["trips"] - 1))
+
+    def latency_percentiles(self, key_idx, model_name):
+        with self._lock:
+            stat = self._stat(key_idx, model_name)
+            return {
+                "p50": _percentile(stat["latency"], 0.5), "p95": _percentile(stat["latency"], 0.95),
+                "ttft_p50": _percentile(stat["ttft"], 0.5), "ttft_p95": _percentile(stat["ttft"], 0.95),
+            }
+
+    def hedge_delay(self, key_idx, model_name):
+        # 첫 토큰 대기 마감: 이 쌍의 첫 토큰 p95 × 1.2 (기록이 없으면 기본값), 상·하한 적용
+        ttft_p95 = self.latency_percentiles(key_idx, model_name)["ttft_p95"]
+        delay = ttft_p95 * 1.2 if ttft_p95 else HEDGE_DEFAULT_DELAY_SEC
+        return min(HEDGE_MAX_DELAY_SEC, max(HEDGE_MIN_DELAY_SEC, delay))
+
+    def try_acquire_hedge(self):
+        # 프로세스 전체 헤지 예산 (분당 토큰 버킷) → 쿼터를 과하게 태우지 않도록 제한
+        now = time.time()
+        with self._lock:
+            tokens, updated = getattr(self, "_hedge_bucket", (HEDGE_BUDGET_PER_MIN, now))
+            tokens = min(HEDGE_BUDGET_PER_MIN, tokens + (now - updated) * HEDGE_BUDGET_PER_MIN / 60.0)
+            if tokens < 1:
+                self._hedge_bucket = (tokens, now)
+                return False
+            self._hedge_bucket = (tokens - 1, now)
+            return True
 
-def clean_text_for_plot_safe(text):
-    if not text: return ""
-    text = text.replace(r'\iff', '⇔').replace(r'\implies', '⇒')
-    return text
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            rows = []
+            for (key_idx, model_name), stat in self._stats.items():
+                total = stat["success"] + stat["failure"]
+                rows.append({
+                    "key": f"#{key_idx}", "model": model_name, "success": stat["success"], "failure": stat["failure"],
+                    "success_rate": stat["success"] / total if total else None,
+                    "p50": _percentile(stat["latency"], 0.5), "p95": _percentile(stat["latency"], 0.95),
+                    "blocked_sec": max(0.0, self._available_at(key_idx, model_name) - now),
+                    "last_error": stat["last_error"],
+                })
+            return rows
 
-def text_for_plot_fallback(text):
-    if not text: return ""
-    return re.sub(r'[\$\\\{\}]', '', text)
-
-def create_solution_image(original_image, hints):
-    font_prop = get_handwriting_font_prop()
-    w, h = original_image.size
-    aspect = h / w
-    note_height_ratio = 0.5 
-    fig_width = 10
-    fig_height = fig_width * (aspect + note_height_ratio)
-    
-    fig = plt.figure(figsize=(fig_width, fig_height))
-    gs = fig.add_gridspec(2, 1, height_ratios=[aspect, note_height_ratio], hspace=0)
-    
-    ax_img = fig.add_subplot(gs[0])
-    ax_img.imshow(original_image)
-    ax_img.axis('off')
-    
-    ax_note = fig.add_subplot(gs[1])
-    ax_note.axis('off')
-    ax_note.set_facecolor('#FFFACD') 
-    rect = patches.Rectangle((0,0), 1, 1, transform=ax_note.transAxes, color='#FFFACD', zorder=0)
-    ax_note.add_patch(rect)
-    ax_note.plot([0, 1], [1, 1], transform=ax_note.transAxes, color='gray', linestyle='--', linewidth=1)
+@st.cache_resource
+def get_key_scheduler():
+    return KeyModelScheduler(API_KEYS)
+
+# 🔥 [성능] 문제 이미지 업로드 핸들
+# 같은 문제 이미지를 채팅 턴/해설/Pro 호출마다 다시 보내지 않도록 (이미지, API 키)당 한 번 File API 로 올리고
+# 이후 호출에서는 파일 URI 만 참조합니다. 업로드된 파일은 키(프로젝트)에 묶이므로 스케줄러가 다른 키를 고르면
+# 그 키로 새로 올립니다. 만료(File API 48시간) 전에 여유를 두고 다시 올리고, 파일을 찾을 수 없다는 오류가 나면
+# 핸들을 버립니다. 업로드가 실패하면 그 호출은 이미지 바이트를 직접 보냅니다.
+IMAGE_HANDLE_TTL_SEC = 47 * 3600       # 서버가 만료 시각을 주지 않을 때
+IMAGE_HANDLE_EXPIRY_MARGIN_SEC = 3600  # 만료 1시간 전부터는 새로 업로드
+IMAGE_HANDLE_UPLOAD_TIMEOUT_SEC = 20
+
+class GeminiFileBackend:
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def upload(self, api_key, problem):
+        from google.generativeai.client import FileServiceClient
+        with self._lock:
+            client = self._clients.get(api_key)
+            if client is None:
+                client = self._clients[api_key] = FileServiceClient(client_options={"api_key": api_key})
+        file = client.create_file(io.BytesIO(problem.data), mime_type=problem.mime_type, display_name=f"problem-{problem.digest}")
+        if file.state.name == "FAILED": raise RuntimeError(f"file upload failed: {file.name}")
+        expires_at = file.expiration_time.timestamp() if file.expiration_time else 0
+        if expires_at <= time.time(): expires_at = time.time() + IMAGE_HANDLE_TTL_SEC
+        return {"file_data": {"mime_type": problem.mime_type, "file_uri": file.uri}}, expires_at
+
+class LocalImageBackend:
+    # 네트워크 없이 핸들 계층을 시험하기 위한 대역: "업로드"를 기록만 하고 호출에는 이미지 바이트를 그대로 보냄
+    def __init__(self, ttl=IMAGE_HANDLE_TTL_SEC):
+        self.ttl = ttl
+        self.uploads = []
+
+    def upload(self, api_key, problem):
+        self.uploads.append((api_key[-4:], problem.digest))
+        return problem.blob(), time.time() + self.ttl
+
+IMAGE_HANDLE_BACKENDS = {"gemini": GeminiFileBackend, "local": LocalImageBackend}
+
+def is_file_reference_error(error):
+    message = str(error).lower()
+    return "file" in message and any(word in message for word in ("not exist", "not found", "permission", "expired"))
+
+class ImageHandleRegistry:
+    def __init__(self, backend, max_entries=256):
+        self._backend = backend
+        self._handles = LRUCache(maxsize=max_entries) # (이미지 digest, 키 번호) → (part, 만료 시각)
+        self._inflight = {} # (이미지 digest, 키 번호) → (업로드 Future, 시작 시각)
+        self._uploader = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="image-upload")
+        self._lock = threading.Lock()
+        self.uploads = 0
+        self.reuses = 0
+        self.fallbacks = 0
+
+    def part_for(self, image, key_idx, api_key):
+        # Gemini 호출에 넣을 이미지 part. ProblemImage 만 핸들로 바꾸고 나머지(캔버스 합성 등)는 그대로 보냄
+        if not isinstance(image, ProblemImage): return image
+        handle_key = (image.digest, key_idx)
+        with self._lock:
+            cached = self._handles.get(handle_key)
+            if cached and cached[1] - IMAGE_HANDLE_EXPIRY_MARGIN_SEC > time.time():
+                self.reuses += 1
+                return cached[0]
+            inflight = self._inflight.get(handle_key)
+            if inflight is None: # 헤지 시도가 같은 키로 겹쳐도 업로드는 한 번
+                inflight = self._inflight[handle_key] = (self._uploader.submit(self._upload, handle_key, image, api_key), time.monotonic())
+        # 업로드 요청에는 타임아웃이 없으므로(httplib2) 업로드 스레드와 떨어져서 기다림: 먼저 시작된 업로드가 멈춰 있으면
+        # 남은 시간만큼만 (이미 마감을 넘겼으면 바로) 포기하고 이번 호출은 이미지 바이트를 직접 보냄
+        future, started = inflight
+        try: return future.result(timeout=max(0.0, started + IMAGE_HANDLE_UPLOAD_TIMEOUT_SEC - time.monotonic()))
+        except Exception:
+            with self._lock: self.fallbacks += 1
+            return image.blob()
+
+    def _upload(self, handle_key, image, api_key):
+        try:
+            part, expires_at = self._backend.upload(api_key, image)
+            self._handles.put(handle_key, (part, expires_at))
+            with self._lock: self.uploads += 1
+            return part
+        finally:
+            with self._lock: self._inflight.pop(handle_key, None)
 
-    try:
-        safe_hints = clean_text_for_plot_safe(hints)
-        ax_note.text(0.05, 0.88, "💡 1타 강사의 핵심 Point", fontsize=24, color='#FF4500', fontweight='bold', va='top', ha='left', transform=ax_note.transAxes, fontproperties=font_prop)
-        
-        # 힌트 텍스트 줄바꿈 처리
-        lines = safe_hints.split('\n')
-        y_pos = 0.72
-        
-        for line in lines:
-            if not line.strip(): continue
-            
-            # 🔥 [수정 핵심] 글자를 자르는 대신(Truncate), 폭에 맞춰 줄바꿈(Wrap) 합니다.
-            # width=40 은 대략 한 줄에 들어갈 글자 수입니다. (폰트 크기에 따라 조절 가능)
-            wrapped_lines = textwrap.wrap(line.strip(), width=38)
-            
-            for i, w_line in enumerate(wrapped_lines):
-                # 첫 줄엔 bullet point(•), 둘째 줄부터는 들여쓰기
-                prefix = "• " if i == 0 else "  "
-                ax_note.text(0.05, y_pos, f"{prefix}{w_line}", fontsize=21, color='#333333', va='top', ha='left', transform=ax_note.transAxes, fontproperties=font_prop)
-                
-                # 줄 간격 (폰트 크기에 맞춰 넉넉하게)
-                y_pos -= 0.13 
+    def invalidate(self, image, key_idx):
+        if isinstance(image, ProblemImage): self._handles.pop((image.digest, key_idx))
 
-        fig.canvas.draw()
-    except:
-        ax_note.clear()
-        ax_note.axis('off')
-        ax_note.add_patch(rect)
-        fallback_hints = text_for_plot_fallback(hints)
-        ax_note.text(0.05, 0.85, "💡 1타 강사의 핵심 Point", fontsize=24, color='#FF4500', fontweight='bold', va='top', ha='left', transform=ax_note.transAxes, fontproperties=font_prop)
-        
-        # 예외 발생 시에도 줄바꿈 적용
-        ax_note.text(0.05, 0.65, fallback_hints, fontsize=21, color='#333333', va='top', ha='left', transform=ax_note.transAxes, wrap=True, fontproperties=font_prop, linespacing=2.0)
+    def stats(self):
+        with self._lock:
+            return {"handles": len(self._handles), "uploads": self.uploads, "reuses": self.reuses, "fallbacks": self.fallbacks}
 
-    buf = io.BytesIO()
-    plt.savefig(buf, format='jpg', bbox_inches='tight', pad_inches=0)
-    buf.seek(0)
-    plt.close(fig)
-    return Image.open(buf)
+@st.cache_resource
+def get_image_handles():
+    return ImageHandleRegistry(IMAGE_HANDLE_BACKENDS.get(IMAGE_HANDLE_BACKEND, GeminiFileBackend)())
+
+# 🔥 [안정성] 비동기 호출 계층 (asyncio)
+# 모든 Gemini 스트림 호출은 프로세스 공용 이벤트 루프 스레드 하나에서 돌아가고, 시도마다 마감 세 개를 둡니다.
+#   연결 = 입장한 뒤 스트림이 열릴 때까지 / 첫 토큰 = 시작부터 첫 조각까지 / 전체 = 시작부터 마지막 조각까지
+# 마감을 넘긴 시도는 끊고 실패로 기록해서(서킷 브레이커) 다음 키/모델로 넘어가므로, 멈춘 호출이 스크립트 스레드를 붙잡지 않습니다.
+#
+# 🔥 [안정성] 입장 제어 + 공정 대기열
+# 수업 중 여러 학생이 한꺼번에 요청해도 세션마다 모든 키를 두드려 429 가 연쇄로 터지지 않도록, 모든 시도는 대기열을 거쳐 입장합니다.
+# 입장 조건: (1) 동시 스트림 수 < LLM_MAX_CONCURRENT_CALLS (2) 그 키의 최근 60초 요청 수·토큰 수가 LLM_KEY_RPM / LLM_KEY_TPM 미만
+# 대기 순서: (우선순위, 그 학생이 지금 쓰는 스트림 수, 호출 도착 순) → 채팅 턴이 해설·Pro 분석보다 먼저, 한 학생이 여러 호출을 걸어도
+# 다른 학생이 먼저 한 자리씩 받습니다. 앞 순서의 키가 한도에 걸려 있으면 다른 키를 기다리는 뒤 순서부터 들여보냅니다.
+# 입장 토큰은 어림값으로 잡고 스트림이 끝나면 실제 사용량으로 정산합니다. 대기 순번은 호출한 화면에 ("queue", 순번) 이벤트로 알립니다.
+# 한도는 프로세스 단위이므로 여러 프로세스로 배포하면 secrets 의 LLM_KEY_RPM / LLM_KEY_TPM 을 프로세스 수로 나눈 값으로 설정하세요.
+LLM_QUEUE_TIMEOUT_SEC = 120
+LLM_CONNECT_TIMEOUT_SEC = 15
+LLM_FIRST_TOKEN_TIMEOUT_SEC = 60 # Pro 모델은 첫 토큰 전 생각 시간이 길어 넉넉히
+LLM_TOTAL_TIMEOUT_SEC = 300
+LLM_MAX_CONCURRENT_CALLS = 16
+LLM_RATE_WINDOW_SEC = 60
+LLM_IMAGE_TOKENS = 258           # 이미지 한 장의 입력 토큰 어림값
+LLM_OUTPUT_TOKEN_ESTIMATE = 1500 # 입장할 때 잡아 두는 출력 토큰 (끝나면 실제 사용량으로 정산)
+
+LLM_PRIORITY_CHAT = 0
+LLM_PRIORITY_ANALYSIS = 1
+LLM_PRIORITY_PRO = 2
+LLM_PRIORITY_BACKGROUND = 3 # 선행 생성, 대화 요약
+
+class LLMDeadlineExceeded(TimeoutError):
+    def __init__(self, phase, seconds):
+        super().__init__(f"{phase} 마감({seconds:.0f}초) 초과")
+        self.phase = phase
+
+def make_call_ticket(prompt, image=None, mode="flash", priority=None, session=None, on_position=None):
+    # 호출 하나의 입장 정보 (헤지·재시도로 시도가 여러 번이어도 같은 표로 줄을 섭니다)
+    images = 0 if image is None else len(image) if isinstance(image, (list, tuple)) else 1
+    if priority is None: priority = LLM_PRIORITY_PRO if mode == "pro" else LLM_PRIORITY_ANALYSIS
+    return {
+        "priority": priority, "session": session, "on_position": on_position, "position": None, "seq": None, "active": 0,
+        "tokens": estimate_tokens(prompt) + images * LLM_IMAGE_TOKENS + LLM_OUTPUT_TOKEN_ESTIMATE,
+    }
+
+class AsyncCallLayer:
+    def __init__(self, max_concurrent=LLM_MAX_CONCURRENT_CALLS, rpm=None, tpm=None):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="llm-event-loop", daemon=True).start()
+        self.max_concurrent = max_concurrent
+        self.rpm = rpm or LLM_KEY_RPM
+        self.tpm = tpm or LLM_KEY_TPM
+        # 아래 상태는 이벤트 루프 스레드에서만 바뀝니다.
+        self._waiters = []
+        self._usage = collections.defaultdict(collections.deque) # 키 → 최근 입장 기록 [시각, 토큰] (정산 때 토큰을 고침)
+        self._sessions = collections.Counter()                     # 학생(세션) → 진행 중 스트림 수
+        self._next_seq = 0
+        self._wakeup = None
+        self.in_flight = 0
+        self.peak = 0
+        self.admitted = 0
+        self.queued = 0
+        self.cancelled = 0
+        self.timeouts = collections.Counter()
+
+    def submit(self, coro):
+        # 빈 컨텍스트에서 예약: 스크립트 스레드의 contextvars(Streamlit 의 현재 컨테이너 등)가 루프 작업으로 넘어가면
+        # 루프에서 부르는 @st.cache_resource 의 스피너가 그 컨테이너(예: chat_message)에 그리려다 NoSessionContext 로 실패합니다.
+        return contextvars.Context().run(asyncio.run_coroutine_threadsafe, coro, self.loop)
+
+    def _window(self, key_idx, now):
+        usage = self._usage[key_idx]
+        while usage and usage[0][0] <= now - LLM_RATE_WINDOW_SEC: usage.popleft()
+        return usage
+
+    def key_free_at(self, key_idx, tokens, now):
+        # 이 키로 tokens 만큼 입장할 수 있는 가장 이른 루프 시각 (한도보다 큰 요청은 창이 비면 혼자 입장)
+        usage = self._window(key_idx, now)
+        count, total = len(usage), sum(used for _, used in usage)
+        if count < self.rpm and total + tokens <= self.tpm: return now
+        for at, used in usage: # 오래된 기록부터 창 밖으로 빠질 때마다 다시 확인
+            count, total = count - 1, total - used
+            if count < self.rpm and total + tokens <= self.tpm: return at + LLM_RATE_WINDOW_SEC
+        return usage[-1][0] + LLM_RATE_WINDOW_SEC if usage else now
+
+    def route(self, pairs, tokens):
+        # 시도할 (키, 모델) 고르기: 지금 들어갈 수 있는 키 → 대기 중인 시도가 적은 키 → 스케줄러 순서
+        now = self.loop.time()
+        queued = collections.Counter(w["key_idx"] for w in self._waiters)
+        return min(pairs, key=lambda p: (self.key_free_at(p[0], tokens, now), queued[p[0]]))
+
+    def _dispatch(self):
+        # 대기열을 공정 순서로 훑어 들어갈 수 있는 시도를 입장시키고, 남은 호출에는 대기 순번을 알림
+        if self._wakeup: self._wakeup.cancel()
+        self._wakeup = None
+        now = self.loop.time()
+        waiting, retry_at = [], None
+        for waiter in sorted(self._waiters, key=lambda w: (w["ticket"]["priority"], self._sessions[w["ticket"]["session"]], w["ticket"]["seq"])):
+            free_at = self.key_free_at(waiter["key_idx"], waiter["ticket"]["tokens"], now)
+            if self.in_flight < self.max_concurrent and free_at <= now:
+                self._admit(waiter, now)
+                continue
+            waiting.append(waiter)
+            if free_at > now: retry_at = min(retry_at or free_at, free_at)
+        self._waiters = waiting
+        positions = {}
+        for waiter in waiting:
+            ticket = waiter["ticket"]
+            if not ticket["active"]: positions.setdefault(id(ticket), (ticket, len(positions) + 1))
+        for ticket, position in positions.values(): self._notify(ticket, position)
+        if retry_at: self._wakeup = self.loop.call_at(retry_at, self._dispatch) # 키 한도가 풀리는 시각에 다시 배정
+
+    def _notify(self, ticket, position):
+        if ticket["position"] == position or not ticket["on_position"]: return
+        ticket["position"] = position
+        try: ticket["on_position"](position)
+        except Exception: pass
+
+    def _admit(self, waiter, now):
+        ticket = waiter["ticket"]
+        waiter["grant"] = [now, ticket["tokens"]]
+        self._usage[waiter["key_idx"]].append(waiter["grant"])
+        self._sessions[ticket["session"]] += 1
+        ticket["active"] += 1
+        self.in_flight += 1
+        self.peak = max(self.peak, self.in_flight)
+        self.admitted += 1
+        self._notify(ticket, 0)
+        waiter["future"].set_result(waiter["grant"])
+
+    def _release(self, waiter):
+        ticket = waiter["ticket"]
+        self.in_flight -= 1
+        ticket["active"] -= 1
+        self._sessions[ticket["session"]] -= 1
+        if self._sessions[ticket["session"]] <= 0: del self._sessions[ticket["session"]]
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def admit(self, ticket, key_idx):
+        # 입장할 때까지 기다렸다가 [입장 시각, 토큰] 기록을 돌려줌 (토큰을 고치면 키 TPM 정산에 반영)
+        if ticket["seq"] is None:
+            ticket["seq"] = self._next_seq # 순서는 시도가 아니라 호출 도착 순 (재시도해도 자리 유지)
+            self._next_seq += 1
+        waiter = {"ticket": ticket, "key_idx": key_idx, "future": self.loop.create_future(), "grant": None}
+        self._waiters.append(waiter)
+        self._dispatch()
+        if not waiter["future"].done(): self.queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter["future"]), LLM_QUEUE_TIMEOUT_SEC)
+        except BaseException as e:
+            if waiter["grant"] is not None: self._release(waiter) # 입장과 동시에 취소됨
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+                self._dispatch()
+            if isinstance(e, asyncio.TimeoutError): raise LLMDeadlineExceeded("대기열", LLM_QUEUE_TIMEOUT_SEC) from None
+            raise
+        try: yield waiter["grant"]
+        finally: self._release(waiter)
+
+    def stats(self):
+        now = self.loop.time()
+        return {
+            "max_concurrent": self.max_concurrent, "in_flight": self.in_flight, "waiting": len(self._waiters), "peak": self.peak,
+            "admitted": self.admitted, "queued": self.queued, "cancelled": self.cancelled, "timeouts": dict(self.timeouts),
+            "keys": {
+                key_idx: {"requests": len(recent), "tokens": sum(used for _, used in recent)}
+                for key_idx, usage in list(self._usage.items())
+                for recent in [[entry for entry in list(usage) if entry[0] > now - LLM_RATE_WINDOW_SEC]]
+            },
+        }
 
-def generate_content_with_fallback(prompt, image=None, mode="flash", status_container=None, text_placeholder=None):
+@st.cache_resource
+def get_llm_layer():
+    return AsyncCallLayer()
+
+async def _within(awaitable, deadline, phase, seconds):
+    # deadline(루프 시각)까지 끝나지 않으면 LLMDeadlineExceeded
+    try: return await asyncio.wait_for(awaitable, max(0.0, deadline - asyncio.get_running_loop().time()))
+    except asyncio.TimeoutError: raise LLMDeadlineExceeded(phase, seconds) from None
+
+# 🔥 [스트리밍] 토큰이 도착하는 대로 화면에 표시
+# stream_content_with_fallback 은 이벤트 제너레이터입니다: ("text", 조각) / ("reset", 사유) / ("done", 모델 표시)
+#   / ("queue", 대기 순번) — 입장 대기 중이면 1부터, 입장하면 0
+# 스트림이 중간에 끊기면 "reset" 을 보낸 뒤 다음 키/모델로 처음부터 다시 받습니다. (렌더러는 이미 보여준 내용을 지우고 새로 그림)
+#
+# 🔥 [지연] 헤지(Hedged) 요청 모드
+# 첫 시도가 적응형 마감(첫 토큰 p95 기반) 안에 첫 토큰을 내지 못하면, 다른 키/모델로 두 번째 시도를 동시에 시작합니다.
+# 먼저 토큰을 낸 스트림이 이기고 나머지는 취소됩니다. 호출당 추가 시도 수와 프로세스 전체 분당 예산으로 제한.
+HEDGE_DEFAULT_DELAY_SEC = 4.0
+HEDGE_MIN_DELAY_SEC = 2.0
+HEDGE_MAX_DELAY_SEC = 8.0
+HEDGE_MAX_EXTRA_ATTEMPTS = 1
+HEDGE_BUDGET_PER_MIN = 20
+CANCEL_POLL_SEC = 0.5 # 동기 래퍼는 조각을 기다리는 동안에도 이 간격으로 취소·리런 요청 확인
+
+class CallCancelled(Exception):
+    pass
+
+async def _stream_attempt(layer, scheduler, ticket, attempt, prompt, image, events):
+    from google.generativeai.types import GenerateContentResponse
+    key_idx, model_name = attempt["pair"]
+    image_parts = []
+    loop = asyncio.get_running_loop()
+    call = None
+    first_token_at = None
+    try:
+        image_handles = get_image_handles()
+        images = [] if image is None else list(image) if isinstance(image, (list, tuple)) else [image]
+        if images:
+            api_key = scheduler.api_key(key_idx)
+            try:
+                image_parts = await _within(
+                    loop.run_in_executor(None, lambda: [image_handles.part_for(img, key_idx, api_key) for img in images]),
+                    loop.time() + IMAGE_HANDLE_UPLOAD_TIMEOUT_SEC, "업로드", IMAGE_HANDLE_UPLOAD_TIMEOUT_SEC
+                )
+            except LLMDeadlineExceeded:
+                layer.timeouts["업로드"] += 1 # 업로드가 멈춰도 시도는 이어감: 이미지 바이트를 직접 보냄
+                image_parts = [img.blob() if isinstance(img, ProblemImage) else img for img in images]
+        async with layer.admit(ticket, key_idx) as grant:
+            started = loop.time() # 업로드·대기열 시간은 마감과 모델 지연 통계에서 제외
+            model = scheduler.async_model_for(key_idx, model_name)
+            # generate_content_async 는 첫 조각까지 한 번에 기다리므로, 연결과 첫 토큰 마감을 나누려고 요청을 직접 만들어 스트림을 엽니다.
+            request = model._prepare_request(contents=[prompt, *image_parts] if images else prompt, tools=None, tool_config=None)
+            request.contents[-1].role = "user"
+            call = await _within(
+                model._async_client.stream_generate_content(request, timeout=LLM_TOTAL_TIMEOUT_SEC),
+                started + LLM_CONNECT_TIMEOUT_SEC, "연결", LLM_CONNECT_TIMEOUT_SEC
+            )
+            chunks = call.__aiter__()
+            while True:
+                if first_token_at is None:
+                    limit = (started + LLM_FIRST_TOKEN_TIMEOUT_SEC, "첫 토큰", LLM_FIRST_TOKEN_TIMEOUT_SEC)
+                else:
+                    limit = (started + LLM_TOTAL_TIMEOUT_SEC, "전체", LLM_TOTAL_TIMEOUT_SEC)
+                try: chunk = await _within(chunks.__anext__(), *limit)
+                except StopAsyncIteration: break
+                if chunk.usage_metadata.total_token_count: grant[1] = chunk.usage_metadata.total_token_count # 실제 사용량으로 TPM 정산
+                text = GenerateContentResponse.from_response(chunk).text
+                if text:
+                    if first_token_at is None: first_token_at = loop.time()
+                    events.put_nowait((attempt["id"], "text", text))
+
+        finished = loop.time()
+        scheduler.record_success(key_idx, model_name, finished - started, (first_token_at or finished) - started)
+        events.put_nowait((attempt["id"], "done", model_name))
+    except asyncio.CancelledError:
+        layer.cancelled += 1 # 진 시도·취소된 호출은 통계에 남기지 않음
+        raise
+    except Exception as e:
+        if isinstance(e, LLMDeadlineExceeded): layer.timeouts[e.phase] += 1
+        if any(isinstance(part, dict) and "file_data" in part for part in image_parts) and is_file_reference_error(e):
+            for img in images: image_handles.invalidate(img, key_idx) # 만료/삭제된 파일: 키·모델 탓이 아니므로 통계에 남기지 않고 다음 시도에서 재업로드
+        elif getattr(e, "phase", None) != "대기열": # 입장 대기 초과는 키·모델 탓이 아님
+            scheduler.record_failure(key_idx, model_name, e)
+        events.put_nowait((attempt["id"], "error", e))
+    finally:
+        if call is not None: call.cancel()
+
+async def astream_content_with_fallback(prompt, image=None, mode="flash", hedge=None, budget=None, ticket=None):
+    # budget: 키별 시도 예산(try_charge) — 예산이 남은 키로만 시도. 이 제너레이터를 닫거나 취소하면 진행 중인 시도를 모두 끊습니다.
+    # ticket: make_call_ticket 으로 만든 입장 정보 (우선순위·학생·대기 순번 알림, 없으면 모드 기본 우선순위)
+    if ticket is None: ticket = make_call_ticket(prompt, image, mode)
+    layer = get_llm_layer()
+    scheduler = get_key_scheduler()
+    loop = asyncio.get_running_loop()
+    hedges_left = HEDGE_MAX_EXTRA_ATTEMPTS if (HEDGED_REQUESTS if hedge is None else hedge) else 0
+    pairs = scheduler.plan(mode)
+    events = asyncio.Queue()
+    running = {}
+    winner = None
     last_error = None
-    key_indices = list(range(len(API_KEYS)))
-    random.shuffle(key_indices)
-
-    if mode == "pro":
-        target_models = PRO_MODELS
-    else:
-        target_models = FLASH_MODELS
+    deadline = None
+
+    def launch():
+        # 헤지 시도는 이미 돌고 있는 키와 다른 키를 우선 선택, 그중 키 한도에 여유가 있는 쪽으로
+        busy_keys = {a["pair"][0] for a in running.values()}
+        while pairs:
+            choice = layer.route([p for p in pairs if p[0] not in busy_keys] or pairs, ticket["tokens"])
+            pairs.remove(choice)
+            if budget is None or budget.try_charge(choice[0]): break
+        else: return None
+        attempt = {"id": uuid.uuid4().hex, "pair": choice}
+        running[attempt["id"]] = attempt
+        attempt["task"] = loop.create_task(_stream_attempt(layer, scheduler, ticket, attempt, prompt, image, events))
+        return attempt
 
-    for model_name in target_models:
-        for key_idx in key_indices:
-            current_key = API_KEYS[key_idx]
+    try:
+        first = launch()
+        if first is None: raise RuntimeError("사용 가능한 API 키가 없습니다.")
+        if hedges_left: deadline = loop.time() + scheduler.hedge_delay(*first["pair"])
+
+        while running:
+            timeout = None
+            if winner is None and deadline is not None:
+                timeout = max(0.0, deadline - loop.time())
             try:
-                genai.configure(api_key=current_key)
-                model = genai.GenerativeModel(model_name)
-                
-                if image: 
-                    response_stream = model.generate_content([prompt, image], stream=True)
-                else: 
-                    response_stream = model.generate_content(prompt, stream=True)
-                
-                full_text = ""
-                for chunk in response_stream:
-                    if chunk.text:
-                        full_text += chunk.text
-                        if status_container:
-                            pass # status 업데이트 로직 제거 (안정성)
-                        if text_placeholder:
-                            pass # 스트리밍 제거 (안정성)
-                
-                return full_text, f"✅ {model_name}"
-            
-            except Exception as e:
-                last_error = e
-                time.sleep(0.5) 
+                attempt_id, kind, value = await asyncio.wait_for(events.get(), timeout)
+            except asyncio.TimeoutError:
+                # 마감까지 첫 토큰이 없음 → 예산이 허락하면 다른 키/모델로 추가 시도
+                deadline = None
+                if hedges_left and scheduler.try_acquire_hedge() and launch():
+                    hedges_left -= 1
                 continue
-    
-    raise last_error
 
-# 🔥 [파서] 빈 화면 방지 (안전 장치)
-def parse_response_to_dict(text):
-    data = {}
-    clean_text = re.sub(r'[\*\#]*={3,}\s*([A-Z_]+)\s*={3,}[\*\#]*', r'===\1===', text)
-    
-    def extract_section(start_tag, end_tags, default=""):
-        if start_tag not in clean_text: return default
+            if attempt_id not in running: continue # 이미 취소된 시도의 잔여 이벤트
+            if kind == "text":
+                if winner is None:
+                    winner = attempt_id
+                    for other_id in [i for i in running if i != attempt_id]:
+                        running.pop(other_id)["task"].cancel()
+                if attempt_id == winner: yield ("text", value)
+            elif kind == "done":
+                if winner in (None, attempt_id):
+                    yield ("done", f"✅ {value}")
+                    return
+            elif kind == "error":
+                running.pop(attempt_id)
+                last_error = value
+                if attempt_id == winner:
+                    winner = None
+                    yield ("reset", str(value))
+                if not running and launch() and hedges_left:
+                    deadline = loop.time() + HEDGE_DEFAULT_DELAY_SEC
+    finally:
+        for attempt in running.values(): attempt["task"].cancel()
+
+    raise last_error or RuntimeError("사용 가능한 API 키가 없습니다.")
+
+def _yield_to_script_runner():
+    # 스크립트 스레드라면 대기 중인 리런/중지 요청(예: 호출 도중 누른 초기화 버튼)을 바로 처리합니다.
+    # streamlit 은 화면에 무언가를 쓸 때만 이 요청을 확인하므로, 조각이 오지 않는 동안에는 여기서 대신 확인합니다.
+    from streamlit.runtime.scriptrunner import get_script_run_ctx, RerunException, StopException
+    from streamlit.runtime.scriptrunner_utils.script_requests import ScriptRequestType
+    ctx = get_script_run_ctx(suppress_warning=True)
+    if ctx is None or ctx.script_requests is None: return
+    request = ctx.script_requests.on_scriptrunner_yield()
+    if request is None: return
+    if request.type == ScriptRequestType.RERUN: raise RerunException(request.rerun_data)
+    raise StopException()
+
+def session_cancel_event():
+    # 이 세션이 백그라운드로 건 호출의 취소 신호 (초기화·로그아웃·새 문제에서 cancel_session_calls 가 켬)
+    event = st.session_state.get('llm_cancel')
+    if event is None: event = st.session_state['llm_cancel'] = threading.Event()
+    return event
+
+def stream_content_with_fallback(prompt, image=None, mode="flash", hedge=None, budget=None, cancelled=None, priority=None, session=None):
+    # astream_content_with_fallback 의 동기 래퍼: 호출 계층의 이벤트 루프에서 돌린 이벤트를 큐로 받아 그대로 내보냅니다.
+    # cancelled(): True 를 돌려주면 중단 (CallCancelled). 소비를 멈추거나 예외로 빠져나가면 진행 중인 시도를 모두 끊습니다.
+    # priority: LLM_PRIORITY_* (없으면 모드 기본값) / session: 공정 대기열에서 학생을 구분할 세션 id (없으면 지금 세션)
+    events = queue.Queue()
+    ticket = make_call_ticket(
+        prompt, image, mode, priority, session or current_session_id(), on_position=lambda position: events.put(("event", ("queue", position)))
+    )
+
+    async def pump():
         try:
-            content = clean_text.split(start_tag)[1]
-            for end_tag in end_tags:
-                if end_tag in content:
-                    content = content.split(end_tag)[0]
-                    break
-            return content.strip()
-        except:
-            return default
+            async for event in astream_content_with_fallback(prompt, image, mode, hedge, budget, ticket):
+                events.put(("event", event))
+        except Exception as e:
+            events.put(("error", e))
+        finally:
+            events.put(("end", None))
+
+    future = get_llm_layer().submit(pump())
+    try:
+        while True:
+            if cancelled and cancelled(): raise CallCancelled()
+            _yield_to_script_runner()
+            try: kind, value = events.get(timeout=CANCEL_POLL_SEC)
+            except queue.Empty: continue
+            if kind == "end": return
+            if kind == "error": raise value
+            yield value
+    finally:
+        future.cancel()
+
+def render_stream(events, text_placeholder=None, status_container=None, transform=None, parser=None):
+    # parser(SectionStreamParser)가 있으면 조각을 넘겨 섹션을 나누고, 미리보기도 파서가 만든 것을 씀
+    full_text, model_label = "", None
+    for kind, value in events:
+        if kind == "text":
+            full_text += value
+            if parser: parser.feed(value)
+            if text_placeholder:
+                preview = parser.preview() if parser else (transform(full_text) if transform else full_text)
+                text_placeholder.markdown(preview + " ▌")
+        elif kind == "reset":
+            full_text = ""
+            if parser: parser.reset()
+            if text_placeholder: text_placeholder.empty()
+            if status_container: status_container.update(label="⚠️ 응답이 끊겨 다른 모델로 다시 생성하는 중...")
+        elif kind == "queue":
+            # 입장 대기 중이면 스피너 대신 대기 순번을 보여주고, 입장하면 지움 (이미 받은 조각이 있으면 그대로)
+            if value:
+                if text_placeholder: text_placeholder.info(f"⏳ 요청이 몰려 차례를 기다리는 중입니다... (대기 {value}번째)")
+                if status_container: status_container.update(label=f"⏳ 대기 {value}번째...")
+            elif text_placeholder and not full_text:
+                text_placeholder.empty()
+        elif kind == "done":
+            model_label = value
+    return full_text, model_label
+
+def generate_content_with_fallback(prompt, image=None, mode="flash", status_container=None, text_placeholder=None, transform=None, parser=None,
+                                   hedge=None, budget=None, cancelled=None, priority=None, session=None):
+    return render_stream(
+        stream_content_with_fallback(prompt, image, mode, hedge, budget, cancelled, priority, session), text_placeholder, status_container, transform, parser
+    )
+
+# 🔥 [파서] 해설 섹션 프로토콜 (===CONCEPT=== … ===TWIN_ANSWER===)
+# 스트림 조각을 받는 대로 한 번만 훑어 섹션으로 나눕니다. 구분자가 조각 경계에 걸칠 수 있으므로 구분자의 앞부분일 수 있는
+# 꼬리는 다음 조각이 올 때까지 보류합니다. 섹션이 끝날 때마다(다음 구분자 도착) on_section(태그, 내용)을 호출해서
+# SOLUTION 이 생성되는 동안에도 HINT 로 오답노트 이미지 렌더링을 시작할 수 있습니다.
+# 최종 결과(result)는 예전 parse_response_to_dict 와 같은 규칙(끝 태그 우선순위, 기본값, 풀이 실패 시 원문)을 따릅니다.
+SECTION_MARKER_RE = re.compile(r'[\*\#]*={3,}\s*([A-Z_]+)\s*={3,}[\*\#]*')
+SECTION_MARKER_TAIL_RE = re.compile(r'[\*\#]*(?:={1,2}|={3,}\s*(?:[A-Z_]+\s*={0,2})?)?$')
+SECTION_FIELDS = [ # (결과 키, 시작 태그, 끝 태그(우선순위 순), 기본값)
+    ('concept', "CONCEPT", ["HINT"], "개념 분석 중..."),
+    ('hint_for_image', "HINT", ["SOLUTION"], "힌트 없음"),
+    ('solution', "SOLUTION", ["SHORTCUT", "CORRECTION"], ""),
+    ('shortcut', "SHORTCUT", ["CORRECTION", "TWIN_PROBLEM"], "숏컷 없음"),
+    ('correction', "CORRECTION", ["TWIN_PROBLEM"], "첨삭 없음"),
+    ('twin_problem', "TWIN_PROBLEM", ["TWIN_ANSWER"], "문제 생성 중..."),
+    ('twin_answer', "TWIN_ANSWER", [], "정답 없음"),
+]
 
-    data['concept'] = extract_section("===CONCEPT===", ["===HINT==="], "개념 분석 중...")
-    data['hint_for_image'] = extract_section("===HINT===", ["===SOLUTION==="], "힌트 없음")
-    
-    # 🔥 [핵심] 솔루션 파싱 실패 시, 원본 텍스트를 다 보여줌 (Fallback)
-    sol_candidate = extract_section("===SOLUTION===", ["===SHORTCUT===", "===CORRECTION==="], "")
-    if not sol_candidate or len(sol_candidate) < 10:
-        data['solution'] = text 
-    else:
-        data['solution'] = sol_candidate
+# 해설 스트리밍 미리보기: 섹션 구분자를 제목으로 바꾸고, 쌍둥이 문제 정답은 보여주지 않음
+STREAM_SECTION_LABELS = {
+    "CONCEPT": "📘 핵심 개념", "HINT": "💡 힌트", "SOLUTION": "📖 풀이", "SHORTCUT": "⚡ 숏컷",
+    "CORRECTION": "📝 첨삭", "TWIN_PROBLEM": "📝 쌍둥이 문제",
+}
 
-    data['shortcut'] = extract_section("===SHORTCUT===", ["===CORRECTION===", "===TWIN_PROBLEM==="], "숏컷 없음")
-    data['correction'] = extract_section("===CORRECTION===", ["===TWIN_PROBLEM==="], "첨삭 없음")
-    data['twin_problem'] = extract_section("===TWIN_PROBLEM===", ["===TWIN_ANSWER==="], "문제 생성 중...")
-    data['twin_answer'] = extract_section("===TWIN_ANSWER===", [], "정답 없음")
+class SectionStreamParser:
+    def __init__(self, on_section=None):
+        self.on_section = on_section
+        self.reset()
+
+    def reset(self):
+        # 스트림이 다른 모델로 처음부터 다시 시작될 때
+        self._pending = ""                  # 구분자의 앞부분일 수 있어 보류 중인 꼬리
+        self.segments = [[None, []]]        # [태그, 텍스트 조각들] (첫 구분자 앞은 태그 None)
+        self._first = {}                    # 태그 → 처음 나온 segments 위치
+        self._preview_closed = []           # 끝난 섹션의 미리보기 문자열
+        self._hidden = False                # TWIN_ANSWER 이후는 미리보기에서 숨김
+
+    def feed(self, chunk, final=False):
+        buf = self._pending + chunk
+        pos = hold = 0
+        while True:
+            m = SECTION_MARKER_RE.search(buf, pos)
+            if not m: break
+            if m.end() == len(buf) and not final: # 뒤에 *, # 가 더 붙을 수 있으니 다음 조각까지 보류
+                hold = m.start()
+                break
+            self._append(buf[pos:m.start()])
+            self._open(m.group(1))
+            pos = m.end()
+        if not m: hold = len(buf) if final else SECTION_MARKER_TAIL_RE.search(buf, pos).start()
+        self._append(buf[pos:hold])
+        self._pending = buf[hold:]
+
+    def close(self):
+        # 스트림 끝: 보류 중인 꼬리까지 처리하고 마지막 섹션을 알림
+        self.feed("", final=True)
+        self._emit(self.segments[-1])
+
+    def _append(self, text):
+        if text: self.segments[-1][1].append(text)
+
+    def _emit(self, segment):
+        if self.on_section and segment[0] is not None:
+            self.on_section(segment[0], "".join(segment[1]).strip())
+
+    def _open(self, tag):
+        self._emit(self.segments[-1])
+        if not self._hidden: self._preview_closed.append(self._preview_of(self.segments[-1]))
+        if tag == "TWIN_ANSWER": self._hidden = True
+        self._first.setdefault(tag, len(self.segments))
+        self.segments.append([tag, []])
+
+    def _preview_of(self, segment):
+        tag, parts = segment
+        header = f"\n\n**{STREAM_SECTION_LABELS.get(tag, tag)}**\n\n" if tag else ""
+        return header + "".join(parts)
+
+    def preview(self):
+        if self._hidden: return "".join(self._preview_closed)
+        return "".join(self._preview_closed) + self._preview_of(self.segments[-1])
+
+    def section(self, tag, end_tags, default=""):
+        # 첫 tag 뒤 ~ 같은 tag 가 다시 나오기 전까지 중에서, end_tags 를 우선순위대로 찾아 처음 나오는 곳에서 자름
+        start = self._first.get(tag)
+        if start is None: return default
+        stop = start + 1
+        while stop < len(self.segments) and self.segments[stop][0] != tag: stop += 1
+        span_tags = [seg[0] for seg in self.segments[start + 1:stop]]
+        for end_tag in end_tags:
+            if end_tag in span_tags:
+                stop = start + 1 + span_tags.index(end_tag)
+                break
+        pieces = ["".join(self.segments[start][1])]
+        for seg_tag, parts in self.segments[start + 1:stop]:
+            pieces.append(f"==={seg_tag}===")
+            pieces.extend(parts)
+        return "".join(pieces).strip()
+
+    def result(self, raw_text):
+        data = {key: self.section(tag, end_tags, default) for key, tag, end_tags, default in SECTION_FIELDS}
+        # 🔥 [핵심] 솔루션 파싱 실패 시, 원본 텍스트를 다 보여줌 (Fallback)
+        if not data['solution'] or len(data['solution']) < 10:
+            data['solution'] = raw_text
+        return data
 
-    return data
+# 🔥 [파서] 빈 화면 방지 (안전 장치)
+def parse_response_to_dict(text):
+    parser = SectionStreamParser()
+    parser.feed(text)
+    parser.close()
+    return parser.result(text)
 
 def sanitize_json(text):
     text = text.replace("```json", "").replace("```", "").strip()
@@ -465,6 +2175,614 @@ def sanitize_json(text):
     text = re.sub(pattern, r'\\\\', text)
     return text
 
+# 🔥 [Flash 프롬프트: EBS 수능특강 해설지 로봇 + 손글씨 인식]
+def build_main_prompt(subject, safe_self_note):
+    curriculum_rules = get_curriculum_prompt(subject)
+    return f"""
+        당신은 감정이 없는 **'평가원 정답지 작성 알고리즘(Standard Answer Generator)'**입니다. (과목: {subject})
+        이미지를 분석하여 다음 항목을 작성하십시오.
+
+        **[0. 이미지 인식 지침 (Handwriting Filtering)]**
+        - 이미지 내의 **'인쇄된 텍스트(Problem)'**와 **'손글씨(Student's Work)'**를 엄격히 구분하십시오.
+        - **[풀이 작성 시]:** 오직 '인쇄된 문제'를 기준으로 정석 풀이를 작성하십시오. 손글씨는 무시하십시오.
+        - **[첨삭 작성 시]:** '손글씨'를 분석하여 학생이 어느 과정에서 틀렸는지 구체적으로 지적하십시오.
+
+        **[학생의 Self-Note]**
+        {safe_self_note}
+        (이 내용도 참고하여 첨삭을 넣어주세요.)
+
+        **[1. 교육과정 준수 및 스타일 (Grade-Lock)]**
+        {curriculum_rules}
+        - **[No Chat]:** '살펴봅시다', '알 수 있습니다', '이므로', '따라서' 등의 **구어체 및 접속사 절대 금지.**
+        - **[Symbol Only]:** 문장 대신 화살표($\\rightarrow$, $\\Rightarrow$)와 논리 기호($\\because$, $\\therefore$)만 사용.
+        - **[Ending]:** 모든 문장은 명사형(~임, ~함)으로 끝내거나 수식으로 종료.
+        - **[Structure]:** 풀이 과정을 의미 단위로 끊어서 `[Step 1]`, `[Step 2]`로 줄바꿈.
+
+        **[2. 숏컷 필수 체크리스트 (Priority Check)]**
+        아래 리스트는 **반드시 체크해야 할 대표적인 예시**이며, 리스트에 없더라도 해당 단원의 숏컷이 있다면 적극적으로 사용하십시오.
+        적용 가능한 기술은 **오직 [2] 숏컷 풀이**에만 반영하십시오.
+        ⚠️ **주의: 숏컷 기술들은 [1] 정석 풀이에는 절대 사용하지 마십시오. (감점 요인임)**
+        1. **[다항함수]** 3차/4차함수 비율 관계(2:1, 3:1), 넓이 공식(1/6, 1/12), 높이차 공식, 변곡점 대칭성.
+        2. **[수열/극한]** 등차수열 합의 기하학적 해석(상수항 없는 2차함수), 등비수열=지수함수, 테일러 근사($\\sin x \\approx x$).
+        3. **[미분/적분]** 이차함수 두 점 사이 기울기(=중점의 미분계수), 로피탈.
+        4. **[삼각/기하]** 사인법칙(지름의 지배), 코사인법칙(피타고라스 보정), 신발끈 공식, 파푸스 중선정리.
+        5. **[확통/경우의 수]** 같은 것이 있는 순열, 정규분포 대칭성 활용, 중복조합 H 공식 직결.
+
+        **[출력 형식]**
+        ===CONCEPT===
+        (핵심 개념 한 줄)
+        ===HINT===
+        (결정적 힌트 1줄)
+        ===SOLUTION===
+        (### 📖 [1] 정석 풀이
+        **[주의]**: 위 [서술형 표준 프로토콜]을 철저히 지키며, 교과서적인 서술형 풀이 작성.)
+        ===SHORTCUT===
+        (### 🍯 [2] 숏컷 풀이 (Skill)
+        위 [필수 체크 리스트]를 활용한 수능 실전 기술 분석가의 시선으로 작성.)
+        ===CORRECTION===
+        (학생의 노트와 **이미지 속 손글씨 풀이**에 대한 **[메타인지 피드백]**을 작성하십시오.
+        1. 오류 진단: **[단순 계산 / 개념 오적용 / 조건 누락 / 발문 독해]** 중 원인을 분류.
+        2. 칭찬과 지적: 학생의 사고 중 맞는 부분은 인정하고, 논리가 꼬인 '결정적 분기점'을 지적.
+        3. 행동 지침: "다음에는 문제의 OOO 단어에 동그라미를 치세요" 같은 구체적 행동 제시.)
+        ===TWIN_PROBLEM===
+        (숫자 변형 유사 문제 1개. LaTeX 사용)
+        ===TWIN_ANSWER===
+        (정답 및 간단 풀이)
+        """
+
+# 🔥 [Pro 프롬프트: 수능 해커 + 손글씨 인식 + 무제한 스킬]
+def build_pro_prompt(safe_self_note_pro):
+    return f"""
+        당신은 대한민국 수학계의 정점, '수능 해커'입니다.
+        학생이 **[고난도 심화 분석]**을 요청했습니다. 
+        단순한 공식 암기나 계산 노동을 넘어, **문제의 구조를 꿰뚫는 가장 짧은 길**을 제시하십시오.
+
+        **[0. 이미지 인식 지침 (Handwriting Filtering)]**
+        - 이미지 내의 **'인쇄된 텍스트(Problem)'**와 **'손글씨(Student's Work)'**를 엄격히 구분하십시오.
+        - 문제를 풀 때는 오직 '인쇄된 텍스트'에 집중하십시오.
+        - 단, `===CORRECTION===` 파트에서는 학생의 손글씨 풀이를 분석하여 어떤 사고 과정에서 막혔는지 간파하십시오.
+
+        **[Deep Insight Protocol: 압도적 단축]**
+        **[핵심 지침]:** 교과서적인 서술을 배제하고, **가장 '무자비(Ruthless)'하고 효율적인 '전략적 단축(Strategic Shortcut)'**과 **'직관(Intuitive Insight)'**만 사용하여 답을 찍어내십시오.
+        아래 리스트는 **대표적인 예시**일 뿐입니다. 리스트에 없더라도 이 문제를 가장 빠르고 충격적으로 풀 수 있는 당신만의 비기(Hidden Skill)나 상위 개념이 있다면 **제한 없이** 사용하십시오.
+
+        1. **Regression to Basics (중학 기하의 힘):** 고등 미적분 문제라도 **중학교 도형의 성질(닮음, 합동, 원주각, 대칭성)**로 풀면 계산이 0이 되는 경우가 많습니다. 이를 최우선으로 탐색하십시오.
+        2. **[특수성 우선의 법칙 (Graph Traits)]:** 일반적인 식 계산 전에, 그래프가 **접하거나(Tangency), 대칭(Symmetry)이거나, 변곡점**을 지나는 특수한 상황인지 먼저 의심하십시오. 답은 99% 그곳에 있습니다.
+        3. **[차(Difference) 함수 해석]:** $f(x)=g(x)$를 연립하지 말고, 새로운 함수 $h(x) = f(x)-g(x)$를 그려 $x$축과의 교점으로 해석하여 식을 작성하십시오.
+        4. **[Complex Plane Strategy (복소평면 치트키)]:** 만약 **'복소수(Complex Number)'** 단원 문제라면, $z=a+bi$ 대수 계산을 멈추고 즉시 **[복소평면(Gaussian Plane)]**을 도입하십시오.
+           - 곱셈은 **회전 변환(Rotation)**으로, 덧셈은 **벡터의 합**으로 해석하여 기하학적으로 1초 만에 푸는 방법을 제시하십시오.
+        5. **Cost-Benefit Analysis:** 당신의 풀이가 기존 숏컷보다 확실히 짧고 충격적일 때만 제시하십시오.
+
+        **[작성 지침]**
+        - 설명하려 하지 말고, **보여주십시오.** (Show, Don't Tell)
+        - 문어체 필수. 수식은 LaTeX($$) 사용.
+
+        **[출력 형식]**
+        ===CONCEPT===
+        (문제를 관통하는 단 하나의 원리)
+        ===HINT===
+        (기존 해설과는 다른, 도형이나 대칭성을 이용한 새로운 시각)
+        ===SOLUTION===
+        (논리적 정석 풀이 - Flash 모델과 동일해도 됨)
+        ===SHORTCUT===
+        (### ⚡ [2] Pro Insight (Ultra-Short)
+        **[조건]**: 일반적인 공식 적용보다 더 빠르고 기발한 풀이.
+        - 예: "복잡한 적분 계산 대신, 그래프 대칭성을 이용해 직사각형 넓이로 치환한다.")
+        ===CORRECTION===
+        (학생의 사고 과정 "{safe_self_note_pro}"와 **이미지 속 손글씨**의 맹점 지적)
+        """
+
+# 🔥 [첨삭 전용 프롬프트] 응답 캐시 적중 시, Self-Note/손글씨에 따라 달라지는 CORRECTION 만 새로 생성
+def build_correction_prompt(subject, safe_self_note, cached_result):
+    return f"""
+        당신은 학생의 풀이를 첨삭하는 수학 선생님입니다. (과목: {subject})
+        이 문제의 정석 풀이는 이미 아래와 같이 작성되어 있습니다.
+
+        - 핵심 개념: {cached_result.get('concept')}
+        - 정석 풀이: {cached_result.get('solution')}
+
+        **[이미지 인식 지침]**
+        - 이미지 내의 **'인쇄된 텍스트(Problem)'**와 **'손글씨(Student's Work)'**를 엄격히 구분하고, 손글씨만 분석하십시오.
+
+        **[학생의 Self-Note]**
+        {safe_self_note}
+
+        **[출력 형식]**
+        ===CORRECTION===
+        (학생의 노트와 **이미지 속 손글씨 풀이**에 대한 **[메타인지 피드백]**을 작성하십시오.
+        1. 오류 진단: **[단순 계산 / 개념 오적용 / 조건 누락 / 발문 독해]** 중 원인을 분류.
+        2. 칭찬과 지적: 학생의 사고 중 맞는 부분은 인정하고, 논리가 꼬인 '결정적 분기점'을 지적.
+        3. 행동 지침: "다음에는 문제의 OOO 단어에 동그라미를 치세요" 같은 구체적 행동 제시.)
+        """
+
+# 🔥 [성능] Gemini 응답 캐시 (Content-Addressed)
+# 키 = 문제 이미지 지각 해시(dHash) + 교육과정 규칙 + 프롬프트 템플릿 버전 + 모델 등급.
+# 같은 교재 문제를 여러 학생이 올리면 CONCEPT/SOLUTION/SHORTCUT/TWIN 은 캐시에서 바로 돌려주고,
+# Self-Note 에 의존하는 CORRECTION 은 항상 새로 생성합니다. (프롬프트 문구를 바꾸면 PROMPT_TEMPLATE_VERSION 을 올릴 것)
+# 조회는 키가 정확히 같을 때만 히트합니다. 레이아웃이 같은 다른 문제끼리도 dHash 가 몇 비트 차이밖에 안 날 수 있어
+# 가까운 해시를 허용하면 다른 문제의 풀이를 돌려주게 되므로, 같은 쪽을 다시 찍은 사진은 미스로 처리합니다.
+PROMPT_TEMPLATE_VERSION = 1
+RESPONSE_CACHE_PATH = "mathai_cache.db"
+RESPONSE_CACHE_TTL_SEC = 14 * 24 * 3600
+RESPONSE_CACHE_MAX_ENTRIES = 5000
+RESPONSE_CACHE_SECTIONS = {
+    "flash": ['concept', 'hint_for_image', 'solution', 'shortcut', 'twin_problem', 'twin_answer'],
+    "pro": ['concept', 'hint_for_image', 'solution', 'shortcut'],
+}
+PARSE_DEFAULTS = {"개념 분석 중...", "힌트 없음", "숏컷 없음", "문제 생성 중...", "정답 없음"}
+
+def image_dhash(image, hash_size=16):
+    # 차이 해시: 흑백 (hash_size+1)×hash_size 축소 후 가로로 이웃 픽셀 밝기 비교 → hash_size² 비트
+    gray = image.convert("L").resize((hash_size + 1, hash_size), Image.Resampling.BILINEAR)
+    pixels = list(gray.getdata())
+    bits = 0
+    for y in range(hash_size):
+        row = pixels[y * (hash_size + 1):(y + 1) * (hash_size + 1)]
+        for x in range(hash_size):
+            bits = (bits << 1) | (row[x] > row[x + 1])
+    return f"{bits:0{hash_size * hash_size // 4}x}"
+
+class ResponseCache:
+    def __init__(self, path=RESPONSE_CACHE_PATH, ttl=RESPONSE_CACHE_TTL_SEC, max_entries=RESPONSE_CACHE_MAX_ENTRIES):
+        self._path = path
+        self._ttl = ttl
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        conn = self._connect()
+        try:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS response_cache_lru ON response_cache (last_access)")
+        finally: conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self._path, timeout=30, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def make_key(self, image, curriculum_rules, mode):
+        rules_digest = hashlib.sha256(curriculum_rules.encode("utf-8")).hexdigest()[:16]
+        dhash = image.dhash if isinstance(image, ProblemImage) else image_dhash(image)
+        return f"{dhash}:{rules_digest}:v{PROMPT_TEMPLATE_VERSION}:{mode}"
+
+    def get(self, key):
+        now = time.time()
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT value FROM response_cache WHERE key = ? AND created_at > ?", (key, now - self._ttl)).fetchone()
+            if row: conn.execute("UPDATE response_cache SET last_access = ?, hits = hits + 1 WHERE key = ?", (now, key))
+        finally: conn.close()
+        with self._lock:
+            if row: self.hits += 1
+            else: self.misses += 1
+        return json.loads(row[0]) if row else None
+
+    def put(self, key, data, raw_text, mode):
+        # 파싱이 온전한 응답만 저장 (기본값/원문 Fallback 이 섞인 응답은 캐시하지 않음)
+        sections = {k: data.get(k) for k in RESPONSE_CACHE_SECTIONS[mode]}
+        if any(not v or v in PARSE_DEFAULTS for v in sections.values()) or sections['solution'] == raw_text:
+            return False
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(sections, ensure_ascii=False), now, now)
+            )
+            # TTL 만료분 정리 후 LRU 로 최대 개수 유지
+            conn.execute("DELETE FROM response_cache WHERE created_at <= ?", (now - self._ttl,))
+            conn.execute("""
+                DELETE FROM response_cache WHERE key IN (
+                    SELECT key FROM response_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )
+            """, (self._max_entries,))
+        finally: conn.close()
+        return True
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+@st.cache_resource
+def get_response_cache():
+    return ResponseCache()
+
+def generate_analysis(subject, image, safe_self_note, mode, prompt, text_placeholder=None, on_section=None, **call_options):
+    # 캐시 적중 시 CORRECTION 만 새로 생성(비어 있으면 전체 재생성), 아니면 전체 생성 후 캐시에 저장 → (파싱 결과, 캐시 적중 여부)
+    # on_section(태그, 내용): 스트리밍 중 섹션이 끝날 때마다 호출 (캐시 적중 시에는 호출되지 않음)
+    # call_options: generate_content_with_fallback 로 넘길 hedge/budget/cancelled/priority/session (선행 생성용)
+    response_cache = get_response_cache()
+    cache_key = response_cache.make_key(image, get_curriculum_prompt(subject), mode)
+    data = response_cache.get(cache_key)
+    if data is not None:
+        parser = SectionStreamParser()
+        correction_text, _ = generate_content_with_fallback(
+            build_correction_prompt(subject, safe_self_note, data), image, mode=mode,
+            text_placeholder=text_placeholder, parser=parser, **call_options
+        )
+        parser.close()
+        correction = parser.result(correction_text).get('correction')
+        if correction == "첨삭 없음": # 구분자 없이 첨삭만 쓴 응답 → 응답 전체가 이 학생의 첨삭
+            correction = SECTION_MARKER_RE.sub("", correction_text).strip()
+        if correction:
+            data['correction'] = correction
+            return data, True
+        # 첨삭을 받지 못했으면 캐시된 해설로 기본값을 저장하지 않고 전체를 새로 생성
+    parser = SectionStreamParser(on_section)
+    res_text, _ = generate_content_with_fallback(prompt, image, mode=mode, text_placeholder=text_placeholder, parser=parser, **call_options)
+    parser.close()
+    data = parser.result(res_text)
+    response_cache.put(cache_key, data, res_text, mode)
+    return data, False
+
+# 🔥 [지연] Pro 심화 분석 선행 생성 (Speculative, 선택: secrets SPECULATIVE_PRO)
+# Flash 해설이 저장되면(고난도 과목은 튜터링을 시작할 때부터) 백그라운드에서 Pro 분석을 미리 만들어 두고,
+# 학생이 Pro 버튼을 누르면 바로 보여줍니다. 학생 요청보다 뒤로 밀리도록 작은 전용 풀에서 헤지 없이 돌리고,
+# 키별 하루 선행 생성 예산을 넘으면 그 키는 쓰지 않습니다. 초기화/새 문제/로그아웃 또는 세션 종료(브라우저 닫힘) 시 취소.
+# 미리 만든 뒤 Self-Note 가 바뀌었으면, 버튼을 누를 때 응답 캐시에 남은 Pro 해설을 재사용하고 CORRECTION 만 새로 생성합니다.
+SPECULATIVE_PRO_SUBJECTS = {"[15개정] 미적분", "[15개정] 기하", "[22개정] 미적분II", "[22개정] 기하"}
+SPECULATIVE_PRO_DAILY_PER_KEY = 20   # 키별 하루 선행 생성 시도 수 (KST 날짜 기준)
+SPECULATIVE_PRO_WORKERS = 2
+SPECULATIVE_PRO_WAIT_SEC = 60        # 버튼을 눌렀을 때 진행 중인 선행 생성을 기다리는 최대 시간
+
+def _kst_today():
+    return datetime.datetime.now(datetime.timezone(datetime.timedelta(hours=9))).strftime("%Y-%m-%d")
+
+class SpeculationBudget:
+    def __init__(self, per_key_daily=SPECULATIVE_PRO_DAILY_PER_KEY):
+        self.per_key_daily = per_key_daily
+        self._lock = threading.Lock()
+        self._day = None
+        self._used = collections.Counter()
+
+    def _roll(self):
+        today = _kst_today()
+        if today != self._day: self._day, self._used = today, collections.Counter()
+
+    def try_charge(self, key_idx):
+        with self._lock:
+            self._roll()
+            if self._used[key_idx] >= self.per_key_daily: return False
+            self._used[key_idx] += 1
+            return True
+
+    def exhausted(self, key_count):
+        with self._lock:
+            self._roll()
+            return all(self._used[i] >= self.per_key_daily for i in range(key_count))
+
+    def stats(self):
+        with self._lock:
+            self._roll()
+            return {"day": self._day, "per_key_daily": self.per_key_daily, "used": dict(self._used)}
+
+def current_session_id():
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx else None
+
+def is_session_alive(session_id):
+    from streamlit.runtime import Runtime
+    if not session_id or not Runtime.exists(): return True # 테스트 등 런타임이 없으면 판단하지 않음
+    return Runtime.instance().is_active_session(session_id)
+
+class ProSpeculator:
+    def __init__(self, budget, workers=SPECULATIVE_PRO_WORKERS):
+        self.budget = budget
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pro-speculation")
+        self._lock = threading.Lock()
+        self._jobs = {} # 세션 id → 가장 최근 작업
+        self.started = 0
+        self.used = 0
+        self.cancelled = 0
+
+    @staticmethod
+    def _job_key(problem, self_note):
+        return (problem.digest, self_note)
+
+    def _is_cancelled(self, job):
+        return job["cancel"].is_set() or not is_session_alive(job["session_id"])
+
+    def _run(self, job, subject, problem, self_note):
+        safe_self_note = self_note.replace("{", "{{").replace("}", "}}")
+        try:
+            if self._is_cancelled(job): raise CallCancelled()
+            data, _ = generate_analysis(
+                subject, problem, safe_self_note, "pro", build_pro_prompt(safe_self_note),
+                hedge=False, budget=self.budget, cancelled=lambda: self._is_cancelled(job),
+                priority=LLM_PRIORITY_BACKGROUND, session=job["session_id"]
+            )
+            return data
+        except CallCancelled:
+            with self._lock: self.cancelled += 1
+            raise
+
+    def start(self, session_id, subject, problem, self_note):
+        key = self._job_key(problem, self_note)
+        with self._lock:
+            for sid in [sid for sid, j in self._jobs.items() if j["future"].done() and not is_session_alive(sid)]:
+                del self._jobs[sid] # 떠난 세션의 결과 정리
+            previous = self._jobs.get(session_id)
+            if previous and previous["key"] == key and not (previous["future"].done() and previous["future"].exception()):
+                return previous
+            if self.budget.exhausted(len(API_KEYS)): return None
+            job = {"key": key, "session_id": session_id, "cancel": threading.Event(), "future": concurrent.futures.Future(), "previous": previous}
+            self._jobs[session_id] = job
+            self.started += 1
+
+        def submit(_=None):
+            if job["cancel"].is_set(): return job["future"].set_exception(CallCancelled())
+            inner = self._executor.submit(self._run, job, subject, problem, self_note)
+            inner.add_done_callback(lambda f: job["future"].set_exception(f.exception()) if f.exception() else job["future"].set_result(f.result()))
+
+        # 같은 문제를 다른 Self-Note 로 생성 중이면 그 작업이 끝난 뒤 시작 (응답 캐시를 채운 뒤라 CORRECTION 만 생성)
+        if previous and previous["key"][0] == key[0] and not previous["future"].done(): previous["future"].add_done_callback(submit)
+        else:
+            if previous: previous["cancel"].set()
+            submit()
+        return job
+
+    def take(self, session_id, problem, self_note):
+        # 버튼 클릭: 같은 문제·같은 Self-Note 로 만든 작업의 Future (없으면 None)
+        with self._lock:
+            job = self._jobs.get(session_id)
+            if not job or job["key"] != self._job_key(problem, self_note): return None
+            del self._jobs[session_id]
+            self.used += 1
+            return job["future"]
+
+    def peek(self, session_id, problem, self_note):
+        with self._lock:
+            job = self._jobs.get(session_id)
+            return job["future"] if job and job["key"] == self._job_key(problem, self_note) else None
+
+    def cancel(self, session_id):
+        with self._lock: job = self._jobs.pop(session_id, None)
+        while job:
+            job["cancel"].set()
+            job = job["previous"]
+
+    def stats(self):
+        with self._lock:
+            return {"jobs": len(self._jobs), "started": self.started, "used": self.used, "cancelled": self.cancelled, "budget": self.budget.stats()}
+
+@st.cache_resource
+def get_pro_speculator():
+    return ProSpeculator(SpeculationBudget())
+
+def start_pro_speculation():
+    # 현재 문제·Self-Note 로 Pro 분석 선행 생성 시작 (옵션이 꺼져 있으면 아무것도 하지 않음)
+    if not SPECULATIVE_PRO or not st.session_state.get('gemini_image'): return
+    get_pro_speculator().start(
+        current_session_id(), st.session_state['selected_subject'], st.session_state['gemini_image'], st.session_state['self_note']
+    )
+
+def cancel_pro_speculation():
+    if SPECULATIVE_PRO: get_pro_speculator().cancel(current_session_id())
+
+def cancel_session_calls():
+    # 초기화·로그아웃·새 문제: 이 세션이 백그라운드로 건 호출(선행 생성, 대화 요약)을 모두 끊음
+    # (스크립트 스레드에서 진행 중이던 호출은 버튼 클릭으로 생긴 리런 요청을 stream_content_with_fallback 이 받아 이미 끊은 상태)
+    st.session_state.pop('llm_cancel', threading.Event()).set()
+    cancel_pro_speculation()
+
+# 🔥 [성능] 튜터 채팅 문맥 관리
+# 최근 대화는 토큰 예산 안에서 그대로 넣고, 그보다 오래된 대화는 누적 요약 하나로 접습니다.
+# 요약은 창 밖으로 밀려난 메시지만 이전 요약에 더해 호출 계층의 이벤트 루프에서 갱신하고(전체를 다시 요약하지 않음),
+# 갱신이 끝나기 전에는 밀려난 메시지의 앞부분만 임시로 붙입니다. 해설은 전체 대신 짧은 요약본만 넣습니다.
+CHAT_HISTORY_TOKEN_BUDGET = 1200    # 최근 대화(원문) 예산
+CHAT_RECENT_MAX_MESSAGES = 8
+CHAT_SUMMARY_MAX_CHARS = 500
+CHAT_DIGEST_MAX_CHARS = 600         # 해설 요약본 (정석 + 숏컷)
+CHAT_EXCERPT_CHARS = 80             # 요약 갱신 전 임시 발췌 길이
+CHAT_SUMMARY_BATCH = 6              # 창 밖으로 밀려난 메시지가 이만큼 쌓이면 요약 갱신 (턴마다 호출하지 않음)
+
+def estimate_tokens(text):
+    # 토크나이저 없이 어림: 영문/수식은 ~4바이트, 한글(UTF-8 3바이트)은 ~1글자당 1토큰
+    return len(text.encode("utf-8")) // 3 + 1
+
+def _clip_sentences(text, limit):
+    text = re.sub(r'\s+', ' ', str(text or "")).strip()
+    if len(text) <= limit: return text
+    clipped = text[:limit]
+    cut = max(clipped.rfind(". "), clipped.rfind("$ "))
+    return (clipped[:cut + 1] if cut > limit // 2 else clipped).rstrip() + " …"
+
+def format_chat_lines(messages):
+    return "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+
+def build_chat_summary_prompt(previous_summary, messages):
+    return f"""
+    다음은 수학 튜터링 대화의 [이전 요약]과 그 뒤에 이어진 [새 대화]입니다.
+    학생이 어디서 막혔는지, 선생님이 이미 설명한 내용, 학생이 이해한 것과 아직 헷갈려하는 것을 중심으로
+    요약을 {CHAT_SUMMARY_MAX_CHARS}자 이내의 한국어로 갱신하세요. 요약 문장만 출력하세요.
+
+    [이전 요약]
+    {previous_summary or "(없음)"}
+
+    [새 대화]
+    {format_chat_lines(messages)}
+    """
+
+class ChatContext:
+    def __init__(self):
+        self.summary = ""               # chat_messages[:summarized_upto] 의 누적 요약
+        self.summarized_upto = 0
+        self._pending = None            # (요약에 반영될 끝 위치, Future)
+        self._digest = (None, "")       # (분석 결과, 해설 요약본)
+        self.prompt_sizes = collections.deque(maxlen=100) # 턴별 (프롬프트 토큰, 대화 토큰)
+
+    def _recent_start(self, messages):
+        used, start = 0, len(messages)
+        while start > 0 and len(messages) - start < CHAT_RECENT_MAX_MESSAGES:
+            cost = estimate_tokens(messages[start - 1]['content'])
+            if start < len(messages) and used + cost > CHAT_HISTORY_TOKEN_BUDGET: break
+            used += cost
+            start -= 1
+        return start
+
+    def _absorb(self):
+        if not self._pending or not self._pending[1].done(): return
+        upto, future = self._pending
+        self._pending = None
+        try: summary = future.result().strip()
+        except Exception: summary = ""
+        if summary:
+            self.summary = summary[:CHAT_SUMMARY_MAX_CHARS * 2]
+            self.summarized_upto = upto
+
+    def _refresh_summary(self, messages, recent_start):
+        if self._pending or recent_start - self.summarized_upto < CHAT_SUMMARY_BATCH: return
+        prompt = build_chat_summary_prompt(self.summary, messages[self.summarized_upto:recent_start])
+        cancelled = session_cancel_event().is_set
+        ticket = make_call_ticket(prompt, None, "flash", LLM_PRIORITY_BACKGROUND, current_session_id())
+        async def summarize():
+            # 호출 계층의 이벤트 루프에서 바로 실행 (입장 대기 중에도 워커 스레드를 잡지 않음). 세션이 취소되면 대기·스트림을 함께 끊음
+            text = []
+            async def consume():
+                async for kind, value in astream_content_with_fallback(prompt, None, "flash", ticket=ticket):
+                    if kind == "text": text.append(value)
+                    elif kind == "reset": text.clear()
+            task = asyncio.ensure_future(consume())
+            while not task.done():
+                if cancelled():
+                    task.cancel()
+                    raise CallCancelled()
+                await asyncio.wait({task}, timeout=CANCEL_POLL_SEC)
+            task.result()
+            return "".join(text)
+        self._pending = (recent_start, get_llm_layer().submit(summarize()))
+
+    def solution_digest(self, analysis_result):
+        if not analysis_result: return ""
+        if self._digest[0] is not analysis_result:
+            budget = CHAT_DIGEST_MAX_CHARS
+            solution = _clip_sentences(analysis_result.get('solution'), budget * 2 // 3)
+            shortcut = _clip_sentences(analysis_result.get('shortcut'), budget - len(solution))
+            self._digest = (analysis_result, f"- 정석 풀이(요약): {solution}\n- 숏컷(요약): {shortcut}")
+        return self._digest[1]
+
+    def history_text(self, messages):
+        # [이전 대화 요약] + 최근 대화 원문
+        self._absorb()
+        recent_start = self._recent_start(messages)
+        self._refresh_summary(messages, recent_start)
+        older = [self.summary] if self.summary else []
+        for m in messages[self.summarized_upto:recent_start]:
+            older.append(f"{m['role']}: {_clip_sentences(m['content'], CHAT_EXCERPT_CHARS)}")
+        parts = []
+        if older: parts.append("(이전 대화 요약)\n" + "\n".join(older))
+        parts.append(format_chat_lines(messages[recent_start:]))
+        return "\n".join(parts)
+
+    def record_prompt(self, prompt, history_text):
+        self.prompt_sizes.append((estimate_tokens(prompt), estimate_tokens(history_text)))
+
+    def stats(self):
+        sizes = [p for p, _ in self.prompt_sizes]
+        return {
+            "turns": len(sizes), "last_prompt_tokens": sizes[-1] if sizes else 0,
+            "max_prompt_tokens": max(sizes, default=0), "summarized_messages": self.summarized_upto,
+        }
+
+# 🔥 [성능] 화면 조각(fragment)별 리런
+# 채팅, 문제/판서, 해설 패널, 오답노트 항목을 각각 st.fragment 로 나눠서 그 안의 입력은 해당 조각만 다시 실행합니다.
+# (CSS 주입, 사이드바, 과목 목록, 오답노트 목록 조회는 전체 리런 때만 실행) 조각 사이에 오가는 값은 모두
+# st.session_state 를 통하고, 다른 조각의 화면까지 바뀌어야 하는 동작(해설 공개, Pro 분석)만 전체 리런합니다.
+# 실행 시간은 범위별로 세션에 기록합니다: "app" = 전체 리런, 그 밖에는 조각 이름 (profile_interactions.py 로 비교)
+RUN_TIMING_WINDOW = 50
+
+def record_run_time(scope, elapsed):
+    timings = st.session_state.setdefault('run_timings', {})
+    timings.setdefault(scope, collections.deque(maxlen=RUN_TIMING_WINDOW)).append(elapsed)
+
+def run_timing_stats():
+    return {
+        scope: {"runs": len(samples), "p50_ms": _percentile(samples, 0.5) * 1000, "p95_ms": _percentile(samples, 0.95) * 1000}
+        for scope, samples in st.session_state.get('run_timings', {}).items() if samples
+    }
+
+def finish_run():
+    # 전체 실행과 조각 실행이 정상적으로 끝날 때마다: 공유 상태 저장, 세션 메모리 등록(활동 시각 포함)
+    save_shared_session()
+    track_session_memory()
+
+def in_fragment_run():
+    # 조각만 다시 실행되는 중인지 (전체 실행 안에서 조각 본문이 그려질 때는 False)
+    from streamlit.runtime.scriptrunner import get_script_run_ctx
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return bool(ctx and ctx.fragment_ids_this_run)
+
+def rerun_panel():
+    # 조각 실행 중이면 그 조각만, 전체 실행 중이면(예: 이동 직후 남은 질문에 답한 경우) 전체를 다시 실행
+    if in_fragment_run(): st.rerun(scope="fragment")
+    st.rerun()
+
+def timed_fragment(scope, **fragment_options):
+    # 조각만 다시 실행될 때(조각 안의 상호작용)만 시간을 기록하고 finish_run 을 부릅니다.
+    # 전체 실행 안에서 그려질 때는 본문만 실행 (시간은 "app" 에 포함되고, finish_run 은 스크립트 끝에서 한 번)
+    def decorate(fn):
+        @functools.wraps(fn)
+        def body(*args, **kwargs):
+            if not in_fragment_run(): return fn(*args, **kwargs)
+            started = time.perf_counter()
+            try: result = fn(*args, **kwargs)
+            finally: record_run_time(scope, time.perf_counter() - started)
+            finish_run()
+            return result
+        return st.fragment(body, **fragment_options)
+    return decorate
+
+# 🔥 [운영] 진단 패널 (선택: secrets SHOW_DIAGNOSTICS)
+# 이 세션의 범위별 실행 시간과 채팅 턴별 프롬프트 크기, 프로세스 공용 계층(호출 대기열, 키 스케줄러, 응답 캐시,
+# 이미지 핸들, 시트 Outbox, Pro 선행 생성, 세션 메모리 합계)의 지표를 사이드바에 표시합니다.
+def diagnostics_snapshot():
+    heap = get_session_heap().report()
+    snapshot = {
+        "run_timings": run_timing_stats(),
+        "chat_prompt": st.session_state['chat_context'].stats(),
+        "llm_calls": get_llm_layer().stats(),
+        "key_scheduler": get_key_scheduler().snapshot(),
+        "response_cache": get_response_cache().stats(),
+        "image_handles": get_image_handles().stats(),
+        "session_memory": {k: heap[k] for k in ("pid", "rss_bytes", "sessions", "spills", "totals")}, # 학생별 행은 제외
+    }
+    outbox = get_sheet_outbox()
+    if outbox: snapshot["sheet_outbox"] = outbox.stats()
+    if SPECULATIVE_PRO: snapshot["pro_speculation"] = get_pro_speculator().stats()
+    return snapshot
+
+def render_diagnostics():
+    snapshot = diagnostics_snapshot()
+    prompt = snapshot.pop("chat_prompt")
+    col1, col2 = st.columns(2)
+    col1.metric("채팅 프롬프트 (최근)", f"{prompt['last_prompt_tokens']} tok")
+    col2.metric("채팅 프롬프트 (최대)", f"{prompt['max_prompt_tokens']} tok")
+    st.caption(f"턴 {prompt['turns']}회 · 요약된 메시지 {prompt['summarized_messages']}개")
+    for name, value in snapshot.items():
+        st.caption(name)
+        st.json(value, expanded=False)
+
+    outbox = get_sheet_outbox()
+    if outbox and snapshot["sheet_outbox"]["dead"]:
+        dead = outbox.dead_letters()
+        st.download_button(
+            "⬇️ 실패한 시트 작업 내보내기 (JSON)", json.dumps(dead, ensure_ascii=False, indent=1),
+            file_name="outbox_dead_letters.json", mime="application/json"
+        )
+        if st.button("🔁 실패한 시트 작업 모두 다시 시도"):
+            st.toast(f"{outbox.retry_dead([d['id'] for d in dead])}건을 다시 시도합니다.")
+
 # ----------------------------------------------------------
 # [3] 로그인 & 상태 관리
 # ----------------------------------------------------------
@@ -472,11 +2790,14 @@ if 'is_logged_in' not in st.session_state: st.session_state['is_logged_in'] = Fa
 if 'analysis_result' not in st.session_state: st.session_state['analysis_result'] = None
 if 'gemini_image' not in st.session_state: st.session_state['gemini_image'] = None
 if 'solution_image' not in st.session_state: st.session_state['solution_image'] = None
+if 'post_analysis' not in st.session_state: st.session_state['post_analysis'] = None
 
 if 'chat_active' not in st.session_state: st.session_state['chat_active'] = False
 if 'chat_messages' not in st.session_state: st.session_state['chat_messages'] = []
+if 'chat_context' not in st.session_state: st.session_state['chat_context'] = ChatContext()
 if 'self_note' not in st.session_state: st.session_state['self_note'] = ""
-if 'last_canvas_image' not in st.session_state: st.session_state['last_canvas_image'] = None
+if 'canvas_strokes' not in st.session_state: st.session_state['canvas_strokes'] = None
+if 'canvas_sent' not in st.session_state: st.session_state['canvas_sent'] = None
 if 'enable_canvas' not in st.session_state: st.session_state['enable_canvas'] = False
 if 'saved_timestamp' not in st.session_state: st.session_state['saved_timestamp'] = None 
 if 'last_saved_chat_len' not in st.session_state: st.session_state['last_saved_chat_len'] = 0
@@ -484,22 +2805,19 @@ if 'last_voice_text' not in st.session_state: st.session_state['last_voice_text'
 
 cookie_manager = stx.CookieManager(key="auth_cookie")
 
+# 쿠키 자동 로그인: 쿠키 값은 브라우저 컴포넌트가 응답하면서 생기는 리런에 도착하므로 기다리지 않고 매 실행마다 확인합니다.
+# 확인되면 같은 실행에서 바로 메인 화면으로 넘어갑니다. (인덱스 조회만, 추가 리런 없음)
 if not st.session_state['is_logged_in']:
-    time.sleep(0.1)
     stored_user_id = cookie_manager.get(cookie="mathai_user_id")
     if stored_user_id:
-        df = load_students_from_sheet() 
-        if df is not None and not df.empty:
-            df['id'] = df['id'].astype(str)
-            user_data = df[df['id'] == str(stored_user_id)]
-            if not user_data.empty:
-                st.session_state['is_logged_in'] = True
-                st.session_state['user_name'] = user_data.iloc[0]['name']
-                st.toast(f"👋 {st.session_state['user_name']}님, 어서오세요!")
-                time.sleep(0.5)
-                st.rerun()
+        student = find_student(stored_user_id)
+        if student:
+            st.session_state['is_logged_in'] = True
+            st.session_state['user_name'] = student[1]
+            st.toast(f"👋 {st.session_state['user_name']}님, 어서오세요!")
 
 def login_page():
+    # 로그인에 성공하면 아이디를 돌려줌 (호출 측이 로그인 화면을 지우고 같은 실행에서 메인 화면을 그림)
     st.markdown("<h1 style='text-align: center; color:#f97316;'>🏫 MathAI Pro 로그인</h1>", unsafe_allow_html=True)
     col1, col2, col3 = st.columns([1, 2, 1])
     with col2:
@@ -509,30 +2827,74 @@ def login_page():
         
         if st.button("로그인"):
             with st.spinner("학생 정보를 확인 중입니다..."):
-                df = load_students_from_sheet()
-            if df is not None and not df.empty:
-                df['id'] = df['id'].astype(str)
-                df['pw'] = df['pw'].astype(str).apply(lambda x: x.split('.')[0])
-                
-                user_data = df[df['id'] == user_id]
-                if not user_data.empty and user_data.iloc[0]['pw'] == user_pw:
-                    st.session_state['is_logged_in'] = True
-                    st.session_state['user_name'] = user_data.iloc[0]['name']
-                    cookie_manager.set("mathai_user_id", user_id, expires_at=datetime.datetime.now() + datetime.timedelta(days=7))
-                    st.success("로그인 성공! 이동합니다...")
-                    time.sleep(1)
-                    st.rerun()
-                else: st.error("정보가 일치하지 않습니다.")
-            else: st.error("데이터베이스 연결 실패")
+                student = find_student(user_id)
+            if student is False: st.error("데이터베이스 연결 실패")
+            elif student and student[0] == user_pw:
+                st.session_state['is_logged_in'] = True
+                st.session_state['user_name'] = student[1]
+                return user_id
+            else: st.error("정보가 일치하지 않습니다.")
         st.markdown('</div>', unsafe_allow_html=True)
+    return None
 
 if not st.session_state['is_logged_in']:
-    login_page()
-    st.stop()
+    login_container = st.empty()
+    with login_container.container():
+        logged_in_id = login_page()
+    if not logged_in_id: st.stop()
+    login_container.empty()
+    # 쿠키 설정 컴포넌트는 이번 실행의 화면에 남아야 브라우저에서 실행되므로, 리런하지 않고 그대로 메인 화면을 이어서 그림
+    cookie_manager.set("mathai_user_id", logged_in_id, expires_at=datetime.datetime.now() + datetime.timedelta(days=7))
+
+def attach_shared_session():
+    # 로그인 후 세션마다 한 번: 세션 id 쿠키를 읽거나 새로 발급하고, 탭 id(주소의 ?tab=, 새로고침·재접속에도 유지)를 붙여
+    # 이 탭의 상태 키를 정한 뒤, 공유 저장소에 남은 상태가 있으면 복원
+    store = get_shared_state()
+    if not store or 'state_id' in st.session_state: return
+    browser_id = cookie_manager.get(cookie=SHARED_SESSION_COOKIE)
+    if not browser_id:
+        browser_id = uuid.uuid4().hex
+        cookie_manager.set(SHARED_SESSION_COOKIE, browser_id, key="set_session", expires_at=datetime.datetime.now() + datetime.timedelta(days=7))
+    tab_id = st.query_params.get(SHARED_TAB_PARAM)
+    if not tab_id:
+        tab_id = uuid.uuid4().hex[:12]
+        st.query_params[SHARED_TAB_PARAM] = tab_id
+    st.session_state['state_id'] = f"{browser_id}/{tab_id}"
+    restored = store.load_session(st.session_state['state_id'], st.session_state['user_name'], browser_id)
+    if not restored: return
+    state, image = restored
+    for key in SHARED_SESSION_KEYS:
+        if key in state: st.session_state[key] = state[key]
+    st.session_state['gemini_image'] = image
+    st.session_state['chat_context'] = ChatContext() # 이전 대화 요약은 다음 턴에서 다시 만듦
+    if image is None: st.session_state['chat_active'] = False
+    st.session_state['state_saved_digest'] = shared_session_digest()
+
+def shared_session_digest():
+    image = st.session_state.get('gemini_image')
+    state = json.dumps({key: st.session_state.get(key) for key in SHARED_SESSION_KEYS}, ensure_ascii=False, default=str, sort_keys=True)
+    return hashlib.blake2b(f"{state}|{image.digest if image else ''}".encode("utf-8"), digest_size=16).hexdigest()
+
+def save_shared_session():
+    # 실행이 끝날 때마다 호출: 바뀐 경우에만 공유 저장소에 기록 (st.rerun 으로 끝난 실행의 변경은 다음 실행 끝에서 기록됨)
+    store = get_shared_state()
+    if not store or 'state_id' not in st.session_state: return
+    digest = shared_session_digest()
+    if digest == st.session_state.get('state_saved_digest'): return
+    store.save_session(
+        st.session_state['state_id'], st.session_state['user_name'],
+        {key: st.session_state.get(key) for key in SHARED_SESSION_KEYS}, st.session_state.get('gemini_image')
+    )
+    st.session_state['state_saved_digest'] = digest
+
+attach_shared_session()
 
 # ----------------------------------------------------------
 # [4] UI & 기능
 # ----------------------------------------------------------
+start_record_migration()
+start_solution_image_prefetch()
+
 st.markdown("""
 <header class="sticky top-0 z-50 bg-white border-b border-gray-200 px-6 py-3 shadow-sm mb-6">
     <div class="max-w-[1440px] mx-auto flex items-center justify-between">
@@ -557,21 +2919,44 @@ with st.sidebar:
 
     st.markdown(f"### 👋 반가워요, {st.session_state['user_name']}님!")
     menu = st.radio("학습 메뉴", ["📸 문제 풀기", "📒 내 오답 노트"])
+
+    # 시트 저장이 끝내 실패한 이 학생의 기록: 조용히 쌓아 두지 않고 알리고 다시 시도할 수 있게 함
+    sheet_outbox = get_sheet_outbox()
+    dead_letters = sheet_outbox.dead_letters(st.session_state['user_name']) if sheet_outbox else []
+    if dead_letters:
+        st.warning(f"⚠️ 시트에 저장하지 못한 학습 기록이 {len(dead_letters)}건 있습니다.")
+        if st.button("🔁 저장 다시 시도"):
+            sheet_outbox.retry_dead([d["id"] for d in dead_letters])
+            st.toast("저장을 다시 시도합니다.", icon="💾")
+            st.rerun()
+
+    if SHOW_DIAGNOSTICS:
+        with st.expander("📊 진단 정보", expanded=False):
+            render_diagnostics()
     
     if st.button("🔄 초기화 (새 문제)"):
+        cancel_session_calls()
         st.session_state['chat_active'] = False
         st.session_state['chat_messages'] = []
+        st.session_state['chat_context'] = ChatContext()
         st.session_state['analysis_result'] = None
         st.session_state['gemini_image'] = None
-        st.session_state['last_canvas_image'] = None
+        st.session_state['canvas_strokes'] = None
+        st.session_state['canvas_sent'] = None
         st.session_state['self_note'] = ""
         st.session_state['enable_canvas'] = False
         st.session_state['saved_timestamp'] = None
         st.session_state['last_saved_chat_len'] = 0
         st.session_state['last_voice_text'] = ""
+        st.session_state['post_analysis'] = None
+        st.session_state['solution_image'] = None
         st.rerun()
         
     if st.button("로그아웃"):
+        cancel_session_calls()
+        if 'state_id' in st.session_state:
+            get_shared_state().delete_browser_sessions(st.session_state.pop('state_id').split("/")[0])
+            if cookie_manager.get(cookie=SHARED_SESSION_COOKIE): cookie_manager.delete(SHARED_SESSION_COOKIE, key="delete_session")
         cookie_manager.delete("mathai_user_id") 
         st.session_state['is_logged_in'] = False
         st.success("✅ 로그아웃 되었습니다. 브라우저를 새로고침(F5) 해주세요.")
@@ -619,18 +3004,20 @@ if menu == "📸 문제 풀기":
                     if cam: img_file = cam
 
             if img_file:
-                image = Image.open(img_file)
-                if image.mode in ("RGBA", "P"): image = image.convert("RGB")
-                st.image(image, caption="선택한 문제", use_column_width=True)
+                problem_image = ingest_problem_image(img_file)
+                st.image(problem_image.data, caption="선택한 문제", use_column_width=True)
                 st.markdown("<br>", unsafe_allow_html=True)
                 
                 if st.button("💬 AI 튜터링 시작", type="primary"):
-                    st.session_state['gemini_image'] = resize_image(image)
+                    cancel_session_calls()
+                    st.session_state['gemini_image'] = problem_image
                     st.session_state['selected_subject'] = selected_subject
                     st.session_state['chat_active'] = True
+                    st.session_state['chat_context'] = ChatContext()
                     st.session_state['chat_messages'] = [
                         {"role": "ai", "content": "문제를 확인했습니다. 같이 차근차근 풀어봅시다. 어디서 막혔나요?"}
                     ]
+                    if selected_subject in SPECULATIVE_PRO_SUBJECTS: start_pro_speculation()
                     st.rerun()
             st.markdown('</div>', unsafe_allow_html=True)
         
@@ -648,334 +3035,308 @@ if menu == "📸 문제 풀기":
         
         with chat_col_left:
             st.markdown('<div class="math-card">', unsafe_allow_html=True)
-            col_title, col_toggle = st.columns([0.6, 0.4])
-            with col_title:
-                st.markdown('<h3 class="font-bold mb-2 text-slate-700">📄 문제 & 질문</h3>', unsafe_allow_html=True)
-            with col_toggle:
-                st.session_state['enable_canvas'] = st.checkbox("🖍️ 판서(그리기) 모드", value=st.session_state['enable_canvas'])
-
-            if st.session_state['gemini_image']:
-                if st.session_state['enable_canvas']:
-                    orig_w, orig_h = st.session_state['gemini_image'].size
-                    canvas_width = 500
-                    canvas_height = int(orig_h * (canvas_width / orig_w))
+
+            @timed_fragment("problem") # 판서 획(update_streamlit)과 판서 모드 전환은 이 조각만 다시 실행
+            def problem_panel():
+                col_title, col_toggle = st.columns([0.6, 0.4])
+                with col_title:
+                    st.markdown('<h3 class="font-bold mb-2 text-slate-700">📄 문제 & 질문</h3>', unsafe_allow_html=True)
+                with col_toggle:
+                    st.session_state['enable_canvas'] = st.checkbox("🖍️ 판서(그리기) 모드", value=st.session_state['enable_canvas'])
+
+                if st.session_state['gemini_image']:
+                    if st.session_state['enable_canvas']:
+                        orig_w, orig_h = st.session_state['gemini_image'].size
+                        canvas_width = 500
+                        canvas_height = int(orig_h * (canvas_width / orig_w))
                     
-                    canvas_result = st_canvas(
-                        fill_color="rgba(255, 165, 0, 0.3)",
-                        stroke_width=3,
-                        stroke_color="#ff0000",
-                        background_image=st.session_state['gemini_image'],
-                        update_streamlit=True,
-                        height=canvas_height,
-                        width=canvas_width,
-                        drawing_mode="freedraw",
-                        key="canvas",
-                    )
+                        from streamlit_drawable_canvas import st_canvas
+                        canvas_result = st_canvas(
+                            fill_color="rgba(255, 165, 0, 0.3)",
+                            stroke_width=3,
+                            stroke_color="#ff0000",
+                            background_image=st.session_state['gemini_image'].image,
+                            update_streamlit=True,
+                            height=canvas_height,
+                            width=canvas_width,
+                            drawing_mode="freedraw",
+                            key="canvas",
+                        )
                     
-                    if canvas_result.image_data is not None:
-                        st.session_state['last_canvas_image'] = canvas_result.image_data
-                else:
-                    st.image(st.session_state['gemini_image'], use_column_width=True)
+                        if canvas_result.image_data is not None:
+                            st.session_state['canvas_strokes'] = canvas_strokes(canvas_result.json_data, canvas_result.image_data, st.session_state['canvas_strokes'])
+                    else:
+                        st.image(st.session_state['gemini_image'].data, use_column_width=True)
 
+            problem_panel()
             st.markdown("---")
+
+            @timed_fragment("chat") # 메시지 입력·답변 생성은 이 조각만 다시 실행
+            def chat_panel():
+                st.markdown('<div class="h-[400px] overflow-y-auto flex flex-col relative">', unsafe_allow_html=True)
+                for msg in st.session_state['chat_messages']:
+                    if msg['role'] == 'ai':
+                        with st.chat_message("assistant", avatar="🤖"):
+                            st.write(msg['content'])
+                    else:
+                        with st.chat_message("user", avatar="🧑‍🎓"):
+                            st.write(msg['content'])
+
+                if st.session_state['analysis_result'] and st.session_state['saved_timestamp']:
+                    if len(st.session_state['chat_messages']) > st.session_state['last_saved_chat_len']:
+                        if st.button("💾 추가된 대화 저장하기", type="secondary", use_container_width=True):
+                            if update_chat_log_in_sheet(st.session_state['user_name'], st.session_state['saved_timestamp'], st.session_state['chat_messages']):
+                                st.session_state['last_saved_chat_len'] = len(st.session_state['chat_messages'])
+                                st.toast("대화 내용이 업데이트되었습니다!", icon="✅")
+                            else:
+                                st.error("저장 실패")
+
+                col_mic, col_text = st.columns([0.1, 0.9])
+                with col_mic:
+                    # 🎤 [복구] 마이크 버튼
+                    from streamlit_mic_recorder import speech_to_text
+                    voice_text = speech_to_text(language='ko', start_prompt="🎤", stop_prompt="⏹️", just_once=False, use_container_width=True)
             
-            st.markdown('<div class="h-[400px] overflow-y-auto flex flex-col relative">', unsafe_allow_html=True)
-            for msg in st.session_state['chat_messages']:
-                if msg['role'] == 'ai':
-                    with st.chat_message("assistant", avatar="🤖"):
-                        st.write(msg['content'])
-                else:
-                    with st.chat_message("user", avatar="🧑‍🎓"):
-                        st.write(msg['content'])
-
-            if st.session_state['analysis_result'] and st.session_state['saved_timestamp']:
-                if len(st.session_state['chat_messages']) > st.session_state['last_saved_chat_len']:
-                    if st.button("💾 추가된 대화 저장하기", type="secondary", use_container_width=True):
-                        if update_chat_log_in_sheet(st.session_state['user_name'], st.session_state['saved_timestamp'], st.session_state['chat_messages']):
-                            st.session_state['last_saved_chat_len'] = len(st.session_state['chat_messages'])
-                            st.toast("대화 내용이 업데이트되었습니다!", icon="✅")
-                        else:
-                            st.error("저장 실패")
-
-            col_mic, col_text = st.columns([0.1, 0.9])
-            with col_mic:
-                # 🎤 [복구] 마이크 버튼
-                voice_text = speech_to_text(language='ko', start_prompt="🎤", stop_prompt="⏹️", just_once=False, use_container_width=True)
-            
-            with col_text:
-                chat_input_text = st.chat_input("질문을 입력하세요")
+                with col_text:
+                    chat_input_text = st.chat_input("질문을 입력하세요")
             
-            final_prompt = None
-            if voice_text and voice_text != st.session_state['last_voice_text']:
-                final_prompt = voice_text
-                st.session_state['last_voice_text'] = voice_text 
-            elif chat_input_text:
-                final_prompt = chat_input_text
-
-            if final_prompt:
-                st.session_state['chat_messages'].append({"role": "user", "content": final_prompt})
-                st.rerun()
-
-            if st.session_state['chat_messages'] and st.session_state['chat_messages'][-1]['role'] == 'user':
-                with st.spinner("선생님이 답변을 생각 중입니다..."):
-                    try:
-                        history_text = "\n".join([f"{m['role']}: {m['content']}" for m in st.session_state['chat_messages']])
+                final_prompt = None
+                if voice_text and voice_text != st.session_state['last_voice_text']:
+                    final_prompt = voice_text
+                    st.session_state['last_voice_text'] = voice_text 
+                elif chat_input_text:
+                    final_prompt = chat_input_text
+
+                if final_prompt:
+                    st.session_state['chat_messages'].append({"role": "user", "content": final_prompt})
+                    rerun_panel()
+
+                replied = False
+                if st.session_state['chat_messages'] and st.session_state['chat_messages'][-1]['role'] == 'user':
+                    with st.chat_message("assistant", avatar="🤖"):
+                        text_placeholder = st.empty()
+                        text_placeholder.markdown("💭 선생님이 답변을 생각 중입니다...")
+                        try:
+                            chat_context = st.session_state['chat_context']
+                            history_text = chat_context.history_text(st.session_state['chat_messages'])
                         
-                        context_injection = ""
-                        if st.session_state['analysis_result']:
-                            res = st.session_state['analysis_result']
-                            context_injection = f"""
-                            [참고: 너는 이미 이 문제의 정석 풀이와 숏컷을 학생에게 알려주었어.]
-                            - 정석 풀이: {res.get('solution')}
-                            - 숏컷 풀이: {res.get('shortcut')}
-                            학생이 이 풀이에 대해 추가 질문을 하고 있으니, 위 내용을 바탕으로 답변해줘.
-                            """
-
-                        # 🔥 [Chatbot 프롬프트 수정: 정석 + 손글씨 인식]
-                        tutor_prompt = f"""
-                        당신은 친절하지만 **교과서적인 풀이를 중시하는** 학교 수학 선생님입니다. 
-                        과목: {st.session_state['selected_subject']}
+                            img_to_send, canvas_note = st.session_state['gemini_image'], ""
+                            if st.session_state['enable_canvas']:
+                                img_to_send, canvas_note, st.session_state['canvas_sent'] = canvas_images_for_chat(
+                                    st.session_state['gemini_image'], st.session_state['canvas_strokes'], st.session_state['canvas_sent']
+                                )
+
+                            context_injection = ""
+                            if st.session_state['analysis_result']:
+                                context_injection = f"""
+                                [참고: 너는 이미 이 문제의 정석 풀이와 숏컷을 학생에게 알려주었어.]
+                                {chat_context.solution_digest(st.session_state['analysis_result'])}
+                                학생이 이 풀이에 대해 추가 질문을 하고 있으니, 위 내용을 바탕으로 답변해줘.
+                                """
+
+                            # 🔥 [Chatbot 프롬프트 수정: 정석 + 손글씨 인식]
+                            tutor_prompt = f"""
+                            당신은 친절하지만 **교과서적인 풀이를 중시하는** 학교 수학 선생님입니다. 
+                            과목: {st.session_state['selected_subject']}
                         
-                        **[손글씨 인식 지침]**
-                        이미지 내에 손으로 쓴 글씨가 있다면 그것은 학생의 '풀이 시도'입니다. 
-                        문제를 인식할 때는 인쇄된 텍스트를 기준으로 하고, 학생의 손글씨는 '학생이 어디서 막혔는지' 파악하는 용도로만 사용하십시오.
+                            **[손글씨 인식 지침]**
+                            이미지 내에 손으로 쓴 글씨가 있다면 그것은 학생의 '풀이 시도'입니다. 
+                            문제를 인식할 때는 인쇄된 텍스트를 기준으로 하고, 학생의 손글씨는 '학생이 어디서 막혔는지' 파악하는 용도로만 사용하십시오.
+                            {canvas_note}
                         
-                        {context_injection}
+                            {context_injection}
 
-                        [대화 내역] 
-                        {history_text}
+                            [대화 내역] 
+                            {history_text}
                         
-                        [지시사항]
-                        1. 학생이 먼저 묻지 않는 한, **'숏컷'이나 '로피탈', '변곡점' 같은 기술은 절대 먼저 꺼내지 마세요.**
-                        2. 교과서에 나오는 **정석적인 방법(증감표, 정의 등)**으로만 설명하세요.
-                        3. 수식은 LaTeX($$)를 사용하고, 답변은 3문장 이내로 간결하게 하세요.
-                        """
+                            [지시사항]
+                            1. 학생이 먼저 묻지 않는 한, **'숏컷'이나 '로피탈', '변곡점' 같은 기술은 절대 먼저 꺼내지 마세요.**
+                            2. 교과서에 나오는 **정석적인 방법(증감표, 정의 등)**으로만 설명하세요.
+                            3. 수식은 LaTeX($$)를 사용하고, 답변은 3문장 이내로 간결하게 하세요.
+                            """
                         
-                        img_to_send = st.session_state['gemini_image']
-                        if st.session_state['enable_canvas'] and st.session_state.get('last_canvas_image') is not None:
-                            img_array = st.session_state['last_canvas_image'].astype('uint8')
-                            img_to_send = Image.fromarray(img_array, 'RGBA').convert('RGB')
-
-                        response_text, _ = generate_content_with_fallback(tutor_prompt, img_to_send, mode="flash")
-                        st.session_state['chat_messages'].append({"role": "ai", "content": response_text})
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"채팅 오류: {e}")
-            st.markdown('</div></div>', unsafe_allow_html=True)
+                            chat_context.record_prompt(tutor_prompt, history_text)
+                            response_text, _ = generate_content_with_fallback(
+                                tutor_prompt, img_to_send, mode="flash", text_placeholder=text_placeholder, priority=LLM_PRIORITY_CHAT
+                            )
+                            st.session_state['chat_messages'].append({"role": "ai", "content": response_text})
+                            replied = True
+                        except Exception as e:
+                            st.error(f"채팅 오류: {e}")
+                if replied: rerun_panel()
+                st.markdown('</div></div>', unsafe_allow_html=True)
+
+            chat_panel()
 
         with chat_col_right:
-            st.markdown('<div class="math-card" style="border-left: 5px solid #f97316;">', unsafe_allow_html=True)
-            st.markdown('<h3 class="font-bold mb-2 text-[#f97316]">✍️ 나의 깨달음 정리 (Self-Note)</h3>', unsafe_allow_html=True)
-            st.markdown('<p class="text-xs text-slate-500 mb-2">선생님과 대화하며 알게 된 힌트나 핵심을 적어보세요. (나중에 오답노트에 저장됩니다)</p>', unsafe_allow_html=True)
+            @timed_fragment("analysis") # Self-Note 저장, 쌍둥이 문제 정답 보기 등은 이 조각만 다시 실행
+            def analysis_panel():
+                st.markdown('<div class="math-card" style="border-left: 5px solid #f97316;">', unsafe_allow_html=True)
+                st.markdown('<h3 class="font-bold mb-2 text-[#f97316]">✍️ 나의 깨달음 정리 (Self-Note)</h3>', unsafe_allow_html=True)
+                st.markdown('<p class="text-xs text-slate-500 mb-2">선생님과 대화하며 알게 된 힌트나 핵심을 적어보세요. (나중에 오답노트에 저장됩니다)</p>', unsafe_allow_html=True)
             
-            self_note_input = st.text_area("내용 입력", value=st.session_state['self_note'], height=150, label_visibility="collapsed", placeholder="예: 판별식 D가 0보다 커야 실근 2개를 갖는다는 걸 깜빡했다.")
-            if st.button("💾 정리 내용 임시 저장"):
-                st.session_state['self_note'] = self_note_input
-                st.toast("정리 내용이 저장되었습니다.")
-            st.markdown('</div>', unsafe_allow_html=True)
-
-            # 🔥 [안전장치] Self-Note 중괄호 이스케이프 (오류 방지)
-            safe_self_note = st.session_state['self_note'].replace("{", "{{").replace("}", "}}")
-
-            if not st.session_state['analysis_result']:
-                st.info("💡 충분히 고민하고 정리를 마쳤다면, 아래 버튼을 눌러 해설을 확인하세요.")
-                if st.button("🔐 정답 및 풀이 공개 (저장)", type="primary"):
-                    with st.spinner("1타 강사 해설 및 쌍둥이 문제를 생성하고 저장 중입니다..."):
-                        
-                        # 🔥 [Flash 프롬프트: EBS 수능특강 해설지 로봇 + 손글씨 인식]
-                        curriculum_rules = get_curriculum_prompt(st.session_state['selected_subject'])
-                        
-                        final_prompt_main = f"""
-                        당신은 감정이 없는 **'평가원 정답지 작성 알고리즘(Standard Answer Generator)'**입니다. (과목: {st.session_state['selected_subject']})
-                        이미지를 분석하여 다음 항목을 작성하십시오.
-
-                        **[0. 이미지 인식 지침 (Handwriting Filtering)]**
-                        - 이미지 내의 **'인쇄된 텍스트(Problem)'**와 **'손글씨(Student's Work)'**를 엄격히 구분하십시오.
-                        - **[풀이 작성 시]:** 오직 '인쇄된 문제'를 기준으로 정석 풀이를 작성하십시오. 손글씨는 무시하십시오.
-                        - **[첨삭 작성 시]:** '손글씨'를 분석하여 학생이 어느 과정에서 틀렸는지 구체적으로 지적하십시오.
-
-                        **[학생의 Self-Note]**
-                        {safe_self_note}
-                        (이 내용도 참고하여 첨삭을 넣어주세요.)
-
-                        **[1. 교육과정 준수 및 스타일 (Grade-Lock)]**
-                        {curriculum_rules}
-                        - **[No Chat]:** '살펴봅시다', '알 수 있습니다', '이므로', '따라서' 등의 **구어체 및 접속사 절대 금지.**
-                        - **[Symbol Only]:** 문장 대신 화살표($\\rightarrow$, $\\Rightarrow$)와 논리 기호($\\because$, $\\therefore$)만 사용.
-                        - **[Ending]:** 모든 문장은 명사형(~임, ~함)으로 끝내거나 수식으로 종료.
-                        - **[Structure]:** 풀이 과정을 의미 단위로 끊어서 `[Step 1]`, `[Step 2]`로 줄바꿈.
-
-                        **[2. 숏컷 필수 체크리스트 (Priority Check)]**
-                        아래 리스트는 **반드시 체크해야 할 대표적인 예시**이며, 리스트에 없더라도 해당 단원의 숏컷이 있다면 적극적으로 사용하십시오.
-                        적용 가능한 기술은 **오직 [2] 숏컷 풀이**에만 반영하십시오.
-                        ⚠️ **주의: 숏컷 기술들은 [1] 정석 풀이에는 절대 사용하지 마십시오. (감점 요인임)**
-                        1. **[다항함수]** 3차/4차함수 비율 관계(2:1, 3:1), 넓이 공식(1/6, 1/12), 높이차 공식, 변곡점 대칭성.
-                        2. **[수열/극한]** 등차수열 합의 기하학적 해석(상수항 없는 2차함수), 등비수열=지수함수, 테일러 근사($\\sin x \\approx x$).
-                        3. **[미분/적분]** 이차함수 두 점 사이 기울기(=중점의 미분계수), 로피탈.
-                        4. **[삼각/기하]** 사인법칙(지름의 지배), 코사인법칙(피타고라스 보정), 신발끈 공식, 파푸스 중선정리.
-                        5. **[확통/경우의 수]** 같은 것이 있는 순열, 정규분포 대칭성 활용, 중복조합 H 공식 직결.
-
-                        **[출력 형식]**
-                        ===CONCEPT===
-                        (핵심 개념 한 줄)
-                        ===HINT===
-                        (결정적 힌트 1줄)
-                        ===SOLUTION===
-                        (### 📖 [1] 정석 풀이
-                        **[주의]**: 위 [서술형 표준 프로토콜]을 철저히 지키며, 교과서적인 서술형 풀이 작성.)
-                        ===SHORTCUT===
-                        (### 🍯 [2] 숏컷 풀이 (Skill)
-                        위 [필수 체크 리스트]를 활용한 수능 실전 기술 분석가의 시선으로 작성.)
-                        ===CORRECTION===
-                        (학생의 노트와 **이미지 속 손글씨 풀이**에 대한 **[메타인지 피드백]**을 작성하십시오.
-                        1. 오류 진단: **[단순 계산 / 개념 오적용 / 조건 누락 / 발문 독해]** 중 원인을 분류.
-                        2. 칭찬과 지적: 학생의 사고 중 맞는 부분은 인정하고, 논리가 꼬인 '결정적 분기점'을 지적.
-                        3. 행동 지침: "다음에는 문제의 OOO 단어에 동그라미를 치세요" 같은 구체적 행동 제시.)
-                        ===TWIN_PROBLEM===
-                        (숫자 변형 유사 문제 1개. LaTeX 사용)
-                        ===TWIN_ANSWER===
-                        (정답 및 간단 풀이)
-                        """
-                        try:
-                            res_text, _ = generate_content_with_fallback(final_prompt_main, st.session_state['gemini_image'], mode="flash", status_container=None, text_placeholder=None)
-                            
-                            data = parse_response_to_dict(res_text)
-                            data['my_self_note'] = st.session_state['self_note']
-                            
-                            st.session_state['analysis_result'] = data
+                self_note_input = st.text_area("내용 입력", value=st.session_state['self_note'], height=150, label_visibility="collapsed", placeholder="예: 판별식 D가 0보다 커야 실근 2개를 갖는다는 걸 깜빡했다.")
+                if st.button("💾 정리 내용 임시 저장"):
+                    st.session_state['self_note'] = self_note_input
+                    st.toast("정리 내용이 저장되었습니다.")
+                st.markdown('</div>', unsafe_allow_html=True)
+
+                # 🔥 [안전장치] Self-Note 중괄호 이스케이프 (오류 방지)
+                safe_self_note = st.session_state['self_note'].replace("{", "{{").replace("}", "}}")
+
+                if not st.session_state['analysis_result']:
+                    st.info("💡 충분히 고민하고 정리를 마쳤다면, 아래 버튼을 눌러 해설을 확인하세요.")
+                    if st.button("🔐 정답 및 풀이 공개 (저장)", type="primary"):
+                        stream_placeholder = st.empty()
+                        early = {} # HINT 섹션이 끝나는 즉시 시작한 이미지 파이프라인 (저장 시각은 나중에 전달)
+
+                        def on_section(tag, text):
+                            if tag == "HINT" and not early:
+                                early['hint'], early['saved'] = text, concurrent.futures.Future()
+                                early['pipeline'] = start_post_analysis_pipeline(
+                                    st.session_state['gemini_image'], text, st.session_state['user_name'], early['saved']
+                                )
+
+                        with st.spinner("1타 강사 해설 및 쌍둥이 문제를 생성하고 저장 중입니다..."):
+                            try:
+                                final_prompt_main = build_main_prompt(st.session_state['selected_subject'], safe_self_note)
+                                data, cache_hit = generate_analysis(
+                                    st.session_state['selected_subject'], st.session_state['gemini_image'], safe_self_note, "flash", final_prompt_main,
+                                    text_placeholder=stream_placeholder, on_section=on_section
+                                )
+                                if cache_hit: st.toast("⚡ 같은 문제의 해설을 바로 불러왔습니다.")
+                                data['my_self_note'] = st.session_state['self_note']
                             
-                            st.session_state['solution_image'] = create_solution_image(
-                                st.session_state['gemini_image'], data.get('hint_for_image', '힌트 없음')
-                            )
-                            img_byte_arr = io.BytesIO()
-                            st.session_state['solution_image'].save(img_byte_arr, format='JPEG', quality=90)
-                            link = upload_to_imgbb(img_byte_arr.getvalue()) or "이미지_없음"
+                                st.session_state['analysis_result'] = data
                             
-                            saved_ts = save_result_to_sheet(
-                                st.session_state['user_name'], 
-                                st.session_state['selected_subject'], 
-                                data.get('concept'), 
-                                data, 
-                                link,
-                                st.session_state['chat_messages']
-                            )
-                            st.session_state['saved_timestamp'] = saved_ts
-                            st.session_state['last_saved_chat_len'] = len(st.session_state['chat_messages'])
+                                # 해설은 바로 표시하고, 이미지 렌더링/업로드/링크 갱신은 백그라운드 파이프라인에서 진행
+                                saved_ts = save_result_to_sheet(
+                                    st.session_state['user_name'], 
+                                    st.session_state['selected_subject'], 
+                                    data.get('concept'), 
+                                    data, 
+                                    "이미지_없음",
+                                    st.session_state['chat_messages']
+                                )
+                                st.session_state['saved_timestamp'] = saved_ts
+                                st.session_state['last_saved_chat_len'] = len(st.session_state['chat_messages'])
+                                st.session_state['solution_image'] = None
+                                hint = data.get('hint_for_image', '힌트 없음')
+                                if early and early['hint'] == hint:
+                                    early['saved'].set_result(saved_ts)
+                                    st.session_state['post_analysis'] = early['pipeline']
+                                else: # 스트림이 다른 모델로 다시 시작되어 힌트가 달라진 경우 등
+                                    st.session_state['post_analysis'] = start_post_analysis_pipeline(
+                                        st.session_state['gemini_image'], hint, st.session_state['user_name'], saved_ts
+                                    )
+                                start_pro_speculation()
                             
-                            st.rerun()
-                        except Exception as e:
-                            st.error(f"분석 오류: {e}")
+                                st.rerun()
+                            except Exception as e:
+                                st.error(f"분석 오류: {e}")
+                            finally:
+                                if early and not early['saved'].done(): early['saved'].set_result(None) # 쓰지 않는 파이프라인은 링크를 갱신하지 않음
 
-            if st.session_state['analysis_result']:
-                res = st.session_state['analysis_result']
-                st.success("🎉 분석 완료! 오답노트에 저장되었습니다.")
+                if st.session_state['analysis_result']:
+                    res = st.session_state['analysis_result']
+                    st.success("🎉 분석 완료! 오답노트에 저장되었습니다.")
                 
-                with st.expander("📘 상세 풀이 & 숏컷", expanded=True):
-                    st.markdown(f"**핵심 개념:** {res.get('concept')}")
-                    st.markdown("---")
-                    st.markdown(res.get('solution').replace('\n', '  \n'))
-                    st.markdown("---")
-                    st.info(f"⚡ **숏컷:** {res.get('shortcut')}")
-                    
-                    if res.get('correction') and res.get('correction') != "첨삭 없음":
+                    with st.expander("📘 상세 풀이 & 숏컷", expanded=True):
+                        st.markdown(f"**핵심 개념:** {res.get('concept')}")
                         st.markdown("---")
-                        st.markdown(f"**📝 첨삭 지도:**\n{res.get('correction').replace(chr(10), '  '+chr(10))}")
-
-                with st.expander("📝 쌍둥이 문제 확인", expanded=True):
-                    st.write(res.get('twin_problem'))
-                    if st.button("정답 보기"):
-                        st.write(res.get('twin_answer'))
-
-                if st.session_state['solution_image']:
-                    st.image(st.session_state['solution_image'], caption="오답노트 이미지", use_column_width=True)
+                        st.markdown(res.get('solution').replace('\n', '  \n'))
+                        st.markdown("---")
+                        st.info(f"⚡ **숏컷:** {res.get('shortcut')}")
+                    
+                        if res.get('correction') and res.get('correction') != "첨삭 없음":
+                            st.markdown("---")
+                            st.markdown(f"**📝 첨삭 지도:**\n{res.get('correction').replace(chr(10), '  '+chr(10))}")
+
+                    with st.expander("📝 쌍둥이 문제 확인", expanded=True):
+                        st.write(res.get('twin_problem'))
+                        if st.button("정답 보기"):
+                            st.write(res.get('twin_answer'))
+
+                    def solution_image_panel():
+                        pipeline = st.session_state.get('post_analysis')
+                        if pipeline and st.session_state['solution_image'] is None:
+                            if pipeline['encode'].done():
+                                if pipeline['encode'].exception() is None:
+                                    st.session_state['solution_image'] = SessionBlob(pipeline['encode'].result())
+                                st.session_state['post_analysis'] = None # 렌더링 결과(PIL)를 쥐고 있는 Future 들을 놓아 줌
+                                st.rerun() # 완료 → 자동 새로고침 fragment 종료
+                            st.caption("🖼️ 오답노트 이미지를 만드는 중입니다...")
+                        if st.session_state['solution_image']:
+                            st.image(st.session_state['solution_image'].get(), caption="오답노트 이미지", use_column_width=True)
+
+                    if st.session_state.get('post_analysis') and st.session_state['solution_image'] is None:
+                        st.fragment(run_every=1.0)(solution_image_panel)()
+                    else:
+                        solution_image_panel()
 
-                st.markdown("---")
+                    st.markdown("---")
                 
-                # 🔥 [Pro 분석 표시 구역]
-                if 'pro_solution' in res:
-                    st.markdown("### 🧠 Pro 심화 분석")
-                    with st.expander("🦅 심화 풀이 & 기하학적 통찰", expanded=True):
-                        st.markdown(f"**심화 개념:** {res.get('pro_concept')}")
-                        st.markdown("---")
-                        st.markdown(res.get('pro_solution').replace('\n', '  \n'))
-                        st.info(f"⚡ **Pro 숏컷:** {res.get('pro_shortcut')}")
-                        if res.get('pro_correction'):
+                    # 🔥 [Pro 분석 표시 구역]
+                    if 'pro_solution' in res:
+                        st.markdown("### 🧠 Pro 심화 분석")
+                        with st.expander("🦅 심화 풀이 & 기하학적 통찰", expanded=True):
+                            st.markdown(f"**심화 개념:** {res.get('pro_concept')}")
                             st.markdown("---")
-                            st.markdown(f"**📝 심층 피드백:**\n{res.get('pro_correction')}")
+                            st.markdown(res.get('pro_solution').replace('\n', '  \n'))
+                            st.info(f"⚡ **Pro 숏컷:** {res.get('pro_shortcut')}")
+                            if res.get('pro_correction'):
+                                st.markdown("---")
+                                st.markdown(f"**📝 심층 피드백:**\n{res.get('pro_correction')}")
                 
-                # Pro 분석 요청 버튼 (아직 안 했으면 표시)
-                else:
-                    if st.button("🚨 고난도 심화 분석 요청 (Pro 모델)", type="secondary"):
-                        # 🔥 [안전장치 2] Pro 버튼에도 self_note 이스케이프 적용 (변수 순서 수정 완료)
-                        safe_self_note_pro = st.session_state['self_note'].replace("{", "{{").replace("}", "}}")
+                    # Pro 분석 요청 버튼 (아직 안 했으면 표시)
+                    else:
+                        speculation = None
+                        if SPECULATIVE_PRO:
+                            speculation = get_pro_speculator().peek(current_session_id(), st.session_state['gemini_image'], st.session_state['self_note'])
+                            if speculation and speculation.done() and speculation.exception() is None:
+                                st.caption("⚡ Pro 심화 분석이 준비되어 있습니다.")
+                        if st.button("🚨 고난도 심화 분석 요청 (Pro 모델)", type="secondary"):
+                            # 🔥 [안전장치 2] Pro 버튼에도 self_note 이스케이프 적용 (변수 순서 수정 완료)
+                            safe_self_note_pro = st.session_state['self_note'].replace("{", "{{").replace("}", "}}")
                         
-                        with st.spinner("Pro 모델이 문제를 깊게 분석하고 재작성 중입니다... (약 15초 소요)"):
-                            # 🔥 [Pro 프롬프트: 수능 해커 + 손글씨 인식 + 무제한 스킬] 
-                            final_prompt_pro = f"""
-                            당신은 대한민국 수학계의 정점, '수능 해커'입니다.
-                            학생이 **[고난도 심화 분석]**을 요청했습니다. 
-                            단순한 공식 암기나 계산 노동을 넘어, **문제의 구조를 꿰뚫는 가장 짧은 길**을 제시하십시오.
-
-                            **[0. 이미지 인식 지침 (Handwriting Filtering)]**
-                            - 이미지 내의 **'인쇄된 텍스트(Problem)'**와 **'손글씨(Student's Work)'**를 엄격히 구분하십시오.
-                            - 문제를 풀 때는 오직 '인쇄된 텍스트'에 집중하십시오.
-                            - 단, `===CORRECTION===` 파트에서는 학생의 손글씨 풀이를 분석하여 어떤 사고 과정에서 막혔는지 간파하십시오.
-
-                            **[Deep Insight Protocol: 압도적 단축]**
-                            **[핵심 지침]:** 교과서적인 서술을 배제하고, **가장 '무자비(Ruthless)'하고 효율적인 '전략적 단축(Strategic Shortcut)'**과 **'직관(Intuitive Insight)'**만 사용하여 답을 찍어내십시오.
-                            아래 리스트는 **대표적인 예시**일 뿐입니다. 리스트에 없더라도 이 문제를 가장 빠르고 충격적으로 풀 수 있는 당신만의 비기(Hidden Skill)나 상위 개념이 있다면 **제한 없이** 사용하십시오.
-
-                            1. **Regression to Basics (중학 기하의 힘):** 고등 미적분 문제라도 **중학교 도형의 성질(닮음, 합동, 원주각, 대칭성)**로 풀면 계산이 0이 되는 경우가 많습니다. 이를 최우선으로 탐색하십시오.
-                            2. **[특수성 우선의 법칙 (Graph Traits)]:** 일반적인 식 계산 전에, 그래프가 **접하거나(Tangency), 대칭(Symmetry)이거나, 변곡점**을 지나는 특수한 상황인지 먼저 의심하십시오. 답은 99% 그곳에 있습니다.
-                            3. **[차(Difference) 함수 해석]:** $f(x)=g(x)$를 연립하지 말고, 새로운 함수 $h(x) = f(x)-g(x)$를 그려 $x$축과의 교점으로 해석하여 식을 작성하십시오.
-                            4. **[Complex Plane Strategy (복소평면 치트키)]:** 만약 **'복소수(Complex Number)'** 단원 문제라면, $z=a+bi$ 대수 계산을 멈추고 즉시 **[복소평면(Gaussian Plane)]**을 도입하십시오.
-                               - 곱셈은 **회전 변환(Rotation)**으로, 덧셈은 **벡터의 합**으로 해석하여 기하학적으로 1초 만에 푸는 방법을 제시하십시오.
-                            5. **Cost-Benefit Analysis:** 당신의 풀이가 기존 숏컷보다 확실히 짧고 충격적일 때만 제시하십시오.
-
-                            **[작성 지침]**
-                            - 설명하려 하지 말고, **보여주십시오.** (Show, Don't Tell)
-                            - 문어체 필수. 수식은 LaTeX($$) 사용.
-
-                            **[출력 형식]**
-                            ===CONCEPT===
-                            (문제를 관통하는 단 하나의 원리)
-                            ===HINT===
-                            (기존 해설과는 다른, 도형이나 대칭성을 이용한 새로운 시각)
-                            ===SOLUTION===
-                            (논리적 정석 풀이 - Flash 모델과 동일해도 됨)
-                            ===SHORTCUT===
-                            (### ⚡ [2] Pro Insight (Ultra-Short)
-                            **[조건]**: 일반적인 공식 적용보다 더 빠르고 기발한 풀이.
-                            - 예: "복잡한 적분 계산 대신, 그래프 대칭성을 이용해 직사각형 넓이로 치환한다.")
-                            ===CORRECTION===
-                            (학생의 사고 과정 "{safe_self_note_pro}"와 **이미지 속 손글씨**의 맹점 지적)
-                            """
-                            try:
-                                res_text_pro, _ = generate_content_with_fallback(final_prompt_pro, st.session_state['gemini_image'], mode="pro", status_container=None, text_placeholder=None)
-                                
-                                data_pro = parse_response_to_dict(res_text_pro)
+                            stream_placeholder_pro = st.empty()
+                            with st.spinner("Pro 모델이 문제를 깊게 분석하고 재작성 중입니다... (약 15초 소요)"):
+                                try:
+                                    data_pro = None
+                                    if speculation: # 미리 만든(또는 만드는 중인) 결과 사용, 실패하면 아래에서 새로 생성
+                                        speculation = get_pro_speculator().take(current_session_id(), st.session_state['gemini_image'], st.session_state['self_note'])
+                                        try: data_pro = speculation.result(timeout=SPECULATIVE_PRO_WAIT_SEC) if speculation else None
+                                        except Exception: data_pro = None
+                                    if data_pro is None:
+                                        final_prompt_pro = build_pro_prompt(safe_self_note_pro)
+                                        data_pro, _ = generate_analysis(
+                                            st.session_state['selected_subject'], st.session_state['gemini_image'], safe_self_note_pro, "pro", final_prompt_pro,
+                                            text_placeholder=stream_placeholder_pro
+                                        )
                                 
-                                # 기존 데이터에 Pro 데이터 병합 (Append 방식)
-                                new_data = {
-                                    'pro_concept': data_pro.get('concept'),
-                                    'pro_solution': data_pro.get('solution'),
-                                    'pro_shortcut': data_pro.get('shortcut'),
-                                    'pro_correction': data_pro.get('correction')
-                                }
+                                    # 기존 데이터에 Pro 데이터 병합 (Append 방식)
+                                    new_data = {
+                                        'pro_concept': data_pro.get('concept'),
+                                        'pro_solution': data_pro.get('solution'),
+                                        'pro_shortcut': data_pro.get('shortcut'),
+                                        'pro_correction': data_pro.get('correction')
+                                    }
                                 
-                                # 세션 상태 업데이트
-                                st.session_state['analysis_result'].update(new_data)
+                                    # 세션 상태 업데이트
+                                    st.session_state['analysis_result'].update(new_data)
                                 
-                                if st.session_state['saved_timestamp']:
-                                    overwrite_result_in_sheet(
-                                        st.session_state['user_name'], 
-                                        st.session_state['saved_timestamp'], 
-                                        new_data
-                                    )
-                                st.toast("Pro 분석으로 업데이트되었습니다!")
-                                st.rerun()
-                            except Exception as e:
-                                st.error(f"Pro 분석 오류: {e}")
+                                    if st.session_state['saved_timestamp']:
+                                        overwrite_result_in_sheet(
+                                            st.session_state['user_name'], 
+                                            st.session_state['saved_timestamp'], 
+                                            new_data
+                                        )
+                                    st.toast("Pro 분석으로 업데이트되었습니다!")
+                                    st.rerun()
+                                except Exception as e:
+                                    st.error(f"Pro 분석 오류: {e}")
+
+            analysis_panel()
 
 elif menu == "📒 내 오답 노트":
     st.markdown("""
@@ -989,7 +3350,8 @@ elif menu == "📒 내 오답 노트":
     if not df.empty:
         my_notes = df[df['이름'] == st.session_state['user_name']].sort_values(by='날짜', ascending=False)
         
-        for index, row in my_notes.iterrows():
+        @timed_fragment("note") # 항목을 펼치거나 복습 완료를 눌러도 목록 전체를 다시 그리지 않음
+        def note_entry(index, row):
             with st.expander(f"📅 {row.get('날짜')} | {row.get('과목')} | {row.get('단원')}"):
                 col_img, col_txt = st.columns([1, 2])
                 with col_img:
@@ -998,65 +3360,63 @@ elif menu == "📒 내 오답 노트":
                     else: st.info("이미지 없음")
                 
                 with col_txt:
-                    raw_content = row.get('내용')
-                    content_json = None
-                    
-                    try:
-                        content_json = ast.literal_eval(raw_content)
-                    except:
-                        try:
-                            fixed_content = raw_content.replace("\\", "\\\\")
-                            content_json = ast.literal_eval(fixed_content)
-                        except:
+                    # 목록에는 헤더 열만 있으므로, 펼칠 때만 내용 셀을 가져옵니다.
+                    if st.checkbox("📖 풀이 펼치기", key=f"detail_{index}"):
+                        raw_content, content_json = load_result_content(row.get('날짜'), row.get('이름'))
+                        if content_json is None:
                             st.warning("⚠️ 데이터 형식이 복잡하여 원본을 표시합니다.")
                             st.text(raw_content)
 
-                    if content_json:
-                        if 'my_self_note' in content_json and content_json['my_self_note']:
-                            st.markdown(f"""
-                            <div class="bg-orange-50 p-3 rounded-lg border border-orange-200 mb-3">
-                                <span class="font-bold text-[#f97316]">✍️ 나의 정리:</span><br>
-                                {content_json['my_self_note']}
-                            </div>
-                            """, unsafe_allow_html=True)
+                        if content_json:
+                            if 'my_self_note' in content_json and content_json['my_self_note']:
+                                st.markdown(f"""
+                                <div class="bg-orange-50 p-3 rounded-lg border border-orange-200 mb-3">
+                                    <span class="font-bold text-[#f97316]">✍️ 나의 정리:</span><br>
+                                    {content_json['my_self_note']}
+                                </div>
+                                """, unsafe_allow_html=True)
                         
-                        st.markdown(f"**📘 개념:** {content_json.get('concept')}")
-                        st.markdown("**📝 풀이:**")
-                        sol_clean = content_json.get('solution', '').replace('\n', '  \n')
-                        st.markdown(sol_clean)
-                        st.info(f"⚡ **숏컷:** {content_json.get('shortcut')}")
+                            st.markdown(f"**📘 개념:** {content_json.get('concept')}")
+                            st.markdown("**📝 풀이:**")
+                            sol_clean = content_json.get('solution', '').replace('\n', '  \n')
+                            st.markdown(sol_clean)
+                            st.info(f"⚡ **숏컷:** {content_json.get('shortcut')}")
                         
-                        if content_json.get('correction') and content_json.get('correction') != "첨삭 없음":
-                            st.markdown("---")
-                            st.markdown(f"**📝 첨삭 지도:**\n{content_json.get('correction').replace(chr(10), '  '+chr(10))}")
-
-                        # Pro 분석 결과가 있다면 오답노트에도 표시
-                        if 'pro_solution' in content_json:
-                            st.markdown("---")
-                            st.markdown("### 🧠 Pro 심화 분석")
-                            st.markdown(f"**심화 개념:** {content_json.get('pro_concept')}")
-                            st.markdown(content_json.get('pro_solution').replace('\n', '  \n'))
-                            st.info(f"⚡ **Pro 숏컷:** {content_json.get('pro_shortcut')}")
-
-                        if 'chat_history' in content_json and content_json['chat_history']:
-                            st.markdown("---")
-                            if st.checkbox("💬 튜터링 대화 기록 보기", key=f"chat_view_{index}"):
-                                for msg in content_json['chat_history']:
-                                    role = "🤖 선생님" if msg['role'] == 'ai' else "🧑‍🎓 나"
-                                    st.markdown(f"**{role}:** {msg['content']}")
-
-                        if content_json.get('twin_problem'):
-                            st.divider()
-                            st.markdown("**📝 쌍둥이 문제**")
-                            st.markdown(content_json.get('twin_problem').replace('\n', '  \n'))
-                            if st.checkbox("정답 보기", key=f"twin_ans_{index}"):
-                                st.markdown(content_json.get('twin_answer').replace('\n', '  \n'))
+                            if content_json.get('correction') and content_json.get('correction') != "첨삭 없음":
+                                st.markdown("---")
+                                st.markdown(f"**📝 첨삭 지도:**\n{content_json.get('correction').replace(chr(10), '  '+chr(10))}")
+
+                            # Pro 분석 결과가 있다면 오답노트에도 표시
+                            if 'pro_solution' in content_json:
+                                st.markdown("---")
+                                st.markdown("### 🧠 Pro 심화 분석")
+                                st.markdown(f"**심화 개념:** {content_json.get('pro_concept')}")
+                                st.markdown(content_json.get('pro_solution').replace('\n', '  \n'))
+                                st.info(f"⚡ **Pro 숏컷:** {content_json.get('pro_shortcut')}")
+
+                            if 'chat_history' in content_json and content_json['chat_history']:
+                                st.markdown("---")
+                                if st.checkbox("💬 튜터링 대화 기록 보기", key=f"chat_view_{index}"):
+                                    for msg in content_json['chat_history']:
+                                        role = "🤖 선생님" if msg['role'] == 'ai' else "🧑‍🎓 나"
+                                        st.markdown(f"**{role}:** {msg['content']}")
+
+                            if content_json.get('twin_problem'):
+                                st.divider()
+                                st.markdown("**📝 쌍둥이 문제**")
+                                st.markdown(content_json.get('twin_problem').replace('\n', '  \n'))
+                                if st.checkbox("정답 보기", key=f"twin_ans_{index}"):
+                                    st.markdown(content_json.get('twin_answer').replace('\n', '  \n'))
 
                 if st.button("✅ 오늘 복습 완료", key=f"rev_{index}"):
                     if increment_review_count(row.get('날짜'), row.get('이름')):
                         st.toast("복습 횟수가 증가했습니다!")
-                        time.sleep(1)
-                        st.rerun()
+
+        for index, row in my_notes.iterrows():
+            note_entry(index, row.to_dict())
     else: st.info("아직 저장된 오답 노트가 없습니다.")
 
+finish_run()
+record_run_time("app", time.perf_counter() - RUN_STARTED_AT)
+
 
@@ -0,0 +1,66 @@
+import argparse
+import statistics
+import time
+
+from PIL import Image, ImageDraw
+
+import solution_image
+
+# ----------------------------------------------------------
+# 오답노트 이미지 렌더러 마이크로 벤치마크
+#   python bench_solution_image.py [--runs 20] [--engines pil matplotlib]
+# 엔진별로 첫 호출(콜드: 폰트/수식 캐시 비어 있음)과 반복 호출(웜)의 시간을 비교합니다.
+# ----------------------------------------------------------
+
+HINT_TEXTS = {
+    "plain": "판별식 D가 0보다 커야 서로 다른 두 실근을 가진다.\n근과 계수의 관계를 먼저 적용할 것.",
+    "latex": "$f'(x)=3x^2-6x$ 의 부호 변화로 증감표 작성\n$\\int_0^1 f(x)dx = \\frac{1}{2}$ 을 이용",
+    "long": "조건 (가)에서 $g(x)=f(x)-x$ 로 두면 $g(1)=g(3)=0$ 이므로 인수정리로 $g(x)=(x-1)(x-3)h(x)$ 꼴이 되고, "
+            "조건 (나)의 극한값에서 $h(2)$ 를 결정한 뒤 넓이를 비교한다.",
+    "broken": "$\\frac{1}{2$ 처럼 닫히지 않은 수식이 섞인 힌트\n정상 수식 $x^2+1$ 은 그대로 표시",
+}
+
+def make_problem_image(width=800, height=600):
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    for i in range(12):
+        draw.text((40, 30 + i * 45), f"{i + 1}. 함수 f(x) = x^3 - 3x^2 + {i}x 에 대하여 다음 물음에 답하시오.", fill="black")
+    return image
+
+def bench_engine(engine, problem, hints, runs):
+    render = solution_image.SOLUTION_IMAGE_ENGINES[engine]
+    started = time.perf_counter()
+    first = render(problem, hints)
+    cold_ms = (time.perf_counter() - started) * 1000
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        render(problem, hints)
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        "cold_ms": cold_ms,
+        "mean_ms": statistics.mean(samples),
+        "p95_ms": samples[min(len(samples) - 1, int(0.95 * len(samples)))],
+        "size": first.size,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--engines", nargs="+", default=list(solution_image.SOLUTION_IMAGE_ENGINES))
+    args = parser.parse_args()
+
+    problem = make_problem_image()
+    solution_image.get_handwriting_font_path() # 폰트 다운로드 시간은 측정에서 제외
+
+    print(f"{'hint':<8} {'engine':<11} {'cold ms':>9} {'mean ms':>9} {'p95 ms':>9}  size")
+    for name, hints in HINT_TEXTS.items():
+        results = {engine: bench_engine(engine, problem, hints, args.runs) for engine in args.engines}
+        for engine, r in results.items():
+            print(f"{name:<8} {engine:<11} {r['cold_ms']:>9.1f} {r['mean_ms']:>9.1f} {r['p95_ms']:>9.1f}  {r['size'][0]}x{r['size'][1]}")
+        if "pil" in results and "matplotlib" in results:
+            print(f"{'':<8} {'speedup':<11} {'':>9} {results['matplotlib']['mean_ms'] / results['pil']['mean_ms']:>8.1f}x")
+
+if __name__ == "__main__":
+    main()
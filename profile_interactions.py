@@ -0,0 +1,125 @@
+import argparse
+import hashlib
+import io
+import os
+import statistics
+import sys
+import threading
+
+from PIL import Image, ImageDraw
+
+# ----------------------------------------------------------
+# 상호작용당 서버 실행 시간 비교 (fragment 도입 전/후)
+#   python profile_interactions.py [--runs 20]
+# 튜터링 화면을 AppTest 로 실행하면서 app.py 가 세션에 남기는 범위별 실행 시간(run_timings)을 읽습니다.
+#   app      = 전체 리런 (fragment 도입 전에는 채팅 한 번, 판서 한 획, 버튼 하나마다 이만큼 실행)
+#   problem / chat / analysis = 각 조각만 다시 실행(fragment 리런)될 때의 시간 (도입 후 해당 조각 안의 상호작용 비용)
+# AppTest 는 전체 실행만 요청하므로, 조각 저장소를 실행 사이에 유지하고 요청에 조각 id 를 싣는 러너로 바꿔 끼워
+# 서버가 조각 안의 위젯 이벤트를 받았을 때와 같은 조각 리런을 일으킵니다.
+# Gemini·시트 호출 없이 그릴 수 있도록 로그인·문제·해설·대화 상태를 미리 채워 둡니다.
+# ----------------------------------------------------------
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_FILE = os.path.join(APP_DIR, "app.py")
+SCOPES = ["app", "problem", "chat", "analysis"]
+WARMUP_THREADS = {"solution-image-prefetch", "record-migration"} # 로그인 직후 한 번 도는 백그라운드 예열
+
+class SampleProblem:
+    # app.py 의 ProblemImage 와 같은 속성을 가진 문제 이미지 (AppTest 밖에서는 앱 모듈의 클래스를 쓸 수 없음)
+    def __init__(self, width=800, height=600):
+        image = Image.new("L", (width, height), 255)
+        draw = ImageDraw.Draw(image)
+        for i in range(12):
+            draw.text((40, 30 + i * 45), f"{i + 1}. f(x) = x^3 - 3x^2 + {i}x", fill=0)
+        buf = io.BytesIO()
+        image.save(buf, format="JPEG", quality=85)
+        self.image, self.data, self.mime_type = image, buf.getvalue(), "image/jpeg"
+        self.size = image.size
+        self.dhash = "0" * 64
+        self.digest = hashlib.blake2b(self.data, digest_size=16).hexdigest()
+
+    def blob(self):
+        return {"mime_type": self.mime_type, "data": self.data}
+
+    def release(self):
+        pass
+
+    def decoded_nbytes(self):
+        return self.image.width * self.image.height
+
+def sample_session():
+    messages = []
+    for i in range(6):
+        messages.append({"role": "user", "content": f"{i + 1}번째 질문: 증감표에서 $f'(x)$ 의 부호가 왜 바뀌나요?"})
+        messages.append({"role": "ai", "content": "$f'(x)=3(x-1)(x-3)$ 이므로 $x=1$, $x=3$ 에서 부호가 바뀝니다. " * 3})
+    analysis = {
+        "concept": "도함수의 부호와 증감", "hint_for_image": "$f'(x)$ 의 부호 변화", "solution": "풀이 과정 " * 200,
+        "shortcut": "대칭성 이용", "correction": "첨삭 없음", "twin_problem": "쌍둥이 문제 " * 30, "twin_answer": "3",
+    }
+    return {
+        "is_logged_in": True, "user_name": "측정용", "chat_active": True, "selected_subject": "[15개정] 수학II",
+        "gemini_image": SampleProblem(), "chat_messages": messages, "analysis_result": analysis,
+        "saved_timestamp": "2026-01-01 00:00:00", "last_saved_chat_len": len(messages),
+    }
+
+def install_fragment_runner():
+    # → (조각 저장소, 다음 실행에서 다시 실행할 조각 id 목록)
+    from dataclasses import replace
+    from streamlit.runtime.fragment import MemoryFragmentStorage
+    from streamlit.testing.v1 import app_test, local_script_runner
+    storage, pending = MemoryFragmentStorage(), []
+
+    class FragmentScriptRunner(local_script_runner.LocalScriptRunner):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._fragment_storage = storage # 전체 실행에서 등록된 조각을 다음 실행에서도 찾을 수 있도록
+
+        def request_rerun(self, rerun_data):
+            if pending: rerun_data = replace(rerun_data, fragment_id_queue=[pending.pop()], is_fragment_scoped_rerun=True)
+            return super().request_rerun(rerun_data)
+
+    app_test.LocalScriptRunner = FragmentScriptRunner
+    return storage, pending
+
+def measure(runs):
+    sys.path.insert(0, APP_DIR) # streamlit run 은 스크립트 폴더를 sys.path 에 넣지만 AppTest 는 넣지 않음
+    from streamlit.testing.v1 import AppTest
+    storage, pending = install_fragment_runner()
+    at = AppTest.from_file(APP_FILE, default_timeout=120)
+    at.secrets["GOOGLE_API_KEY"] = "profile"
+    at.secrets["IMGBB_API_KEY"] = "profile"
+    for key, value in sample_session().items():
+        at.session_state[key] = value
+    at.run() # 첫 실행은 import·캐시 준비가 섞이므로 제외
+    if at.exception:
+        raise RuntimeError(f"튜터링 화면 실행 실패: {[e.value for e in at.exception]}")
+    for thread in threading.enumerate(): # 예열(렌더러·matplotlib import 등)이 측정 구간에서 GIL 을 나눠 쓰지 않도록 끝날 때까지 대기
+        if thread.name in WARMUP_THREADS: thread.join(timeout=60)
+    at.session_state["run_timings"] = {}
+    for _ in range(runs):
+        at.run()
+    for fragment_id in list(storage._fragments):
+        for _ in range(runs):
+            pending.append(fragment_id)
+            at.run()
+            if at.exception:
+                raise RuntimeError(f"조각 리런 실패: {[e.value for e in at.exception]}")
+    timings = at.session_state["run_timings"]
+    return {scope: [t * 1000 for t in timings.get(scope, [])] for scope in SCOPES}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=20)
+    args = parser.parse_args()
+
+    samples = measure(args.runs)
+    full = statistics.median(samples["app"])
+    print(f"{'scope':<10} {'p50 ms':>9} {'max ms':>9}  {'vs full rerun':>13}")
+    for scope in SCOPES:
+        if not samples[scope]: continue
+        p50 = statistics.median(samples[scope])
+        ratio = "" if scope == "app" else f"{p50 / full * 100:>12.1f}%"
+        print(f"{scope:<10} {p50:>9.1f} {max(samples[scope]):>9.1f}  {ratio}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+import argparse
+import ast
+import os
+import statistics
+import subprocess
+import sys
+
+# ----------------------------------------------------------
+# 콜드 스타트 측정
+#   python profile_startup.py [--runs 5] [--write] [--check]
+# 1) app.py 모듈 최상단 import 들을 새 프로세스에서 -X importtime 으로 측정 (누적 ms)
+# 2) 로그인 화면까지 걸리는 시간: 새 프로세스에서 streamlit 만 미리 로드한 뒤(실제 서버와 같은 조건)
+#    AppTest 로 app.py 첫 실행 → 아이디/비밀번호 입력칸이 그려질 때까지
+# --write: 결과를 startup_profile.txt 에 저장 / --check: 목표 시간을 넘으면 종료 코드 1
+# ----------------------------------------------------------
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_FILE = os.path.join(APP_DIR, "app.py")
+REPORT_FILE = os.path.join(APP_DIR, "startup_profile.txt")
+
+# 로그인 화면 첫 실행 목표 (p50). 이 중 약 0.4초는 pandas import 로, 쿠키 컴포넌트(CookieManager)를 그릴 때
+# streamlit 이 인자 검사(is_dataframe_like)를 하면서 불러오므로 app.py 에서는 피할 수 없음
+LOGIN_PAGE_TARGET_MS = 1200
+LOGIN_LABELS = {"아이디", "비밀번호"}
+
+LOGIN_PROBE = r"""
+import sys, time
+sys.path.insert(0, {app_dir!r}) # streamlit run 은 스크립트 폴더를 sys.path 에 넣지만 AppTest 는 넣지 않음
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file({app_file!r}, default_timeout=120)
+at.secrets["GOOGLE_API_KEY"] = "profile"
+at.secrets["IMGBB_API_KEY"] = "profile"
+started = time.perf_counter()
+at.run()
+elapsed = (time.perf_counter() - started) * 1000
+labels = sorted(t.label for t in at.text_input)
+errors = [e.value for e in at.exception]
+print(f"{{elapsed:.1f}}\t{{'|'.join(labels)}}\t{{'|'.join(map(str, errors))}}")
+"""
+
+def top_level_imports(path):
+    # [(표시 이름, import 문, importtime 에서 찾을 모듈 이름들), ...]
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    imports = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            imports.extend((alias.name, f"import {alias.name}", [alias.name]) for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            names = [node.module] + [f"{node.module}.{alias.name}" for alias in node.names] # from 패키지 import 하위모듈
+            imports.append((node.module, ast.unparse(node), names))
+    return imports
+
+def profile_imports(imports):
+    code = "; ".join(statement for _, statement, _ in imports)
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True, cwd=APP_DIR)
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line: continue
+        _, cum, name = line.split("|", 2)
+        if name.startswith("  "): continue # 최상위 import 만
+        try: cumulative[name.strip()] = int(cum) / 1000
+        except ValueError: pass
+    return [(label, sum(cumulative.get(n, 0.0) for n in names)) for label, _, names in imports]
+
+def measure_login_page(runs):
+    probe = LOGIN_PROBE.format(app_dir=APP_DIR, app_file=APP_FILE)
+    samples = []
+    for _ in range(runs):
+        proc = subprocess.run([sys.executable, "-W", "ignore", "-c", probe], capture_output=True, text=True, cwd=APP_DIR)
+        output = proc.stdout.splitlines()
+        parts = output[-1].split("\t") if output else []
+        if len(parts) != 3:
+            raise RuntimeError(f"로그인 화면 측정 실패:\n{proc.stderr[-2000:]}")
+        elapsed, labels, errors = parts
+        if errors or not LOGIN_LABELS <= set(labels.split("|")):
+            raise RuntimeError(f"로그인 화면이 그려지지 않음: labels={labels!r} errors={errors!r}")
+        samples.append(float(elapsed))
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--write", action="store_true")
+    parser.add_argument("--check", action="store_true")
+    args = parser.parse_args()
+
+    lines = [f"python {sys.version.split()[0]}", "", "[app.py 최상단 import, 누적 ms (-X importtime)]"]
+    imports = profile_imports(top_level_imports(APP_FILE))
+    for name, ms in sorted(imports, key=lambda item: -item[1]):
+        lines.append(f"  {name:<36} {ms:>8.1f}")
+    lines.append(f"  {'(합계)':<36} {sum(ms for _, ms in imports):>8.1f}")
+
+    samples = measure_login_page(args.runs)
+    p50 = statistics.median(samples)
+    lines += [
+        "",
+        f"[로그인 화면 첫 실행, {args.runs}회 (각각 새 프로세스)]",
+        f"  p50 {p50:.1f} ms / min {min(samples):.1f} ms / max {max(samples):.1f} ms",
+        f"  목표 {LOGIN_PAGE_TARGET_MS} ms → {'OK' if p50 <= LOGIN_PAGE_TARGET_MS else 'FAIL'}",
+    ]
+    report = "\n".join(lines)
+    print(report)
+    if args.write:
+        with open(REPORT_FILE, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    if args.check and p50 > LOGIN_PAGE_TARGET_MS:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+import functools
+import io
+import os
+import re
+import textwrap
+import threading
+import time
+
+import requests
+import matplotlib.pyplot as plt
+import matplotlib.font_manager as fm
+import matplotlib.patches as patches
+from matplotlib.mathtext import math_to_image
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+
+# ----------------------------------------------------------
+# 오답노트 이미지 렌더러 (문제 이미지 + "1타 강사의 핵심 Point" 노트)
+# ----------------------------------------------------------
+# - "matplotlib": 기존 엔진 (figure + imshow + ax.text, mathtext 실패 시 전체 다시 그림)
+# - "pil": Pillow 로 직접 합성. 레이아웃(수식 조각 검증·비트맵 캐시, 픽셀 폭 줄바꿈) 후 한 번에 그림
+# 두 엔진의 결과가 같은 모양이 되도록 PIL 엔진의 치수는 기존 figure 출력(10in × 100dpi, 기본 subplot 여백,
+# bbox_inches='tight')에서 측정한 값을 씁니다. 벤치마크: python bench_solution_image.py
+
+FONT_FILE = "NanumPen.ttf"
+FONT_URL = "https://github.com/google/fonts/raw/main/ofl/nanumpenscript/NanumPenScript-Regular.ttf"
+FONT_DOWNLOAD_TIMEOUT = (3, 10) # (연결, 읽기) 초
+FONT_RETRY_SEC = 300            # 다운로드 실패 후 다시 시도하기까지 (실패를 영구히 캐시하지 않음)
+FONT_SYSTEM_FALLBACKS = ["NanumGothic", "Noto Sans CJK KR", "Noto Sans KR", "Malgun Gothic", "AppleGothic", "UnDotum"] # 손글씨 폰트가 없을 때 쓸 한글 폰트
+
+NOTE_TITLE = "💡 1타 강사의 핵심 Point"
+NOTE_BG = "#FFFACD"
+TITLE_COLOR = "#FF4500"
+TEXT_COLOR = "#333333"
+
+# 기존 figure 기준 치수 (픽셀)
+PIL_OUTPUT_WIDTH = 775      # 10in × 100dpi 중 axes 폭(0.775)
+PIL_NOTE_HEIGHT = 385       # 노트 axes 높이 (0.5 × 0.77 × 1000)
+PIL_MARGIN_X = 39           # x = 0.05 (axes 비율)
+PIL_TITLE_Y = 46            # y = 0.88 (위에서 0.12)
+PIL_BODY_Y = 108            # y = 0.72
+PIL_LINE_STEP = 50          # 0.13 간격
+PIL_TITLE_SIZE = 33         # 24pt @ 100dpi
+PIL_BODY_SIZE = 29          # 21pt @ 100dpi
+PIL_BODY_PT = 21
+PIL_MATH_DPI = 100
+WRAP_WIDTH = 38
+
+_MPL_LOCK = threading.Lock() # pyplot 전역 상태 보호 (여러 세션/스레드 동시 렌더링)
+_FONT_LOCK = threading.Lock()
+_font_failed_at = None
+
+def get_handwriting_font_path():
+    # 이전에 받아 둔 파일 → 다운로드(시간 제한). 실패하면 None 을 돌려주고 FONT_RETRY_SEC 뒤에 다시 시도
+    global _font_failed_at
+    if os.path.exists(FONT_FILE): return FONT_FILE
+    with _FONT_LOCK: # 동시에 부른 렌더링이 같은 파일을 여러 번 받지 않도록
+        if os.path.exists(FONT_FILE): return FONT_FILE
+        if _font_failed_at is not None and time.monotonic() - _font_failed_at < FONT_RETRY_SEC: return None
+        try:
+            r = requests.get(FONT_URL, timeout=FONT_DOWNLOAD_TIMEOUT)
+            r.raise_for_status()
+            tmp_path = f"{FONT_FILE}.{os.getpid()}.tmp" # 받다가 끊긴 파일을 폰트로 쓰지 않도록 다 받은 뒤 교체
+            with open(tmp_path, "wb") as f:
+                f.write(r.content)
+            os.replace(tmp_path, FONT_FILE)
+        except Exception:
+            _font_failed_at = time.monotonic()
+            return None
+    return FONT_FILE
+
+@functools.lru_cache(maxsize=1)
+def get_korean_system_font_path():
+    # 손글씨 폰트를 못 받았을 때 쓸 한글 시스템 폰트 (없으면 None)
+    for family in FONT_SYSTEM_FALLBACKS:
+        try: return fm.findfont(fm.FontProperties(family=family), fallback_to_default=False)
+        except ValueError: continue
+    return None
+
+def get_font_path():
+    return get_handwriting_font_path() or get_korean_system_font_path()
+
+def prefetch():
+    # 백그라운드 예열용: 폰트 준비 + 폰트 객체 생성 (이 모듈 import 로 matplotlib 도 함께 로드됨)
+    get_handwriting_font_prop()
+    _pil_font(PIL_BODY_SIZE)
+
+def get_handwriting_font_prop():
+    font_path = get_font_path()
+    return _font_prop(font_path) if font_path else None
+
+@functools.lru_cache(maxsize=4)
+def _font_prop(font_path):
+    try: return fm.FontProperties(fname=font_path)
+    except: return None
+
+def clean_text_for_plot_safe(text):
+    if not text: return ""
+    text = text.replace(r'\iff', '⇔').replace(r'\implies', '⇒')
+    return text
+
+def text_for_plot_fallback(text):
+    if not text: return ""
+    return re.sub(r'[\$\\\{\}]', '', text)
+
+def create_solution_image_mpl(original_image, hints):
+    with _MPL_LOCK:
+        font_prop = get_handwriting_font_prop()
+        w, h = original_image.size
+        aspect = h / w
+        note_height_ratio = 0.5
+        fig_width = 10
+        fig_height = fig_width * (aspect + note_height_ratio)
+
+        fig = plt.figure(figsize=(fig_width, fig_height))
+        gs = fig.add_gridspec(2, 1, height_ratios=[aspect, note_height_ratio], hspace=0)
+
+        ax_img = fig.add_subplot(gs[0])
+        ax_img.imshow(original_image.convert("RGB")) # 흑백(L) 이미지가 컬러맵으로 칠해지지 않도록
+        ax_img.axis('off')
+
+        ax_note = fig.add_subplot(gs[1])
+        ax_note.axis('off')
+        ax_note.set_facecolor(NOTE_BG)
+        rect = patches.Rectangle((0,0), 1, 1, transform=ax_note.transAxes, color=NOTE_BG, zorder=0)
+        ax_note.add_patch(rect)
+        ax_note.plot([0, 1], [1, 1], transform=ax_note.transAxes, color='gray', linestyle='--', linewidth=1)
+
+        try:
+            # 그릴 수 없는 수식 조각만 미리 글자로 바꿔서 노트 전체를 다시 그리는 일을 줄임
+            safe_hints = validate_math_fragments(clean_text_for_plot_safe(hints))
+            ax_note.text(0.05, 0.88, NOTE_TITLE, fontsize=24, color=TITLE_COLOR, fontweight='bold', va='top', ha='left', transform=ax_note.transAxes, fontproperties=font_prop)
+
+            # 힌트 텍스트 줄바꿈 처리
+            lines = safe_hints.split('\n')
+            y_pos = 0.72
+
+            for line in lines:
+                if not line.strip(): continue
+
+                # 🔥 [수정 핵심] 글자를 자르는 대신(Truncate), 폭에 맞춰 줄바꿈(Wrap) 합니다.
+                # width=40 은 대략 한 줄에 들어갈 글자 수입니다. (폰트 크기에 따라 조절 가능)
+                wrapped_lines = textwrap.wrap(line.strip(), width=WRAP_WIDTH)
+
+                for i, w_line in enumerate(wrapped_lines):
+                    # 첫 줄엔 bullet point(•), 둘째 줄부터는 들여쓰기
+                    prefix = "• " if i == 0 else "  "
+                    ax_note.text(0.05, y_pos, f"{prefix}{w_line}", fontsize=21, color=TEXT_COLOR, va='top', ha='left', transform=ax_note.transAxes, fontproperties=font_prop)
+
+                    # 줄 간격 (폰트 크기에 맞춰 넉넉하게)
+                    y_pos -= 0.13
+
+            fig.canvas.draw()
+        except:
+            ax_note.clear()
+            ax_note.axis('off')
+            ax_note.add_patch(rect)
+            fallback_hints = text_for_plot_fallback(hints)
+            ax_note.text(0.05, 0.85, NOTE_TITLE, fontsize=24, color=TITLE_COLOR, fontweight='bold', va='top', ha='left', transform=ax_note.transAxes, fontproperties=font_prop)
+
+            # 예외 발생 시에도 줄바꿈 적용
+            ax_note.text(0.05, 0.65, fallback_hints, fontsize=21, color=TEXT_COLOR, va='top', ha='left', transform=ax_note.transAxes, wrap=True, fontproperties=font_prop, linespacing=2.0)
+
+        buf = io.BytesIO()
+        plt.savefig(buf, format='jpg', bbox_inches='tight', pad_inches=0)
+        buf.seek(0)
+        plt.close(fig)
+    return Image.open(buf)
+
+# ----------------------------------------------------------
+# PIL 엔진
+# ----------------------------------------------------------
+def _pil_font(size):
+    # 폰트 객체는 (파일, 크기)별로 캐시하고, 어느 파일을 쓸지는 매번 정함 (나중에 받은 손글씨 폰트로 바뀔 수 있도록)
+    return _load_pil_font(get_font_path(), size)
+
+@functools.lru_cache(maxsize=16)
+def _load_pil_font(font_path, size):
+    if font_path:
+        try: return ImageFont.truetype(font_path, size)
+        except OSError: pass
+    return ImageFont.load_default()
+
+@functools.lru_cache(maxsize=512)
+def _render_math_mask(expr, size_pt):
+    # 수식 한 조각을 (식, 크기)당 한 번만 그려 흑백 마스크(L)로 보관 → 붙일 때 원하는 색으로 칠함
+    # 파싱에 실패한 식은 None 으로 캐시해서 다시 시도하지 않음
+    buf = io.BytesIO()
+    try:
+        math_to_image(expr, buf, prop=fm.FontProperties(size=size_pt), dpi=PIL_MATH_DPI, format="png")
+    except Exception:
+        return None
+    buf.seek(0)
+    return ImageOps.invert(Image.open(buf).convert("L"))
+
+def _split_math(line):
+    return [part for part in re.split(r'(\$[^$]+\$)', line) if part]
+
+def _is_math(part):
+    return len(part) > 1 and part.startswith("$") and part.endswith("$")
+
+def validate_math_fragments(text, size_pt=PIL_BODY_PT):
+    # 그릴 수 없는 $수식$ 조각만 일반 글자로 바꿈 (나머지 수식은 그대로 유지)
+    parts = []
+    for part in _split_math(text):
+        if _is_math(part) and _render_math_mask(part, size_pt) is None:
+            part = text_for_plot_fallback(part)
+        parts.append(part)
+    return "".join(parts)
+
+def _layout_tokens(line, font, size_pt):
+    # (종류, 값, 폭) 토큰: 글자는 단어/공백 단위, 수식은 잘리지 않는 한 덩어리
+    tokens = []
+    for part in _split_math(line):
+        mask = _render_math_mask(part, size_pt) if _is_math(part) else None
+        if mask is not None:
+            tokens.append(("math", mask, mask.width))
+            continue
+        if _is_math(part):
+            part = text_for_plot_fallback(part)
+        for word in re.findall(r'\S+|\s+', part):
+            tokens.append(("text", word, font.getlength(word)))
+    return tokens
+
+def _split_long_word(word, font, max_width):
+    pieces, current = [], ""
+    for ch in word:
+        if current and font.getlength(current + ch) > max_width:
+            pieces.append(current)
+            current = ch
+        else:
+            current += ch
+    if current: pieces.append(current)
+    return pieces
+
+def layout_hint_lines(hints, font, size_pt, max_width):
+    # 실제 픽셀 폭으로 줄바꿈. 결과: 줄마다 [(종류, 값, 폭), ...]
+    bullet, indent = "• ", "  "
+    lines = []
+    for raw_line in clean_text_for_plot_safe(hints).split('\n'):
+        if not raw_line.strip(): continue
+        current = [("text", bullet, font.getlength(bullet))]
+        x = current[0][2]
+        content = False
+
+        def push():
+            while current and current[-1][0] == "text" and not current[-1][1].strip():
+                current.pop()
+            lines.append(list(current))
+
+        queue = _layout_tokens(raw_line.strip(), font, size_pt)
+        while queue:
+            kind, value, width = queue.pop(0)
+            if kind == "text" and not value.strip():
+                if content:
+                    current.append((kind, value, width))
+                    x += width
+                continue
+            if content and x + width > max_width:
+                push()
+                current = [("text", indent, font.getlength(indent))]
+                x = current[0][2]
+                content = False
+            if kind == "text" and not content and x + width > max_width:
+                # 한 단어가 한 줄보다 길면 글자 단위로 나눔
+                pieces = _split_long_word(value, font, max_width - x)
+                queue[:0] = [("text", piece, font.getlength(piece)) for piece in pieces[1:]]
+                value = pieces[0]
+                width = font.getlength(value)
+            current.append((kind, value, width))
+            x += width
+            content = True
+        push()
+    return lines
+
+def _draw_layout_line(draw, x, y, tokens, font, line_height):
+    text_run = ""
+    for kind, value, width in tokens:
+        if kind == "text":
+            text_run += value
+            continue
+        if text_run:
+            draw.text((x, y), text_run, font=font, fill=TEXT_COLOR)
+            x += font.getlength(text_run)
+            text_run = ""
+        draw.bitmap((x, y + max(0, (line_height - value.height) // 2)), value, fill=TEXT_COLOR)
+        x += width
+    if text_run:
+        draw.text((x, y), text_run, font=font, fill=TEXT_COLOR)
+
+def create_solution_image_pil(original_image, hints):
+    title_font = _pil_font(PIL_TITLE_SIZE)
+    body_font = _pil_font(PIL_BODY_SIZE)
+
+    # 1) 레이아웃: 수식 검증/렌더링(캐시)과 픽셀 폭 줄바꿈을 먼저 끝냄
+    body_lines = layout_hint_lines(hints, body_font, PIL_BODY_PT, PIL_OUTPUT_WIDTH - 2 * PIL_MARGIN_X)
+
+    # 2) 그리기: 이미지당 한 번
+    img = original_image.convert("RGB")
+    img_h = round(img.height * PIL_OUTPUT_WIDTH / img.width)
+    note_h = max(PIL_NOTE_HEIGHT, PIL_BODY_Y + PIL_LINE_STEP * len(body_lines))
+    canvas = Image.new("RGB", (PIL_OUTPUT_WIDTH, img_h + note_h), NOTE_BG)
+    canvas.paste(img.resize((PIL_OUTPUT_WIDTH, img_h), Image.Resampling.LANCZOS), (0, 0))
+
+    draw = ImageDraw.Draw(canvas)
+    for x in range(0, PIL_OUTPUT_WIDTH, 8):
+        draw.line([(x, img_h), (x + 4, img_h)], fill="gray", width=1)
+    draw.text((PIL_MARGIN_X, img_h + PIL_TITLE_Y), NOTE_TITLE, font=title_font, fill=TITLE_COLOR)
+
+    line_height = getattr(body_font, "size", PIL_BODY_SIZE)
+    y = img_h + PIL_BODY_Y
+    for tokens in body_lines:
+        _draw_layout_line(draw, PIL_MARGIN_X, y, tokens, body_font, line_height)
+        y += PIL_LINE_STEP
+    return canvas
+
+SOLUTION_IMAGE_ENGINES = {
+    "pil": create_solution_image_pil,
+    "matplotlib": create_solution_image_mpl,
+}
+
+def create_solution_image(original_image, hints, engine="pil"):
+    return SOLUTION_IMAGE_ENGINES.get(engine, create_solution_image_pil)(original_image, hints)